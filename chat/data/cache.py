@@ -0,0 +1,352 @@
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Optional
+from chat.data.types import Conversation, Message
+from chat.dialog.breaker import CircuitOpenError, get_breaker
+
+
+class ConversationCache:
+    """Bounded LRU cache of hot conversations with a time to live.
+
+    Conversations are copied on the way in and out, so a turn that fails halfway
+    can't leave a half-updated conversation in the cache.
+    The cache is used from both the event loop and executor threads, hence the lock.
+    The cache only knows about the turns handled by this process, so FirestoreHandler checks a hit
+    against firestore before using it, see FirestoreHandler.get_conversation_async.
+    """
+
+    # Hits are the latest turn even if another process handled it
+    shared = False
+
+    def __init__(self, max_size: int = 1000, ttl: float = 1800):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        "Returns a copy of the cached conversation or None on a miss"
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[conversation_id]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(conversation_id)
+            self.hits += 1
+            conversation = entry[1]
+
+        return conversation.copy(deep=True)
+
+    def put(self, conversation: Conversation):
+        "Adds or replaces a conversation and evicts the least recently used if the cache is full"
+        entry = (time.monotonic() + self.ttl, conversation.copy(deep=True))
+        with self._lock:
+            self._entries[conversation.conversation_id] = entry
+            self._entries.move_to_end(conversation.conversation_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, conversation_id: str):
+        with self._lock:
+            self._entries.pop(conversation_id, None)
+
+    def reject(self, conversation_id: str):
+        "Removes a hit that turned out to be older than the conversation in firestore"
+        self.stale_hits += 1
+        self.invalidate(conversation_id)
+
+    def mark_deleted(self, conversation_id: str):
+        "Only this process' copy can be removed. Writes of other processes fail since firestore has no conversation"
+        self.invalidate(conversation_id)
+
+    def version(self, conversation_id: str) -> Optional[int]:
+        "Only needed when the cache is shared between processes, see RedisConversationCache"
+        return None
+
+    # The interface used on the event loop. The local cache never blocks, so they just call the methods above
+
+    async def get_async(self, conversation_id: str) -> Optional[Conversation]:
+        return self.get(conversation_id)
+
+    async def put_async(self, conversation: Conversation):
+        self.put(conversation)
+
+    async def mark_deleted_async(self, conversation_id: str):
+        self.mark_deleted(conversation_id)
+
+    async def version_async(self, conversation_id: str) -> Optional[int]:
+        return None
+
+    async def close(self):
+        return
+
+    def stats(self) -> Dict:
+        "Returns size and hit/miss counters"
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+        }
+
+
+# Version marker of deleted conversations. Higher than any real version, so no worker can cache them again
+deleted_version = 2 ** 52
+
+# Bump when the encoding changes. Entries in other formats are treated as misses, e.g. during a deploy
+serialization_format = 1
+_header = struct.Struct(">BQ")
+
+
+def serialize_conversation(conversation: Conversation) -> bytes:
+    """Packs a conversation and its loaded messages into a compact binary entry:
+    a header with the format and the conversation's version, followed by compressed json where
+    the messages are rows of values and the field names are stored once"""
+    message_fields = list(Message.__fields__)
+    data = {
+        "conversation": conversation.dict(exclude={"messages"}),
+        "message_fields": message_fields,
+        "messages": [
+            [getattr(message, field) for field in message_fields]
+            for message in conversation.messages
+        ],
+    }
+    payload = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+    header = _header.pack(serialization_format, conversation.nbr_messages)
+    return header + zlib.compress(payload.encode("utf-8"), 1)
+
+
+def deserialize_conversation(entry: bytes) -> Optional[Conversation]:
+    "Unpacks an entry made by serialize_conversation. Returns None if it's in another format"
+    if len(entry) < _header.size:
+        return None
+    entry_format, _ = _header.unpack_from(entry)
+    if entry_format != serialization_format:
+        return None
+    data = json.loads(zlib.decompress(entry[_header.size :]))
+    message_fields = data["message_fields"]
+    messages = [Message(**dict(zip(message_fields, row))) for row in data["messages"]]
+    return Conversation(**data["conversation"], messages=messages)
+
+
+class RedisConversationCache:
+    """Conversation cache in redis, shared by all worker processes. Same interface as ConversationCache.
+
+    gunicorn runs several workers and consecutive turns of a conversation land on any of them, so a per-process
+    cache mostly misses. The url can point to a redis sidecar on a unix socket, e.g. unix:///tmp/redis.sock,
+    or to a redis server, e.g. redis://10.0.0.3:6379/0.
+
+    The event loop uses the *_async methods, which await redis.asyncio behind the "redis" circuit breaker.
+    When redis is down the breaker opens and the calls return at once as misses instead of each waiting
+    for the timeout. The blocking methods are for callers in executor threads and scripts.
+
+    Every entry has a version, the conversation's nbr_messages, which grows with every turn:
+    - Entries are written with a compare-and-set, so a slow worker can never overwrite a newer turn
+    - The version is also kept in a small marker that outlives the entry. A worker that misses the cache
+      and reads firestore uses it to tell if firestore is behind writes queued in another worker
+    Redis errors are logged and treated as misses, so the chat keeps working on firestore alone.
+    """
+
+    shared = True
+
+    # KEYS: entry, version marker. ARGV: version, entry, entry ttl, marker ttl
+    _put_script = """
+    local current = tonumber(redis.call('GET', KEYS[2]) or '-1')
+    if tonumber(ARGV[1]) < current then
+        return 0
+    end
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[4])
+    return 1
+    """
+
+    def __init__(
+        self,
+        url: str,
+        ttl: float = 1800,
+        version_ttl: float = 86400,
+        prefix: str = "emely:conversation",
+        timeout: float = 0.5,
+    ):
+        # Only needed with this backend
+        import redis
+        import redis.asyncio
+
+        options = dict(socket_timeout=timeout, socket_connect_timeout=timeout)
+        self.client = redis.Redis.from_url(url, **options)
+        self.async_client = redis.asyncio.Redis.from_url(url, **options)
+        self._errors = (redis.RedisError, OSError)
+        self._put = self.client.register_script(self._put_script)
+        self._put_async = self.async_client.register_script(self._put_script)
+        self.breaker = get_breaker("redis")
+        self.ttl = int(ttl)
+        self.version_ttl = int(max(version_ttl, ttl))
+        self.prefix = prefix
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.stale_puts = 0
+        self.errors = 0
+        self.skipped = 0
+
+    def _keys(self, conversation_id: str):
+        "Entry and version marker. The hash tag keeps both in the same slot on a redis cluster"
+        return (
+            f"{self.prefix}:{{{conversation_id}}}",
+            f"{self.prefix}:{{{conversation_id}}}:version",
+        )
+
+    def _on_error(self, operation: str, e: Exception):
+        self.errors += 1
+        logging.warning(f"Shared conversation cache {operation} failed: {e!r}")
+
+    async def _guarded(self, operation: str, func, *args, **kwargs):
+        "Awaits a redis call behind the breaker. Returns (True, result), or (False, None) if it failed or was skipped"
+        try:
+            with self.breaker.guard():
+                return True, await func(*args, **kwargs)
+        except CircuitOpenError:
+            self.skipped += 1
+        except self._errors as e:
+            self._on_error(operation, e)
+        return False, None
+
+    def _to_conversation(self, entry: Optional[bytes]) -> Optional[Conversation]:
+        conversation = deserialize_conversation(entry) if entry is not None else None
+        if conversation is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return conversation
+
+    def _put_args(self, conversation: Conversation):
+        keys = self._keys(conversation.conversation_id)
+        args = [
+            conversation.nbr_messages,
+            serialize_conversation(conversation),
+            self.ttl,
+            self.version_ttl,
+        ]
+        return keys, args
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        "Returns the cached conversation or None on a miss"
+        entry_key, _ = self._keys(conversation_id)
+        try:
+            entry = self.client.get(entry_key)
+        except self._errors as e:
+            self._on_error("get", e)
+            return None
+        return self._to_conversation(entry)
+
+    async def get_async(self, conversation_id: str) -> Optional[Conversation]:
+        entry_key, _ = self._keys(conversation_id)
+        ok, entry = await self._guarded("get", self.async_client.get, entry_key)
+        return self._to_conversation(entry) if ok else None
+
+    def put(self, conversation: Conversation):
+        "Adds or replaces a conversation unless the cache already has a newer version of it"
+        keys, args = self._put_args(conversation)
+        try:
+            if not self._put(keys=keys, args=args):
+                self.stale_puts += 1
+        except self._errors as e:
+            self._on_error("put", e)
+
+    async def put_async(self, conversation: Conversation):
+        keys, args = self._put_args(conversation)
+        ok, stored = await self._guarded("put", self._put_async, keys=keys, args=args)
+        if ok and not stored:
+            self.stale_puts += 1
+
+    def invalidate(self, conversation_id: str):
+        try:
+            self.client.delete(*self._keys(conversation_id))
+        except self._errors as e:
+            self._on_error("invalidate", e)
+
+    def mark_deleted(self, conversation_id: str):
+        """Removes the entry and sets the version marker to deleted_version, so the puts of workers that are
+        still in a turn of the conversation are rejected as stale"""
+        entry_key, version_key = self._keys(conversation_id)
+        try:
+            with self.client.pipeline() as pipeline:
+                pipeline.delete(entry_key)
+                pipeline.set(version_key, deleted_version, ex=self.version_ttl)
+                pipeline.execute()
+        except self._errors as e:
+            self._on_error("mark_deleted", e)
+
+    async def mark_deleted_async(self, conversation_id: str):
+        entry_key, version_key = self._keys(conversation_id)
+
+        async def mark_deleted():
+            async with self.async_client.pipeline() as pipeline:
+                pipeline.delete(entry_key)
+                pipeline.set(version_key, deleted_version, ex=self.version_ttl)
+                await pipeline.execute()
+
+        await self._guarded("mark_deleted", mark_deleted)
+
+    def version(self, conversation_id: str) -> Optional[int]:
+        "The latest version of the conversation that any worker has cached, or None if unknown"
+        _, version_key = self._keys(conversation_id)
+        try:
+            version = self.client.get(version_key)
+        except self._errors as e:
+            self._on_error("version", e)
+            return None
+        return int(version) if version is not None else None
+
+    async def version_async(self, conversation_id: str) -> Optional[int]:
+        _, version_key = self._keys(conversation_id)
+        ok, version = await self._guarded("version", self.async_client.get, version_key)
+        return int(version) if ok and version is not None else None
+
+    async def close(self):
+        await self.async_client.close()
+
+    def stats(self) -> Dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_puts": self.stale_puts,
+            "errors": self.errors,
+            "skipped": self.skipped,
+        }
+
+
+def create_conversation_cache():
+    """Creates the conversation cache that CONVERSATION_CACHE_BACKEND asks for:
+    local (default) for a cache per process, or redis for one shared by all workers at REDIS_URL"""
+    backend = os.environ.get("CONVERSATION_CACHE_BACKEND", "local")
+    ttl = float(os.environ.get("CONVERSATION_CACHE_TTL", 1800))
+    if backend == "local":
+        if int(os.environ.get("WEB_CONCURRENCY", 1)) > 1:
+            # Still correct, since FirestoreHandler checks every hit against firestore, but the workers
+            # rarely hit each other's conversations and every hit costs a read
+            logging.warning(
+                "CONVERSATION_CACHE_BACKEND=local with several workers. Each worker caches its own "
+                "conversations, use CONVERSATION_CACHE_BACKEND=redis to share them"
+            )
+        max_size = int(os.environ.get("CONVERSATION_CACHE_SIZE", 1000))
+        return ConversationCache(max_size=max_size, ttl=ttl)
+    elif backend == "redis":
+        url = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+        return RedisConversationCache(url, ttl=ttl)
+    raise ValueError(f"Unknown CONVERSATION_CACHE_BACKEND {backend}")
@@ -1,8 +1,21 @@
 from chat.data.types import Conversation, Message
+from chat.data.writebehind import (
+    WriteBehindQueue,
+    ConversationDelta,
+    max_batch_operations,
+)
+from chat.data.cache import create_conversation_cache, deleted_version
+from chat.data.deletion import DeletionJobs
+from chat.metrics import firestore_seconds, timed
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import NotFound
 from pathlib import Path
-from datetime import datetime
+from collections import defaultdict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import asyncio
+import logging
+import os
 
 from chat.utils import is_gcp_instance
 
@@ -18,8 +31,45 @@ class FirestoreHandler:
             "conversations-with-emely"
         )
 
+        # Updates are written in the background
+        self.write_queue = WriteBehindQueue(
+            self.commit,
+            linger=float(os.environ.get("WRITE_BEHIND_LINGER", 0.01)),
+            max_retries=int(os.environ.get("WRITE_BEHIND_MAX_RETRIES", 5)),
+            # The conversation has been deleted, see _write_batch
+            discard_errors=(NotFound,),
+        )
+
+        # Hot conversations are cached so an active chat needs no database reads.
+        # In this process, or in redis shared by all workers, see create_conversation_cache
+        self.cache = create_conversation_cache()
+
+        # Deletion of user data runs as background jobs
+        self.deletion_jobs = DeletionJobs(
+            self,
+            concurrency=int(os.environ.get("DELETE_CONCURRENCY", 4)),
+            page_size=int(os.environ.get("DELETE_PAGE_SIZE", 20)),
+        )
+
+        # New conversations store their messages one per document ("documents") or packed into
+        # documents of MESSAGE_BUCKET_SIZE messages ("buckets"). Existing conversations keep their layout
+        layout = os.environ.get("MESSAGE_STORAGE_LAYOUT", "documents")
+        if layout not in ["documents", "buckets"]:
+            raise ValueError(f"Unknown MESSAGE_STORAGE_LAYOUT {layout}")
+        if layout == "buckets":
+            self.message_bucket_size = int(os.environ.get("MESSAGE_BUCKET_SIZE", 32))
+        else:
+            self.message_bucket_size = 0
+
     def _authenticate_firebase(self):
         "Authenticates firebase"
+        # In-memory firestore for load testing, see chat.fakes
+        if os.environ.get("USE_FAKE_FIRESTORE") == "1":
+            from chat.fakes.firestore import FakeFirestoreClient
+
+            self.firestore_client = FakeFirestoreClient()
+            return
+
         # TODO: Change projectId and api-key when moving this to new gcp project
         if is_gcp_instance():
             if not firebase_admin._apps:
@@ -47,119 +97,354 @@ class FirestoreHandler:
         doc_ref = self.firestore_collection.document()
         return doc_ref.id
 
-    def get_conversation(self, conversation_id) -> Conversation:
-        "Retreives a conversation from firestore"
-        # TODO: Async calls?
+    def get_conversation(self, conversation_id, window=None) -> Conversation:
+        """Retreives a conversation from the cache or from firestore on a miss.
+        Only the latest `window` messages are loaded from firestore since the dialog flow only looks at
+        the end of the conversation. Defaults to CONVERSATION_WINDOW and window=0 loads all messages.
+        Blocks, so it's meant for scripts and executor threads. Turns use get_conversation_async"""
+        conversation = self.cache.get(conversation_id)
+        if conversation is not None:
+            return conversation
+
+        if window is None:
+            window = int(os.environ.get("CONVERSATION_WINDOW", 16))
+
+        conversation = self._read_conversation(conversation_id, window)
+        self.cache.put(conversation)
+
+        return conversation
+
+    async def _wait_until_fresh(self, conversation: Conversation, window: int):
+        """Re-reads the conversation while firestore is behind the latest version in the shared cache,
+        i.e. while another worker still has writes of it queued"""
+        conversation_id = conversation.conversation_id
+        loop = asyncio.get_running_loop()
+        for delay in [0.05, 0.1, 0.2, 0.4, 0.8]:
+            version = await self.cache.version_async(conversation_id)
+            if (
+                version is None
+                or version >= deleted_version
+                or conversation.nbr_messages >= version
+            ):
+                return conversation
+            await asyncio.sleep(delay)
+            conversation = await loop.run_in_executor(
+                None, self._read_conversation, conversation_id, window
+            )
+        logging.warning(
+            f"Firestore is still behind the cached version of {conversation_id}"
+        )
+        return conversation
+
+    @timed(firestore_seconds, operation="read")
+    def _read_conversation(self, conversation_id, window: int) -> Conversation:
+        "Reads the conversation and its latest `window` messages from firestore"
         conversation_ref = self.firestore_collection.document(conversation_id)
         firestore_conversation = conversation_ref.get().to_dict()
 
-        # Messages
-        # TODO: All messages are fetched. Is there a better way to do this?
-        message_collection = conversation_ref.collection("messages")
-        message_refs = message_collection.where("message_nbr", ">=", 0).stream()
-        firestore_messages = [doc.to_dict() for doc in message_refs]
+        firestore_messages = self._read_messages(
+            conversation_ref, firestore_conversation, window
+        )
         messages = [
             Message(**m, conversation_id=conversation_id) for m in firestore_messages
         ]
 
-        conversation = Conversation(**firestore_conversation, messages=messages,)
+        first_message_nbr = messages[0].message_nbr if messages else 0
+        conversation = Conversation(
+            **firestore_conversation,
+            messages=messages,
+            first_message_nbr=first_message_nbr,
+        )
+        return conversation
+
+    def _read_messages(self, conversation_ref, conversation_data, window: int):
+        """Reads the latest `window` messages of a conversation in message_nbr order, or all if window=0.
+        Works with both storage layouts"""
+        bucket_size = conversation_data.get("message_bucket_size", 0)
+        if bucket_size > 0:
+            return self._read_bucketed_messages(
+                conversation_ref, bucket_size, conversation_data["nbr_messages"], window
+            )
+
+        message_collection = conversation_ref.collection("messages")
+        if window > 0:
+            message_refs = (
+                message_collection.order_by(
+                    "message_nbr", direction=firestore.Query.DESCENDING
+                )
+                .limit(window)
+                .stream()
+            )
+            firestore_messages = [doc.to_dict() for doc in message_refs]
+            firestore_messages.reverse()
+        else:
+            message_refs = message_collection.where("message_nbr", ">=", 0).stream()
+            firestore_messages = [doc.to_dict() for doc in message_refs]
+        return firestore_messages
 
+    def _read_bucketed_messages(
+        self, conversation_ref, bucket_size: int, nbr_messages: int, window: int
+    ):
+        "Reads the buckets that hold the latest `window` messages in one query and unpacks them"
+        first_message_nbr = max(nbr_messages - window, 0) if window > 0 else 0
+        buckets = (
+            conversation_ref.collection("message_buckets")
+            .where("bucket", ">=", first_message_nbr // bucket_size)
+            .stream()
+        )
+        firestore_messages = [
+            message
+            for doc in buckets
+            for message in doc.get("messages").values()
+            if message["message_nbr"] >= first_message_nbr
+        ]
+        firestore_messages.sort(key=lambda m: m["message_nbr"])
+        return firestore_messages
+
+    async def get_conversation_async(self, conversation_id) -> Conversation:
+        """Retrieves a conversation without blocking the event loop.
+        On a cache miss we wait for queued updates of the conversation first so we never read stale data,
+        both the ones queued here and, with the shared cache, the ones queued in other workers"""
+        conversation = await self.cache.get_async(conversation_id)
+        if conversation is not None and await self._is_current(conversation):
+            return conversation
+
+        await self.write_queue.wait_for(conversation_id)
+        window = int(os.environ.get("CONVERSATION_WINDOW", 16))
+        loop = asyncio.get_running_loop()
+        conversation = await loop.run_in_executor(
+            None, self._read_conversation, conversation_id, window
+        )
+        conversation = await self._wait_until_fresh(conversation, window)
+        await self.cache.put_async(conversation)
         return conversation
 
-    def create(self, conversation):
-        "creates a new conversation in firestore"
-        conversation_ref = self.firestore_collection.document(
-            conversation.conversation_id
+    async def _is_current(self, conversation: Conversation) -> bool:
+        """A shared cache always has the latest turn of a conversation. A cache per process doesn't see the
+        turns handled by other workers, so its copy is compared with nbr_messages in firestore, one small read"""
+        if self.cache.shared:
+            return True
+        conversation_id = conversation.conversation_id
+        await self.write_queue.wait_for(conversation_id)
+        if self.write_queue.has_dead_letter(conversation_id):
+            # Firestore is behind this copy until the retry succeeds
+            return True
+        loop = asyncio.get_running_loop()
+        nbr_messages = await loop.run_in_executor(
+            None, self._read_nbr_messages, conversation_id
         )
-        conversation_ref.set(conversation.to_dict(only_updatable=False))
+        if nbr_messages == conversation.nbr_messages:
+            return True
+        logging.info(
+            f"Cached copy of {conversation_id} has {conversation.nbr_messages} messages, "
+            f"firestore has {nbr_messages}"
+        )
+        self.cache.reject(conversation_id)
+        return False
 
-        messages = conversation.get_last_two_messages()
-        message_collection = conversation_ref.collection("messages")
-        for message_nbr, message in messages.items():
-            message_ref = message_collection.document(str(message_nbr))
-            message_ref.set(message.to_dict())
+    @timed(firestore_seconds, operation="read_version")
+    def _read_nbr_messages(self, conversation_id) -> Optional[int]:
+        snapshot = self.firestore_collection.document(conversation_id).get(
+            field_paths=["nbr_messages"]
+        )
+        return snapshot.get("nbr_messages") if snapshot.exists else None
+
+    @timed(firestore_seconds, operation="create")
+    async def create(self, conversation):
+        "Creates a new conversation and its first messages in firestore in one atomic batch"
+        conversation.message_bucket_size = self.message_bucket_size
+        messages = conversation.pop_unsaved_messages()
+        delta = ConversationDelta(
+            conversation_id=conversation.conversation_id,
+            fields=conversation.to_dict(only_updatable=False),
+            messages={nbr: message.to_dict() for nbr, message in messages.items()},
+            created=True,
+            bucket_size=conversation.message_bucket_size,
+        )
+        conversation.mark_persisted()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._write_batch, [delta])
+        await self.cache.put_async(conversation)
         return
 
     def update(self, conversation: Conversation):
         " Updates conversation on firestore"
+        delta = self.get_update_delta(conversation)
+        if not delta.is_empty():
+            self.commit([delta])
+        self.cache.put(conversation)
+        return
+
+    async def submit_update(self, conversation: Conversation):
+        """Caches the conversation and queues an update of it. It's written to firestore in the background.
+        Waits for the cache, so the next turn finds the conversation on any worker"""
+        # The delta is taken first so the cached copy has nothing unsaved left
+        delta = self.get_update_delta(conversation)
+        await self.cache.put_async(conversation)
+        if not delta.is_empty():
+            self.write_queue.submit(delta)
+        return
 
-        conversation_ref = self.firestore_collection.document(
-            conversation.conversation_id
+    def get_update_delta(self, conversation: Conversation) -> ConversationDelta:
+        """Gets the fields and messages that have changed since the conversation was loaded or last persisted.
+        They are marked as persisted"""
+        messages = conversation.pop_unsaved_messages()
+        fields = conversation.pop_changed_fields()
+        if messages and "nbr_messages" not in fields:
+            # Every write of messages also updates the conversation, see _write_batch
+            fields["nbr_messages"] = conversation.nbr_messages
+        return ConversationDelta(
+            conversation_id=conversation.conversation_id,
+            fields=fields,
+            messages={nbr: message.to_dict() for nbr, message in messages.items()},
+            bucket_size=conversation.message_bucket_size,
         )
 
-        conversation_ref.update(conversation.to_dict(only_updatable=True))
+    @timed(firestore_seconds, operation="commit")
+    def commit(self, deltas: List[ConversationDelta]):
+        "Writes conversation deltas to firestore in one atomic batch"
+        self._write_batch(deltas)
 
-        messages = conversation.get_last_two_messages()
-        message_collection = conversation_ref.collection("messages")
-        for message_nbr, message in messages.items():
-            message_ref = message_collection.document(str(message_nbr))
-            message_ref.set(message.to_dict())
+    def _write_batch(self, deltas: List[ConversationDelta]):
+        batch = self.firestore_client.batch()
+        for delta in deltas:
+            conversation_ref = self.firestore_collection.document(
+                delta.conversation_id
+            )
+            if delta.created:
+                batch.set(conversation_ref, delta.fields)
+            elif delta.fields:
+                # update() requires the conversation to exist, so the whole batch fails with NotFound if it has
+                # been deleted, instead of a queued write bringing back some of its messages
+                batch.update(conversation_ref, delta.fields)
+
+            if delta.bucket_size > 0:
+                self._add_bucket_writes(
+                    batch, conversation_ref, delta.messages, delta.bucket_size
+                )
+            else:
+                message_collection = conversation_ref.collection("messages")
+                for message_nbr, message in delta.messages.items():
+                    batch.set(message_collection.document(str(message_nbr)), message)
+        batch.commit()
         return
 
-    def get_user_conversations(self, user_id: str):
-        conversations_data = self.firestore_collection.where(
-            "user_id", "==", user_id
-        ).get()
-        conversations = []
-        for post in conversations_data:
-            conv_data = post.to_dict()
-            message_collection = self.firestore_collection.document(
-                conv_data["conversation_id"]
-            ).collection("messages")
-            docs = message_collection.stream()
-            messages = {doc.id: doc.to_dict() for doc in docs}
-            conversations.append((conv_data, messages))
-        conversations = sorted(
-            conversations,
-            key=lambda d: datetime.strptime(d[0]["created_at"], "%Y-%m-%d %H:%M:%S"),
+    def _add_bucket_writes(
+        self, batch, conversation_ref, messages: Dict[int, Dict], bucket_size: int
+    ):
+        "Adds the messages to their buckets. One merge write per bucket, however many messages it gets"
+        buckets = defaultdict(dict)
+        for message_nbr, message in messages.items():
+            buckets[message_nbr // bucket_size][str(message_nbr)] = message
+        bucket_collection = conversation_ref.collection("message_buckets")
+        for bucket, bucket_messages in buckets.items():
+            batch.set(
+                bucket_collection.document(str(bucket)),
+                {"bucket": bucket, "messages": bucket_messages},
+                merge=True,
+            )
+
+    def migrate_to_buckets(self, conversation_id: str, bucket_size: int = None):
+        """Moves the messages of a conversation from one document per message into buckets.
+        The buckets and the layout flag are written in one batch, so readers see either layout in full.
+        Meant for conversations that aren't active, since queued updates would still use the old layout"""
+        if bucket_size is None:
+            bucket_size = self.message_bucket_size or 32
+        conversation_ref = self.firestore_collection.document(conversation_id)
+        conversation_data = conversation_ref.get().to_dict()
+        if conversation_data.get("message_bucket_size", 0) > 0:
+            return
+
+        message_docs = list(conversation_ref.collection("messages").stream())
+        messages = {doc.get("message_nbr"): doc.to_dict() for doc in message_docs}
+        batch = self.firestore_client.batch()
+        self._add_bucket_writes(batch, conversation_ref, messages, bucket_size)
+        batch.update(conversation_ref, {"message_bucket_size": bucket_size})
+        batch.commit()
+        self.cache.invalidate(conversation_id)
+
+        # The old documents aren't read anymore, so they can go in as many batches as needed
+        for i in range(0, len(message_docs), max_batch_operations):
+            batch = self.firestore_client.batch()
+            for doc in message_docs[i : i + max_batch_operations]:
+                batch.delete(doc.reference)
+            batch.commit()
+        logging.info(
+            f"Migrated {len(messages)} messages of {conversation_id} into buckets of {bucket_size}"
         )
-        return conversations
 
-    def get_user_conversations_formatted(self, user_id: str):
-        try:
-            conversations = self.get_user_conversations(user_id)
-            all_conv_string = "\nYour conversations:\n"
-            for conv_data, messages in conversations:
-                all_conv_string = all_conv_string + self.format_conversation(
-                    conv_data, messages
+    @timed(firestore_seconds, operation="user_conversations")
+    def read_user_conversation_page(self, user_id: str, page_size: int, cursor=None):
+        """Reads one page of a user's conversations in created_at order, starting after the cursor snapshot.
+        The query needs the composite index in firestore.indexes.json"""
+        query = (
+            self.firestore_collection.where("user_id", "==", user_id)
+            .order_by("created_at")
+            .limit(page_size)
+        )
+        if cursor is not None:
+            query = query.start_after(cursor)
+        return list(query.stream())
+
+    async def stream_user_conversations(
+        self, user_id: str, page_size: int = None, concurrency: int = None
+    ) -> AsyncIterator[Tuple[Dict, List[Dict]]]:
+        """Yields (conversation data, messages in message_nbr order) of a user's conversations in created_at order.
+        Conversations are read a page at a time and the messages of a page are read concurrently,
+        at most `concurrency` conversations at once. The next page is read while the current one is yielded"""
+        if page_size is None:
+            page_size = int(os.environ.get("EXPORT_PAGE_SIZE", 20))
+        if concurrency is None:
+            concurrency = int(os.environ.get("EXPORT_CONCURRENCY", 8))
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def read_messages(conv_data):
+            conversation_ref = self.firestore_collection.document(
+                conv_data["conversation_id"]
+            )
+            async with semaphore:
+                return await loop.run_in_executor(
+                    None, self._read_messages, conversation_ref, conv_data, 0
                 )
-        except:
-            return False
-        return all_conv_string
-
-    def format_conversation(self, conv_data, messages):
-        separator = "_______________________________________________________________\n"
-        conv_string = separator
-        info_included = ["persona", "job", "created_at"]
-        for param in info_included:
-            conv_string = conv_string + param + ":\t" + conv_data[param] + "\n"
-        conv_string = conv_string + separator
-        for _, v in messages.items():
-            conv_string = conv_string + v["who"] + ":\t" + v["text"] + "\n"
-        conv_string = conv_string + "\n\n"
-        return conv_string
-
-    def delete_user_data(self, user_id: str):
-        try:
-            conversations_data = self.firestore_collection.where(
-                "user_id", "==", user_id
-            ).get()
-            # Delete the "messages"-collection in each conversation document
-            for post in conversations_data:
-                conv_data = post.to_dict()
-                message_collection = self.firestore_collection.document(
-                    conv_data["conversation_id"]
-                ).collection("messages")
-                docs = message_collection.stream()
-                for doc in docs:
-                    doc.reference.delete()
-            # Delete all documents
-            conversations_docs = self.firestore_collection.where(
-                "user_id", "==", user_id
-            ).stream()
-            for doc in conversations_docs:
-                doc.reference.delete()
-            return True
-        except:
-            return False
 
+        def read_page(cursor):
+            return loop.run_in_executor(
+                None, self.read_user_conversation_page, user_id, page_size, cursor
+            )
+
+        next_page = read_page(None)
+        while next_page is not None:
+            page = await next_page
+            next_page = read_page(page[-1]) if len(page) == page_size else None
+            try:
+                conversations = [snapshot.to_dict() for snapshot in page]
+                messages = await asyncio.gather(*map(read_messages, conversations))
+                for conv_data, conv_messages in zip(conversations, messages):
+                    yield conv_data, conv_messages
+            except BaseException:
+                # The export failed or was stopped, e.g. because the client went away
+                if next_page is not None:
+                    next_page.cancel()
+                raise
+
+    def get_user_conversations(self, user_id: str) -> List[Tuple[Dict, Dict]]:
+        "Returns all conversations of a user in created_at order with their messages by message_nbr"
+        conversations = []
+        page_size = int(os.environ.get("EXPORT_PAGE_SIZE", 20))
+        page = self.read_user_conversation_page(user_id, page_size)
+        while page:
+            for snapshot in page:
+                conv_data = snapshot.to_dict()
+                conversation_ref = self.firestore_collection.document(
+                    conv_data["conversation_id"]
+                )
+                messages = {
+                    str(m["message_nbr"]): m
+                    for m in self._read_messages(conversation_ref, conv_data, window=0)
+                }
+                conversations.append((conv_data, messages))
+            if len(page) < page_size:
+                break
+            page = self.read_user_conversation_page(user_id, page_size, page[-1])
+        return conversations
@@ -0,0 +1,256 @@
+import asyncio
+import datetime
+import logging
+import time
+import uuid
+from typing import Dict, Optional
+from chat.data.writebehind import max_batch_operations
+from chat.metrics import firestore_seconds
+
+""" Deletion of all data of a user as a background job.
+
+A job deletes the user's conversations a page at a time. The messages of a conversation are deleted in batched
+writes of up to 500 documents, several conversations at once, and the conversation document goes last. Whatever
+is left of the user's data can always be found with the same query. That makes a job idempotent, and a job
+that stopped halfway, e.g. because the instance was shut down, can just be run again.
+
+Job state is kept in firestore so the status endpoint works on every instance. Jobs that are pending or running
+without having made progress within the lease are resumed on startup.
+"""
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class DeletionJobs:
+    """Starts, runs and resumes deletion jobs.
+
+    Example usage:
+        jobs = DeletionJobs(database_handler)
+        job = await jobs.start(user_id)     # returns at once
+        await jobs.status(job["job_id"])    # from any instance
+        await jobs.resume()                 # on startup
+        await jobs.stop()                   # on shutdown
+    """
+
+    def __init__(
+        self,
+        database_handler,
+        concurrency: int = 4,
+        page_size: int = 20,
+        lease: float = 60,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        self.database_handler = database_handler
+        self.collection = database_handler.firestore_client.collection(
+            "user-deletion-jobs"
+        )
+        # Conversations deleted at the same time, i.e. batches in flight
+        self.concurrency = concurrency
+        self.page_size = page_size
+        # A job that hasn't saved progress for this many seconds is considered abandoned
+        self.lease = lease
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._tasks = {}
+
+        # Metrics
+        self.nbr_started = 0
+        self.nbr_done = 0
+        self.nbr_failed = 0
+        self.nbr_deleted_documents = 0
+
+    def stats(self) -> Dict:
+        return {
+            "running": len(self._tasks),
+            "started": self.nbr_started,
+            "done": self.nbr_done,
+            "failed": self.nbr_failed,
+            "deleted_documents": self.nbr_deleted_documents,
+        }
+
+    async def _run_blocking(self, func, *args):
+        """Firestore calls block, so they run in the executor.
+        Everything a job does is idempotent, so failed calls are retried with backoff"""
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await loop.run_in_executor(None, func, *args)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"Deletion job call failed on attempt {attempt + 1}: {e}")
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def start(self, user_id: str) -> Dict:
+        """Starts a job that deletes the user's data and returns it at once.
+        If the user already has an unfinished job, that job is returned (and resumed if it was abandoned)"""
+        job = await self._run_blocking(self._find_unfinished_job, user_id)
+        if job is None:
+            now = time.time()
+            job = {
+                "job_id": uuid.uuid4().hex,
+                "user_id": user_id,
+                "status": PENDING,
+                "created_at": str(datetime.datetime.now()),
+                "updated_at": now,
+                "deleted_conversations": 0,
+                "deleted_documents": 0,
+                "error": None,
+            }
+            await self._save(job)
+            self._run_in_background(job, claim=True)
+        else:
+            self._run_in_background(job)
+        return job
+
+    async def status(self, job_id: str) -> Optional[Dict]:
+        "Returns the job or None if there's no such job"
+        snapshot = await self._run_blocking(self.collection.document(job_id).get)
+        return snapshot.to_dict() if snapshot.exists else None
+
+    async def wait(self, job_id: str):
+        "Waits for a job that runs on this instance"
+        task = self._tasks.get(job_id)
+        if task is not None:
+            await asyncio.shield(task)
+
+    async def resume(self):
+        "Resumes the jobs that were abandoned, e.g. by an instance that was shut down"
+        query = self.collection.where("status", "in", [PENDING, RUNNING])
+        snapshots = await self._run_blocking(query.get)
+        for snapshot in snapshots:
+            self._run_in_background(snapshot.to_dict())
+
+    async def stop(self):
+        "Stops the jobs of this instance. They are resumed by the next instance that starts"
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _find_unfinished_job(self, user_id: str) -> Optional[Dict]:
+        for snapshot in self.collection.where("user_id", "==", user_id).stream():
+            job = snapshot.to_dict()
+            if job["status"] in [PENDING, RUNNING, FAILED]:
+                return job
+        return None
+
+    def _run_in_background(self, job: Dict, claim: bool = False):
+        """Runs the job unless it's already running here, or on another instance that still holds the lease.
+        claim is set for jobs that were just created here"""
+        job_id = job["job_id"]
+        if job_id in self._tasks:
+            return
+        running_elsewhere = (
+            job["status"] in [PENDING, RUNNING]
+            and time.time() - job["updated_at"] < self.lease
+        )
+        if running_elsewhere and not claim:
+            return
+        task = asyncio.ensure_future(self._run(job))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _save(self, job: Dict):
+        job["updated_at"] = time.time()
+        reference = self.collection.document(job["job_id"])
+        await self._run_blocking(reference.set, dict(job))
+
+    async def _run(self, job: Dict):
+        self.nbr_started += 1
+        logging.info(f"Started deletion job {job['job_id']}")
+        try:
+            job["status"] = RUNNING
+            job["error"] = None
+            await self._save(job)
+            while True:
+                page = await self._run_blocking(
+                    self.database_handler.read_user_conversation_page,
+                    job["user_id"],
+                    self.page_size,
+                )
+                if not page:
+                    break
+                await self._delete_page(job, page)
+                # Saving the progress also renews the lease
+                await self._save(job)
+        except asyncio.CancelledError:
+            logging.info(f"Stopped deletion job {job['job_id']}. It will be resumed")
+            raise
+        except Exception as e:
+            logging.exception(f"Deletion job {job['job_id']} failed")
+            self.nbr_failed += 1
+            job["status"] = FAILED
+            job["error"] = str(e)
+            try:
+                await self._save(job)
+            except Exception:
+                # Still marked as running, so it's resumed when the lease has run out
+                logging.exception(f"Failed to save the state of deletion job {job['job_id']}")
+            return
+
+        # The job is kept as a receipt, but not who it was for
+        self.nbr_done += 1
+        job["status"] = DONE
+        job["user_id"] = None
+        await self._save(job)
+        logging.info(
+            f"Deletion job {job['job_id']} deleted {job['deleted_conversations']} conversations "
+            f"and {job['deleted_documents']} documents"
+        )
+
+    async def _delete_page(self, job: Dict, page):
+        "Deletes a page of conversations, at most `concurrency` at once"
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def delete(snapshot):
+            async with semaphore:
+                await self._delete_conversation(job, snapshot)
+
+        await asyncio.gather(*map(delete, page))
+
+    async def _delete_conversation(self, job: Dict, snapshot):
+        "Deletes the messages of a conversation in batches and then the conversation itself"
+        conversation_id = snapshot.id
+        # Updates queued here are written first. Other workers' caches reject the conversation from now on
+        await self.database_handler.write_queue.wait_for(conversation_id)
+        await self.database_handler.cache.mark_deleted_async(conversation_id)
+
+        await self._delete_messages(job, snapshot.reference)
+        await self._delete_batch([snapshot.reference])
+        job["deleted_conversations"] += 1
+        job["deleted_documents"] += 1
+        # Updates from other workers fail once the conversation is gone, but one may have added messages
+        # while the old ones were being deleted
+        await self._delete_messages(job, snapshot.reference)
+
+    async def _delete_messages(self, job: Dict, conversation_reference):
+        for name in ["messages", "message_buckets"]:
+            collection = conversation_reference.collection(name)
+            query = collection.limit(max_batch_operations)
+            while True:
+                docs = await self._run_blocking(query.get)
+                if not docs:
+                    break
+                await self._delete_batch([doc.reference for doc in docs])
+                job["deleted_documents"] += len(docs)
+
+    async def _delete_batch(self, references):
+        "Deletes up to 500 documents in one batched write"
+
+        def commit():
+            batch = self.database_handler.firestore_client.batch()
+            for reference in references:
+                batch.delete(reference)
+            with firestore_seconds.time(operation="delete") as labels:
+                labels["outcome"] = "error"
+                batch.commit()
+                labels["outcome"] = "ok"
+
+        await self._run_blocking(commit)
+        self.nbr_deleted_documents += len(references)
@@ -0,0 +1,87 @@
+import json
+import zlib
+from typing import AsyncIterator, Dict, List, Tuple
+
+""" Formats of the user data export on /user_conversations.
+
+Conversations come in as an async iterator of (conversation data, messages in message_nbr order), a page at a
+time from FirestoreHandler.stream_user_conversations, and every conversation is formatted on its own, so
+the export never holds more than a page in memory.
+"""
+
+separator = "_______________________________________________________________\n"
+info_included = ["persona", "job", "created_at"]
+message_fields = ["message_nbr", "created_at", "who", "text"]
+
+ExportedConversation = Tuple[Dict, List[Dict]]
+
+
+def format_conversation(conv_data: Dict, messages: List[Dict]) -> str:
+    "Formats a conversation as readable text"
+    lines = [separator]
+    for param in info_included:
+        lines.append(f"{param}:\t{conv_data[param]}\n")
+    lines.append(separator)
+    for message in messages:
+        lines.append(f"{message['who']}:\t{message['text']}\n")
+    lines.append("\n\n")
+    return "".join(lines)
+
+
+def conversation_record(conv_data: Dict, messages: List[Dict]) -> Dict:
+    "The part of a conversation that is exported as json"
+    record = {param: conv_data.get(param) for param in info_included}
+    record["conversation_id"] = conv_data["conversation_id"]
+    record["messages"] = [
+        {field: message.get(field) for field in message_fields} for message in messages
+    ]
+    return record
+
+
+async def text_chunks(conversations: AsyncIterator[ExportedConversation]):
+    "Yields the export as text, one conversation at a time"
+    yield "\nYour conversations:\n"
+    async for conv_data, messages in conversations:
+        yield format_conversation(conv_data, messages)
+
+
+async def ndjson_chunks(conversations: AsyncIterator[ExportedConversation]):
+    "Yields the export as newline delimited json, one conversation per line"
+    async for conv_data, messages in conversations:
+        record = conversation_record(conv_data, messages)
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+async def gzip_chunks(chunks: AsyncIterator[str]):
+    "Compresses a stream of text chunks into a gzip stream"
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        # The compressor holds on to small chunks until it has enough data
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def started(items: AsyncIterator) -> AsyncIterator:
+    """Reads the first item so that e.g. failing to reach the database raises here, before a streamed
+    response has been started. Returns an iterator over all items"""
+    try:
+        first = await items.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def chain():
+        if first is None:
+            return
+        yield first
+        async for item in items:
+            yield item
+
+    return chain()
+
+
+export_formats = {
+    "text": (text_chunks, "text/plain; charset=utf-8"),
+    "ndjson": (ndjson_chunks, "application/x-ndjson"),
+}
@@ -1,8 +1,33 @@
+from collections import deque
+from itertools import islice
+import copy
 from typing import List, Optional, Dict
 import datetime
-from pydantic import BaseModel, Field
+import numpy as np
+from pydantic import BaseModel, Field, PrivateAttr
 import os
 import chat
+from chat.dialog.fingerprints import fingerprint_text, n_features
+
+# Fingerprints are only kept for Emely's latest messages since the repetition filter only looks that far back
+max_fingerprinted_messages = 16
+
+# Visible context lines and Emely messages kept in order for the flow handlers. The models get at most 8 lines
+max_context_messages = 32
+
+# Conversation fields that change during a conversation. The rest are only written when it's created
+updatable_fields = (
+    "current_dialog_block",
+    "current_dialog_block_length",
+    "episode_done",
+    "nbr_messages",
+    "question_list",
+    "progress",
+)
+
+
+class QuestionNotFoundError(LookupError):
+    "Raised when none of the loaded messages is one of Emely's interview questions"
 
 
 class UserMessage(BaseModel):
@@ -125,6 +150,36 @@ class Conversation(BaseModel):
     # Default values
     conversation_id: str = None  # Is set first when we've pushed to firestore so it has to be None at initialisation
     progress: float = 0
+    first_message_nbr: int = 0  # message_nbr of the first loaded message. > 0 if only the tail is loaded
+    message_bucket_size: int = 0  # Messages are packed this many per document. 0 means one document per message
+
+    # Sentence fingerprints of Emely's messages by message_nbr. Used by the repetition filter
+    _fingerprints: Dict[int, np.ndarray] = PrivateAttr(default_factory=dict)
+    # English text of the latest messages that Emely should see, in message_nbr order
+    _context: deque = PrivateAttr(
+        default_factory=lambda: deque(maxlen=max_context_messages)
+    )
+    # Emely's latest messages in message_nbr order
+    _emely_messages: deque = PrivateAttr(
+        default_factory=lambda: deque(maxlen=max_context_messages)
+    )
+    # Messages added since the conversation was last persisted, by message_nbr
+    _unsaved_messages: Dict[int, Message] = PrivateAttr(default_factory=dict)
+    # Values of the updatable fields as they were last persisted
+    _saved_fields: Dict = PrivateAttr(default_factory=dict)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        # Loaded messages are already persisted, so they only go into the ordered views
+        self.messages.sort(key=lambda m: m.message_nbr)
+        for message in self.messages:
+            self._index_message(message)
+        self._mark_fields_saved(updatable_fields)
+
+    @property
+    def is_partial(self) -> bool:
+        "True if only the latest messages of the conversation are loaded"
+        return self.first_message_nbr > 0
 
     def add_message(self, message: Message) -> float:
         """Adds a message to the conversation and computes progress.
@@ -147,9 +202,44 @@ class Conversation(BaseModel):
 
         self.nbr_messages += 1
         self.messages.append(message)
+        self._index_message(message)
+        self._unsaved_messages[message.message_nbr] = message
         self.progress = progress
+        if message.who == "bot":
+            self._add_fingerprints(message)
         return progress
 
+    def _index_message(self, message: Message):
+        "Appends a message to the ordered views that the flow handlers read"
+        if message.show_emely:
+            self._context.append(message.text_en)
+        if message.who == "bot":
+            self._emely_messages.append(message)
+
+    def _add_fingerprints(self, message: Message) -> np.ndarray:
+        fingerprints = fingerprint_text(message.text_en)
+        self._fingerprints[message.message_nbr] = fingerprints
+        while len(self._fingerprints) > max_fingerprinted_messages:
+            del self._fingerprints[min(self._fingerprints)]
+        return fingerprints
+
+    def get_emely_fingerprints(self, N) -> np.ndarray:
+        """Returns the sentence fingerprints of Emely's last N messages stacked in one matrix.
+        Fingerprints are computed once per message and then cached on the conversation"""
+        if N <= max_context_messages:
+            emely_messages = list(self._emely_messages)[-N:]
+        else:
+            emely_messages = [m for m in self.messages if m.who == "bot"][-N:]
+        fingerprints = [
+            self._fingerprints.get(m.message_nbr)
+            if m.message_nbr in self._fingerprints
+            else self._add_fingerprints(m)
+            for m in emely_messages
+        ]
+        if len(fingerprints) == 0:
+            return np.zeros((0, n_features), dtype=np.float32)
+        return np.vstack(fingerprints)
+
     def add_user_message(
         self,
         user_message: UserMessage,
@@ -180,54 +270,61 @@ class Conversation(BaseModel):
         """Used before pushing conversation to database.
         Removes the message list as it's saved in subcollection"""
         if only_updatable:
-            return self.dict(
-                include={
-                    "current_dialog_block",
-                    "current_dialog_block_length",
-                    "episode_done",
-                    "nbr_messages",
-                    "question_list",
-                    "progress",
-                }
-            )
+            return self.dict(include=set(updatable_fields))
         else:
             return self.dict(
-                exclude={"messages"}
+                exclude={"messages", "first_message_nbr"}
             )  # Messags will be saved in sub collection
 
     def get_emely_messages(self, N=-1) -> List[str]:
         "Returns a list of all Messages uttered by Emely in english"
-        emely_messages = [m.text_en for m in self.messages if m.who == "bot"]
-        if N == -1 or N >= len(emely_messages):
-            return emely_messages
+        if 0 < N <= max_context_messages:
+            emely_messages = list(self._emely_messages)
         else:
-            return emely_messages[-N:]
-
-    def get_last_two_messages(self) -> Dict[int, Message]:
-        "Used before updating database since only two messages are new and need to be synced"
-
-        if self.nbr_messages == 1:
-            return {0: self.messages[0]}
+            emely_messages = [m for m in self.messages if m.who == "bot"]
+        if N == -1 or N >= len(emely_messages):
+            return [m.text_en for m in emely_messages]
         else:
-            sorted_messages = sorted(
-                self.messages, key=lambda x: x.message_nbr, reverse=True
-            )
-            last_two_message = sorted_messages[:2]
-            return {m.message_nbr: m for m in last_two_message}
+            return [m.text_en for m in emely_messages[-N:]]
+
+    def pop_unsaved_messages(self) -> Dict[int, Message]:
+        "Returns the messages added since the last call and marks them as persisted"
+        messages = self._unsaved_messages
+        self._unsaved_messages = {}
+        return messages
+
+    def pop_changed_fields(self) -> Dict:
+        """Returns the updatable fields that changed since the last call or since the conversation was loaded,
+        and marks them as persisted. Compared by value since e.g. question_list is changed in place"""
+        changed = [
+            field
+            for field in updatable_fields
+            if getattr(self, field) != self._saved_fields[field]
+        ]
+        if not changed:
+            return {}
+        self._mark_fields_saved(changed)
+        return self.dict(include=set(changed))
+
+    def mark_persisted(self):
+        "Called when the whole conversation has been written, e.g. when it's created"
+        self._unsaved_messages = {}
+        self._mark_fields_saved(updatable_fields)
+
+    def _mark_fields_saved(self, fields):
+        for field in fields:
+            self._saved_fields[field] = copy.deepcopy(getattr(self, field))
 
     def get_last_x_message_strings(self, x):
         "Returns blenderbot formatted string of last x messages"
-        sorted_messages = sorted(
-            self.messages, key=lambda x: x.message_nbr, reverse=False
-        )
-        filtered_messages = list(
-            filter(lambda message: message.show_emely, sorted_messages)
-        )
+        if 0 < x <= max_context_messages:
+            start = max(len(self._context) - x, 0)
+            return "\n".join(islice(self._context, start, None))
 
-        # We will take all
-        if x >= len(sorted_messages):
+        # Longer than the buffer. Messages are kept in message_nbr order
+        filtered_messages = [m for m in self.messages if m.show_emely]
+        if x >= len(self.messages):
             messages = filtered_messages
-
         else:
             messages = filtered_messages[-x:]
 
@@ -235,7 +332,8 @@ class Conversation(BaseModel):
         return "\n".join(strings)
 
     def get_nbr_messages(self) -> int:
-        return len(self.messages)
+        "Total number of messages, including the ones that aren't loaded in a partial conversation"
+        return self.nbr_messages
 
     def repeat_last_message(self) -> str:
         "Gets last message. Used when user says badword"
@@ -247,13 +345,16 @@ class Conversation(BaseModel):
         return latest_emely_message.text
 
     def get_last_question(self) -> str:
-        "Gets last question"
-        for i in range(1, len(self.messages)):
-            recent_message = self.messages[-i]
+        """Gets last question. In a partial conversation it has to be among the loaded messages.
+        Raises QuestionNotFoundError if it isn't"""
+        for recent_message in reversed(self.messages):
             if recent_message.who == "bot" and recent_message.is_hardcoded:
-                last_question = recent_message
-                return last_question.text
-        assert False, "No last question found"
+                return recent_message.text
+        if self.is_partial:
+            raise QuestionNotFoundError(
+                f"No question among the latest {len(self.messages)} messages of {self.conversation_id}"
+            )
+        raise QuestionNotFoundError(f"No question asked in {self.conversation_id}")
 
     def last_bot_message_was_hardcoded(self) -> str:
         "Returns true if Emelys last message was hardcoded"
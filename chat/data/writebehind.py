@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Firestore allows at most 500 writes in one batched commit
+max_batch_operations = 500
+
+
+class ConversationDelta(NamedTuple):
+    """The changes of one conversation turn that should be persisted.
+    Only changed fields are included. If created is True, fields is the whole conversation document"""
+    conversation_id: str
+    fields: Dict
+    messages: Dict[int, Dict]
+    created: bool = False
+    # Messages are packed in documents of this many messages, or one document per message if 0
+    bucket_size: int = 0
+
+    def nbr_operations(self) -> int:
+        if self.bucket_size > 0:
+            nbr_message_writes = len({nbr // self.bucket_size for nbr in self.messages})
+        else:
+            nbr_message_writes = len(self.messages)
+        return int(bool(self.fields)) + nbr_message_writes
+
+    def is_empty(self) -> bool:
+        return self.nbr_operations() == 0
+
+    def merged_onto(self, older: "ConversationDelta") -> "ConversationDelta":
+        "Combines an older, unwritten delta of the same conversation with this one. Newer values win"
+        return self._replace(
+            fields={**older.fields, **self.fields},
+            messages={**older.messages, **self.messages},
+            created=older.created or self.created,
+        )
+
+
+class WriteBehindQueue:
+    """Accepts conversation deltas, returns at once and writes them to firestore in background batches.
+
+    - Deltas are committed in the order they were submitted, so writes to a conversation are never reordered
+    - A failed batch is retried with exponential backoff before its deltas are retried one by one
+    - Deltas that still fail are kept as dead letters. They are written together with the next delta of their
+      conversation, or on their own every dead_letter_interval seconds, so a firestore outage loses nothing
+      unless more than max_dead_letters conversations are waiting
+    - Deltas that fail with one of discard_errors, e.g. because the conversation has been deleted, are discarded
+    - wait_for(conversation_id) lets readers wait until a conversation has no pending writes, and tells whether
+      they were all written
+    - drain() writes everything that is queued and should be awaited on shutdown
+    """
+
+    def __init__(
+        self,
+        commit: Callable[[List[ConversationDelta]], None],
+        linger: float = 0.01,
+        max_retries: int = 5,
+        backoff: float = 0.1,
+        max_backoff: float = 5,
+        dead_letter_interval: float = 30,
+        max_dead_letters: int = 10000,
+        discard_errors: Tuple[type, ...] = (),
+    ):
+        # commit is a blocking function that writes a list of deltas in one batch
+        self.commit = commit
+        self.linger = linger
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.dead_letter_interval = dead_letter_interval
+        self.max_dead_letters = max_dead_letters
+        # Errors that retrying can't fix
+        self.discard_errors = discard_errors
+
+        self._deltas = deque()
+        # Conversation id -> the unwritten changes of the conversation, oldest first
+        self._dead_letters = OrderedDict()
+        self._next_dead_letter_retry = 0.0
+        # Conversations whose last failed write was discarded or lost, until one of their writes succeeds
+        self._unwritten = OrderedDict()
+        self._pending = Counter()
+        self._wakeup = None
+        self._flushed = None
+        self._worker = None
+
+        # Metrics
+        self.nbr_flushes = 0
+        self.nbr_written = 0
+        self.nbr_dead_lettered = 0
+        self.nbr_failed = 0
+        self.nbr_discarded = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    @property
+    def depth(self) -> int:
+        "Number of deltas that are queued or being written"
+        return sum(self._pending.values())
+
+    def stats(self) -> Dict:
+        "Returns queue depth and flush metrics"
+        return {
+            "depth": self.depth,
+            "flushes": self.nbr_flushes,
+            "written": self.nbr_written,
+            "dead_lettered": self.nbr_dead_lettered,
+            "dead_letters": len(self._dead_letters),
+            "failed": self.nbr_failed,
+            "discarded": self.nbr_discarded,
+            "last_flush_latency": self.last_flush_latency,
+            "mean_flush_latency": self.total_flush_latency / max(self.nbr_flushes, 1),
+        }
+
+    def submit(self, delta: ConversationDelta):
+        "Queues a delta and returns at once"
+        self._ensure_worker()
+        self._deltas.append(delta)
+        self._pending[delta.conversation_id] += 1
+        self._wakeup.set()
+
+    async def wait_for(self, conversation_id: str) -> bool:
+        """Waits until all submitted deltas of a conversation are done. Returns False if some of them weren't
+        written, because they are dead letters or were discarded"""
+        if self._flushed is not None:
+            async with self._flushed:
+                await self._flushed.wait_for(lambda: conversation_id not in self._pending)
+        return not (
+            conversation_id in self._dead_letters or conversation_id in self._unwritten
+        )
+
+    def has_dead_letter(self, conversation_id: str) -> bool:
+        "True if some changes of the conversation failed to be written and are waiting for a retry"
+        return conversation_id in self._dead_letters
+
+    async def drain(self):
+        "Writes everything that is queued and stops the background worker"
+        if self._worker is None:
+            return
+        # A last attempt at the dead letters
+        self._requeue_dead_letters()
+        self._wakeup.set()
+        async with self._flushed:
+            await self._flushed.wait_for(lambda: not self._pending)
+        self._worker.cancel()
+        self._worker = None
+        for delta in self._dead_letters.values():
+            logging.error(f"Lost write of conversation {delta.conversation_id}: {delta}")
+        self.nbr_failed += len(self._dead_letters)
+        self._dead_letters.clear()
+        logging.info(f"Write-behind queue drained: {self.stats()}")
+
+    def _ensure_worker(self):
+        "Starts the background worker. Done lazily since it needs the running event loop"
+        if self._worker is None or self._worker.done():
+            if self._wakeup is None:
+                self._wakeup = asyncio.Event()
+                self._flushed = asyncio.Condition()
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            if not self._deltas:
+                self._wakeup.clear()
+                try:
+                    timeout = self.dead_letter_interval if self._dead_letters else None
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            if time.monotonic() >= self._next_dead_letter_retry:
+                self._requeue_dead_letters()
+            if not self._deltas:
+                continue
+
+            # Wait a little so deltas from concurrent conversations end up in the same batch
+            if self.linger > 0:
+                await asyncio.sleep(self.linger)
+
+            batch = self._take_batch()
+            await self._flush(batch)
+
+            async with self._flushed:
+                for delta in batch:
+                    self._pending[delta.conversation_id] -= 1
+                    if self._pending[delta.conversation_id] <= 0:
+                        del self._pending[delta.conversation_id]
+                self._flushed.notify_all()
+
+    def _take_batch(self) -> List[ConversationDelta]:
+        "Pops deltas from the queue until the batch is as big as firestore allows"
+        batch = [self._with_dead_letter(self._deltas.popleft())]
+        nbr_operations = batch[0].nbr_operations()
+        while self._deltas:
+            next_delta = self._with_dead_letter(self._deltas[0])
+            next_operations = next_delta.nbr_operations()
+            if nbr_operations + next_operations > max_batch_operations:
+                # The dead letter stays in the merged delta at the head of the queue
+                self._deltas[0] = next_delta
+                break
+            self._deltas.popleft()
+            batch.append(next_delta)
+            nbr_operations += next_operations
+        return batch
+
+    def _with_dead_letter(self, delta: ConversationDelta) -> ConversationDelta:
+        "Adds the unwritten changes of the conversation to its next delta"
+        dead_letter = self._dead_letters.pop(delta.conversation_id, None)
+        if dead_letter is None:
+            return delta
+        return delta.merged_onto(dead_letter)
+
+    def _requeue_dead_letters(self):
+        "Queues the dead letters of conversations that have no other writes queued"
+        self._next_dead_letter_retry = time.monotonic() + self.dead_letter_interval
+        for conversation_id in list(self._dead_letters):
+            if conversation_id not in self._pending:
+                self._deltas.append(self._dead_letters.pop(conversation_id))
+                self._pending[conversation_id] += 1
+
+    async def _flush(self, batch: List[ConversationDelta]):
+        "Commits a batch with retries"
+        error = await self._commit_with_retries(batch)
+        if error is None:
+            return
+        if len(batch) == 1:
+            self._failed(batch[0], error)
+            return
+
+        # One bad delta shouldn't take the rest of the batch down with it
+        for delta in batch:
+            # An earlier delta of the same conversation may just have failed
+            delta = self._with_dead_letter(delta)
+            error = await self._commit_with_retries([delta], max_retries=0)
+            if error is not None:
+                self._failed(delta, error)
+
+    async def _commit_with_retries(self, batch, max_retries=None) -> Optional[Exception]:
+        "Returns None if the batch was committed, otherwise the last error"
+        loop = asyncio.get_running_loop()
+        if max_retries is None:
+            max_retries = self.max_retries
+
+        for attempt in range(max_retries + 1):
+            tic = time.perf_counter()
+            try:
+                await loop.run_in_executor(None, self.commit, batch)
+            except Exception as e:
+                logging.warning(
+                    f"Write-behind commit of {len(batch)} deltas failed on attempt {attempt + 1}: {e}"
+                )
+                error = e
+                if isinstance(e, self.discard_errors):
+                    break
+                if attempt < max_retries:
+                    await asyncio.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+                continue
+
+            for delta in batch:
+                self._unwritten.pop(delta.conversation_id, None)
+            latency = time.perf_counter() - tic
+            self.nbr_flushes += 1
+            self.nbr_written += len(batch)
+            self.last_flush_latency = latency
+            self.total_flush_latency += latency
+            return None
+        return error
+
+    def _failed(self, delta: ConversationDelta, error: Exception):
+        if isinstance(error, self.discard_errors):
+            self.nbr_discarded += 1
+            logging.warning(
+                f"Discarded write of conversation {delta.conversation_id}: {error}"
+            )
+            self._mark_unwritten(delta.conversation_id)
+        else:
+            self._dead_letter(delta)
+
+    def _dead_letter(self, delta: ConversationDelta):
+        "Keeps a delta that failed after retries until the next attempt"
+        self.nbr_dead_lettered += 1
+        logging.error(
+            f"Write of conversation {delta.conversation_id} failed after retries. It will be retried later"
+        )
+        self._dead_letters[delta.conversation_id] = self._with_dead_letter(delta)
+        while len(self._dead_letters) > self.max_dead_letters:
+            _, lost = self._dead_letters.popitem(last=False)
+            self.nbr_failed += 1
+            logging.error(f"Lost write of conversation {lost.conversation_id}: {lost}")
+            self._mark_unwritten(lost.conversation_id)
+
+    def _mark_unwritten(self, conversation_id: str):
+        self._unwritten[conversation_id] = None
+        self._unwritten.move_to_end(conversation_id)
+        while len(self._unwritten) > self.max_dead_letters:
+            self._unwritten.popitem(last=False)
@@ -0,0 +1,225 @@
+import asyncio
+import contextlib
+import logging
+import os
+import time
+from collections import deque
+from typing import Dict
+from chat.metrics import registry
+
+""" Circuit breakers for the upstream model services and the shared conversation cache.
+
+A breaker keeps a rolling window of the latest calls to its upstream. It opens when too many of them
+failed or were slow, and then rejects calls at once with CircuitOpenError so the flow handlers can
+fall back without waiting. After reset_timeout it lets probe calls through (half-open), and closes
+again if they succeed.
+
+The thresholds are configured with BREAKER_WINDOW, BREAKER_MIN_CALLS, BREAKER_ERROR_RATE,
+BREAKER_SLOW_CALL_RATE and BREAKER_RESET_TIMEOUT, and per upstream with e.g.
+    INTERVIEW_MODEL_SLOW_CALL_THRESHOLD=8
+"""
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Seconds after which a call to the upstream counts as slow
+slow_call_defaults = {
+    "interview_model": 8,
+    "fika_model": 8,
+    "rasa_nlu": 0.4,
+    "huggingface": 20,
+    "redis": 0.1,
+}
+
+
+class CircuitOpenError(Exception):
+    "Raised instead of calling an upstream whose breaker is open"
+
+
+class CircuitBreaker:
+    "Closed -> open -> half-open -> closed state machine over a rolling window of calls"
+
+    def __init__(
+        self,
+        name: str,
+        window: float = 30,
+        min_calls: int = 10,
+        error_rate: float = 0.5,
+        slow_call_threshold: float = 5,
+        slow_call_rate: float = 0.8,
+        reset_timeout: float = 15,
+        half_open_probes: int = 1,
+    ):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_threshold = slow_call_threshold
+        self.slow_call_rate = slow_call_rate
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        # (finished at, failed, slow) of the calls in the window
+        self._calls = deque()
+        self._nbr_failed = 0
+        self._nbr_slow = 0
+
+        # Metrics
+        self.nbr_rejected = 0
+        self.nbr_opened = 0
+
+    @property
+    def state(self) -> str:
+        reset = time.monotonic() - self._opened_at >= self.reset_timeout
+        if self._state == OPEN and reset:
+            self._state = HALF_OPEN
+            self._probes = 0
+            logging.info(f"Circuit breaker {self.name} is half-open")
+        return self._state
+
+    @contextlib.contextmanager
+    def guard(self):
+        """Wraps one call to the upstream. Raises CircuitOpenError if the call isn't allowed.
+        Exceptions raised in the block count as failures, except cancellation"""
+        self._before_call()
+        tic = time.monotonic()
+        try:
+            yield
+        except asyncio.CancelledError:
+            # E.g. an unused speculative request. Says nothing about the upstream
+            self._release()
+            raise
+        except Exception:
+            self._on_result(failed=True, elapsed=time.monotonic() - tic)
+            raise
+        self._on_result(failed=False, elapsed=time.monotonic() - tic)
+
+    def _before_call(self):
+        state = self.state
+        probing = state == HALF_OPEN and self._probes >= self.half_open_probes
+        if state == OPEN or probing:
+            self.nbr_rejected += 1
+            raise CircuitOpenError(f"Circuit breaker {self.name} is open")
+        if state == HALF_OPEN:
+            self._probes += 1
+
+    def _release(self):
+        if self._state == HALF_OPEN:
+            self._probes = max(self._probes - 1, 0)
+
+    def _on_result(self, failed: bool, elapsed: float):
+        slow = elapsed >= self.slow_call_threshold
+        if self._state == HALF_OPEN:
+            self._probes = max(self._probes - 1, 0)
+            if failed or slow:
+                self._open()
+            else:
+                self._close()
+            return
+        if self._state == OPEN:
+            # A call that started before the breaker opened
+            return
+
+        now = time.monotonic()
+        self._calls.append((now, failed, slow))
+        self._nbr_failed += failed
+        self._nbr_slow += slow
+        self._prune(now)
+
+        nbr_calls = len(self._calls)
+        if nbr_calls >= self.min_calls and (
+            self._nbr_failed / nbr_calls >= self.error_rate
+            or self._nbr_slow / nbr_calls >= self.slow_call_rate
+        ):
+            self._open()
+
+    def _prune(self, now: float):
+        while self._calls and now - self._calls[0][0] > self.window:
+            _, failed, slow = self._calls.popleft()
+            self._nbr_failed -= failed
+            self._nbr_slow -= slow
+
+    def _open(self):
+        logging.warning(
+            f"Circuit breaker {self.name} opened: {self._nbr_failed} failed and "
+            f"{self._nbr_slow} slow of the last {len(self._calls)} calls"
+        )
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self.nbr_opened += 1
+        self._reset_window()
+
+    def _close(self):
+        logging.info(f"Circuit breaker {self.name} closed")
+        self._state = CLOSED
+        self._reset_window()
+
+    def _reset_window(self):
+        self._calls.clear()
+        self._nbr_failed = 0
+        self._nbr_slow = 0
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "calls_in_window": len(self._calls),
+            "failed_in_window": self._nbr_failed,
+            "slow_in_window": self._nbr_slow,
+            "rejected": self.nbr_rejected,
+            "opened": self.nbr_opened,
+        }
+
+
+def log_model_failure(model, e: Exception):
+    "Logs why a flow handler fell back instead of using a model reply"
+    if isinstance(e, CircuitOpenError):
+        logging.info(f"Skipped {type(model).__name__}: {e}")
+    else:
+        logging.warning(f"{type(model).__name__} failed: {e!r}")
+
+
+_breakers = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    "Returns the shared breaker of an upstream, creating it on first use"
+    if name not in _breakers:
+        env = os.environ
+        slow_call_threshold = env.get(
+            f"{name.upper()}_SLOW_CALL_THRESHOLD", slow_call_defaults.get(name, 5)
+        )
+        _breakers[name] = CircuitBreaker(
+            name,
+            window=float(env.get("BREAKER_WINDOW", 30)),
+            min_calls=int(env.get("BREAKER_MIN_CALLS", 10)),
+            error_rate=float(env.get("BREAKER_ERROR_RATE", 0.5)),
+            slow_call_threshold=float(slow_call_threshold),
+            slow_call_rate=float(env.get("BREAKER_SLOW_CALL_RATE", 0.8)),
+            reset_timeout=float(env.get("BREAKER_RESET_TIMEOUT", 15)),
+        )
+    return _breakers[name]
+
+
+_state_values = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def _breaker_stats():
+    stats = {}
+    for name, breaker in _breakers.items():
+        for stat, value in breaker.stats().items():
+            if stat == "state":
+                value = _state_values[value]
+            stats[(name, stat)] = value
+    return stats
+
+
+registry.gauge(
+    "emely_circuit_breaker",
+    "State (0 closed, 1 half-open, 2 open) and call counts of the upstream circuit breakers",
+    ("upstream", "stat"),
+    _breaker_stats,
+)
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import time
+import aiohttp
+from typing import Dict, Tuple
+from chat.metrics import upstream_seconds
+
+""" Shared, long-lived async http clients for the upstream model services.
+
+Each upstream gets its own keep-alive connection pool so a slow upstream can't starve the others.
+Pool limits and timeouts are configured per upstream through environment variables, e.g.
+    INTERVIEW_MODEL_POOL_SIZE=50
+    INTERVIEW_MODEL_TIMEOUT=30
+"""
+
+# Default (pool size, total timeout in seconds) per upstream
+upstream_defaults = {
+    "interview_model": (50, 30),
+    "fika_model": (50, 30),
+    "rasa_nlu": (50, 0.5),
+    "huggingface": (10, 30),
+}
+keepalive_timeout = 60
+
+
+class UpstreamError(Exception):
+    "Raised when an upstream responds with a server error"
+
+    def __init__(self, name: str, status: int, data):
+        super().__init__(f"{name} responded with status {status}: {data}")
+        self.status = status
+        self.data = data
+
+
+class UpstreamClient:
+    "Long-lived aiohttp session with a keep-alive connection pool for one upstream service"
+
+    def __init__(self, name: str, pool_size: int, timeout: float):
+        self.name = name
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._loop = None
+        # Closing of replaced sessions
+        self._closing = set()
+        # time.monotonic() of the last successful response. Tells if the upstream is warm
+        self.last_response_at = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The session is created lazily since it has to belong to the running event loop.
+        It is recreated if the loop has changed, e.g. in the TestClient"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._close_replaced_session(loop)
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._loop = loop
+        return self._session
+
+    def _close_replaced_session(self, loop: asyncio.AbstractEventLoop):
+        """Closes a session that belongs to another event loop before it's replaced.
+        The old loop is usually closed, so closing is scheduled on this one"""
+        if self._session is None or self._session.closed:
+            return
+        task = loop.create_task(self._session.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def post(
+        self, url: str, json: Dict, headers: Dict = None, timeout: float = None
+    ) -> Tuple[Dict, float]:
+        """Posts json to the upstream. Returns the json response and the elapsed time in seconds.
+        Raises UpstreamError on server errors"""
+        kwargs = {"json": json, "headers": headers}
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+
+        tic = time.perf_counter()
+        outcome = "error"
+        try:
+            async with self.session.post(url, **kwargs) as resp:
+                # Error responses from the model services are json too
+                data = await resp.json(content_type=None)
+                outcome = "ok" if resp.status < 400 else f"http_{resp.status}"
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise
+        except asyncio.CancelledError:
+            # E.g. an unused speculative request
+            outcome = "cancelled"
+            raise
+        finally:
+            elapsed = time.perf_counter() - tic
+            upstream_seconds.observe(elapsed, upstream=self.name, outcome=outcome)
+        if resp.status >= 500:
+            raise UpstreamError(self.name, resp.status, data)
+        self.last_response_at = time.monotonic()
+        return data, elapsed
+
+    async def get(self, url: str, timeout: float = None) -> float:
+        "Sends a get request to the upstream and returns the elapsed time in seconds"
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+
+        tic = time.perf_counter()
+        async with self.session.get(url, **kwargs) as resp:
+            await resp.read()
+        return time.perf_counter() - tic
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        loop = asyncio.get_running_loop()
+        closing = [task for task in self._closing if task.get_loop() is loop]
+        await asyncio.gather(*closing, return_exceptions=True)
+
+
+_clients = {}
+
+
+def get_client(name: str) -> UpstreamClient:
+    "Returns the shared client for an upstream, creating it on first use"
+    if name not in _clients:
+        default_pool_size, default_timeout = upstream_defaults[name]
+        pool_size = os.environ.get(f"{name.upper()}_POOL_SIZE", default_pool_size)
+        timeout = os.environ.get(f"{name.upper()}_TIMEOUT", default_timeout)
+        _clients[name] = UpstreamClient(name, int(pool_size), float(timeout))
+    return _clients[name]
+
+
+async def close_clients():
+    "Closes all connection pools. Called on shutdown"
+    for client in _clients.values():
+        await client.close()
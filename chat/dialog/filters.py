@@ -1,9 +1,10 @@
 from chat.data.types import Conversation, BotMessage, UserMessage
-import re
-from itertools import product
-from difflib import SequenceMatcher
+import numpy as np
 from typing import Tuple, List
-from chat.hardcoded_messages.badwords import badwords
+from chat.hardcoded_messages.badwords import badwords_by_lang
+from chat.dialog.toxicity import ToxicityMatcher
+from chat.dialog.fingerprints import fingerprint_sentences, split_text_into_sentences
+from chat.metrics import filter_seconds, timed
 import os
 
 lies = [
@@ -20,21 +21,34 @@ lies = [
 ]
 min_text_length = 4
 
+# Rows of previous fingerprints compared at a time by the repetition filter
+repetition_block_size = 16
 
-def contains_toxicity(user_message: UserMessage) -> bool:
-    """ Checks if any swedish badword is in the message """
-    if user_message.lang == "sv":
-        sentence_words = user_message.text.lower().split(" ")
-        offensive = any([bad_word in sentence_words for bad_word in badwords])
-        return offensive
+# Built once at startup. TOXICITY_PREFIX_MATCHING=1 also matches inflections of the badwords
+toxicity_matcher = ToxicityMatcher(
+    badwords_by_lang,
+    prefix_matching=os.environ.get("TOXICITY_PREFIX_MATCHING", "0") == "1",
+)
 
-    else:
-        return False
+
+@timed(filter_seconds, filter="toxicity")
+def find_toxicity(user_message: UserMessage) -> List[str]:
+    """ Returns the badwords found in the message """
+    return toxicity_matcher.find(user_message.text, user_message.lang)
+
+
+def contains_toxicity(user_message: UserMessage) -> bool:
+    """ Checks if any badword of the message's language is in the message """
+    return len(find_toxicity(user_message)) > 0
 
 
+@timed(filter_seconds, filter="too_repetitive")
 def is_too_repetitive(bot_message: BotMessage, conversation: Conversation) -> bool:
     """Modifies bot_message.text if it contains parts that are repetitive. 
     Will return True if it is too heavily modified and too little text is left.
+    Each sentence is compared to the sentences of Emely's latest messages in matrix products
+    of their fingerprints, which are cached on the conversation. The latest sentences are compared first,
+    and a sentence that is over the threshold isn't compared any further.
 
     Args:
         conversation (Conversation): [description]
@@ -49,41 +63,35 @@ def is_too_repetitive(bot_message: BotMessage, conversation: Conversation) -> bo
         return False
 
     else:
-        # What if we have a really long conversation? Is it okay to only check the latest X messages? Computation time can be a "problem" if we have a 40 message conversation
-        previous_replies = conversation.get_emely_messages(
+        previous_fingerprints = conversation.get_emely_fingerprints(
             int(os.environ["N_MESSAGES_FOR_REPETITION_FILTER"])
         )
-        if len(previous_replies) == 0:
+        if previous_fingerprints.shape[0] == 0:
             return False
 
         sentences, separators = split_text_into_sentences(bot_message.text)
+        fingerprints = fingerprint_sentences(sentences)
 
-        # Split the previous sentences into
-        previous_sentences = []
-        for text in previous_replies:
-            text_parts, _ = split_text_into_sentences(text)
-            previous_sentences.extend(text_parts)
-
+        # A sentence is kept if it isn't too similar to any previous sentence. Repeats are most likely
+        # of the latest messages, so blocks of previous sentences are compared newest first
         similarity_threshold = float(os.environ["SIMILARITY_THRESHOLD"])
-        keep_idx = []
-        # We loop over the sentences in bot_message and check how similar they are to previous sentences
-        # idx is appended to keep_idx if the sentence is deemed okay to keep
-        for i in range(len(sentences)):
-            combos = list(product([sentences[i]], previous_sentences))
-            ratios = [SequenceMatcher(a=s1, b=s2).ratio() for s1, s2 in combos]
-            if max(ratios) < similarity_threshold:
-                keep_idx.append(i)
+        keep = np.arange(len(sentences))
+        for end in range(previous_fingerprints.shape[0], 0, -repetition_block_size):
+            block = previous_fingerprints[max(end - repetition_block_size, 0) : end]
+            similarities = fingerprints[keep] @ block.T
+            keep = keep[similarities.max(axis=1) < similarity_threshold]
+            # Everything is removed
+            if len(keep) == 0:
+                return True
+        keep_idx = keep.tolist()
 
         # Everything is kept
         if len(keep_idx) == len(sentences):
             return False
-        # Everything is removed
-        elif len(keep_idx) == 0:
-            return True
 
         # Stitch together sentence
         keep_sentences = [sentences[i] for i in keep_idx]
-        keep_separators = [separators[i] for i in keep_idx]
+        keep_separators = [separators[i] for i in keep_idx if i < len(separators)]
         new_reply = stitch_together_sentences(keep_sentences, keep_separators)
 
         # Last check if it's too short
@@ -94,6 +102,7 @@ def is_too_repetitive(bot_message: BotMessage, conversation: Conversation) -> bo
             return True
 
 
+@timed(filter_seconds, filter="not_question")
 def contains_question(reply: BotMessage) -> bool:
     "Determines if reply is not a question"
 
@@ -103,20 +112,6 @@ def contains_question(reply: BotMessage) -> bool:
 # Method 2: Just remove if
 
 
-def split_text_into_sentences(text: str) -> Tuple[List[str], List[str]]:
-    "Helper func. Splits a text on . ? and ! and returns a list with the sentences and the separators"
-
-    sentence_parts = re.split("([.?!])", text)
-    if sentence_parts[-1] == "":
-        del sentence_parts[-1]
-
-    # We split the sentence parts into the words and the .?! signs
-    sentences = [sep for i, sep in enumerate(sentence_parts) if i % 2 == 0]
-    separators = [sep for i, sep in enumerate(sentence_parts) if i % 2 != 0]
-
-    return (sentences, separators)
-
-
 def stitch_together_sentences(sentences: List[str], separators: List[str]) -> str:
     "Helper func. Stitches together a list of sentence and separators into a string of sentences"
     stitched_text = ""
@@ -0,0 +1,51 @@
+import re
+import zlib
+import numpy as np
+from typing import List, Tuple
+
+""" Sentence fingerprints used by the repetition filter.
+
+A fingerprint is a vector of hashed character 3-gram counts, normalized to unit length,
+so the similarity of two sentences is the dot product of their fingerprints.
+"""
+
+n_features = 512
+ngram_length = 3
+
+
+def split_text_into_sentences(text: str) -> Tuple[List[str], List[str]]:
+    "Helper func. Splits a text on . ? and ! and returns a list with the sentences and the separators"
+
+    sentence_parts = re.split("([.?!])", text)
+    if sentence_parts[-1] == "":
+        del sentence_parts[-1]
+
+    # We split the sentence parts into the words and the .?! signs
+    sentences = [sep for i, sep in enumerate(sentence_parts) if i % 2 == 0]
+    separators = [sep for i, sep in enumerate(sentence_parts) if i % 2 != 0]
+
+    return (sentences, separators)
+
+
+def fingerprint_sentences(sentences: List[str]) -> np.ndarray:
+    "Returns a (len(sentences), n_features) matrix with one fingerprint per row"
+    fingerprints = np.zeros((len(sentences), n_features), dtype=np.float32)
+    for i, sentence in enumerate(sentences):
+        sentence = sentence.strip().lower()
+        if sentence == "":
+            continue
+        # Pad so short sentences get at least one shingle
+        padded = f" {sentence} "
+        for j in range(max(len(padded) - ngram_length + 1, 1)):
+            shingle = padded[j : j + ngram_length].encode("utf-8")
+            fingerprints[i, zlib.crc32(shingle) % n_features] += 1
+
+    norms = np.linalg.norm(fingerprints, axis=1, keepdims=True)
+    np.divide(fingerprints, norms, out=fingerprints, where=norms > 0)
+    return fingerprints
+
+
+def fingerprint_text(text: str) -> np.ndarray:
+    "Returns the fingerprints of each sentence in a text"
+    sentences, _ = split_text_into_sentences(text)
+    return fingerprint_sentences(sentences)
@@ -1,19 +1,29 @@
 import logging
-import requests
 from chat.data.types import UserMessage
 from typing import Dict
 import os
-import aiohttp
+from chat.dialog.clients import get_client
+from chat.dialog.breaker import get_breaker
+from chat.dialog.speculation import current_speculation
 from chat.utils import timer
+from chat.metrics import model_call_seconds
 from pathlib import Path
 import json
 import nltk
 
-interview_model_url = "https://interview-model-em7jnms6va-ey.a.run.app"  # "https://interview-model-ef5bmjer3q-ey.a.run.app"
-fika_model_url = "https://blender-90m-em7jnms6va-ey.a.run.app"  # "https://blender-90m-ef5bmjer3q-ey.a.run.app"
-rasa_nlu_url = "https://rasa-nlu-em7jnms6va-ey.a.run.app" #"https://rasa-nlu-ef5bmjer3q-ey.a.run.app"
-huggingface_fika_model_url = (
-    "https://api-inference.huggingface.co/models/facebook/blenderbot-400M-distill"
+# The upstreams can be pointed elsewhere, e.g. to the fakes in chat.fakes for load testing
+interview_model_url = os.environ.get(
+    "INTERVIEW_MODEL_URL", "https://interview-model-em7jnms6va-ey.a.run.app"
+)  # "https://interview-model-ef5bmjer3q-ey.a.run.app"
+fika_model_url = os.environ.get(
+    "FIKA_MODEL_URL", "https://blender-90m-em7jnms6va-ey.a.run.app"
+)  # "https://blender-90m-ef5bmjer3q-ey.a.run.app"
+rasa_nlu_url = os.environ.get(
+    "RASA_NLU_URL", "https://rasa-nlu-em7jnms6va-ey.a.run.app"
+)  # "https://rasa-nlu-ef5bmjer3q-ey.a.run.app"
+huggingface_fika_model_url = os.environ.get(
+    "HUGGINGFACE_FIKA_MODEL_URL",
+    "https://api-inference.huggingface.co/models/facebook/blenderbot-400M-distill",
 )
 
 
@@ -21,33 +31,57 @@ class MLModel:
     """Parent class for all models
     """
 
-    def __init__(self, url):
+    headers = None
+
+    def __init__(self, url, client_name, base_url=None):
         self.url = url
+        # Root url of the service, used for wake up calls
+        self.base_url = base_url if base_url is not None else url
+        self.client = get_client(client_name)
+        self.breaker = get_breaker(client_name)
 
-    def get_response(self, x):
+    async def get_response(self, x):
         ""
         inputs = self._format_input(x)
-        r = requests.post(url=self.url, json=inputs)
-        outputs = self._format_outputs(r)
+        r, elapsed = await self._request(inputs)
+        outputs = self._format_outputs(r, elapsed)
 
         return outputs
 
+    async def _post(self, inputs):
+        """Sends the request. Returns a tuple of (json response, elapsed seconds).
+        Raises CircuitOpenError at once if the upstream's circuit breaker is open"""
+        with self.breaker.guard():
+            return await self.client.post(
+                url=self.url, headers=self.headers, json=inputs
+            )
+
+    async def _request(self, inputs):
+        "Uses the turn's speculative request if one was started with the same inputs"
+        model = type(self).__name__
+        speculation = current_speculation()
+        if speculation is not None:
+            task = speculation.take(self, inputs)
+            if task is not None:
+                with model_call_seconds.time(model=model, speculative="true"):
+                    return await task
+        with model_call_seconds.time(model=model, speculative="false"):
+            return await self._post(inputs)
+
     def _format_input(self, x):
         raise NotImplementedError(
             "Override and implement this function in your MLModel subclass!"
         )
 
-    def _format_outputs(self, y):
+    def _format_outputs(self, y, elapsed):
         raise NotImplementedError(
             "Override and implement this function in your MLModel subclass"
         )
 
-    def wake_up(self):
-        "Sends a request with a short timeout to wake up gcp instance"
-        try:
-            requests.get(url=self.model_url, timeout=0.01)
-        except:
-            logging.info(f"Sent wake up call to {type(self)} model")
+    async def wake_up(self, timeout: float = None) -> float:
+        """Sends a request to the service so cloud run starts an instance, and waits for the response.
+        Returns the elapsed time in seconds, which is long if the service had to start"""
+        return await self.client.get(url=self.base_url, timeout=timeout)
 
 
 class HuggingfaceFika(MLModel):
@@ -59,18 +93,10 @@ class HuggingfaceFika(MLModel):
     def __init__(
         self, url=huggingface_fika_model_url
     ):
-        super().__init__(url=url)
+        super().__init__(url=url, client_name="huggingface")
         key = os.environ["HUGGINGFACE_KEY"]
         self.headers = {"Authorization": key}
 
-    def get_response(self, x):
-        ""
-        inputs = self._format_input(x)
-        r = requests.post(url=self.url, headers=self.headers, json=inputs)
-        outputs = self._format_outputs(r)
-
-        return outputs
-
     """
     Formats the input to huggingface-format
     """
@@ -104,10 +130,7 @@ class HuggingfaceFika(MLModel):
     Extracts the generated response and response-time from huggingface output
     """
 
-    def _format_outputs(self, y):
-        t = y.elapsed
-        y = y.json()
-        time = t.seconds + t.microseconds / 1000000
+    def _format_outputs(self, y, elapsed):
         if "generated_text" not in y:
             raise RuntimeError("Model not awakened")
 
@@ -115,55 +138,50 @@ class HuggingfaceFika(MLModel):
         sentences = nltk.tokenize.sent_tokenize(y["generated_text"])
         formatted_sentences = [sentence[0].upper() + sentence[1:] for sentence in sentences]
 
-        return (" ".join(formatted_sentences), time)
+        return (" ".join(formatted_sentences), elapsed)
 
-    def wake_up(self):
-        "Sends a request with one word to wake up huggingface model"
-        try:
-            inputs = {
-                "inputs": {
-                    "past_user_inputs": [],
-                    "generated_responses": [],
-                    "text": ".",
-                },
-            }
-            _ = requests.post(self.url, headers=self.headers, json=inputs)
-        except:
-            pass
-        logging.info(f"Sent wake up call to {type(self)} model")
+    async def wake_up(self, timeout: float = None) -> float:
+        "Sends a request with one word to wake up huggingface model. Returns the elapsed time in seconds"
+        inputs = {
+            "inputs": {
+                "past_user_inputs": [],
+                "generated_responses": [],
+                "text": ".",
+            },
+        }
+        _, elapsed = await self.client.post(
+            self.url, headers=self.headers, json=inputs, timeout=timeout
+        )
+        return elapsed
 
 
 class InterviewModel(MLModel):
     "Interfaces communication with the interview model"
 
-    def __init__(self, url=interview_model_url):
+    def __init__(self, url=interview_model_url, client_name="interview_model"):
         inference_url = url + "/inference"
-        super().__init__(url=inference_url)
-    
-    def get_response(self, x, block_list):
+        super().__init__(url=inference_url, client_name=client_name, base_url=url)
+
+    async def get_response(self, x, block_list):
         ""
         inputs = self._format_input(x, block_list)
-        r = requests.post(url=self.url, json=inputs)
-        outputs = self._format_outputs(r)
+        r, elapsed = await self._request(inputs)
+        outputs = self._format_outputs(r, elapsed)
 
         return outputs
 
     def _format_input(self, x, block_list):
         return {"text": x, "block_list": block_list}
 
-    def _format_outputs(self, y):
-        t = y.elapsed
-        y = y.json()
-        time = t.seconds + t.microseconds / 1000000
-
-        return (y["text"], time)
+    def _format_outputs(self, y, elapsed):
+        return (y["text"], elapsed)
 
 
 class FikaModel(InterviewModel):
     "Interfaces communication with the Fika model"
 
     def __init__(self, url=fika_model_url):
-        super().__init__(url=url)
+        super().__init__(url=url, client_name="fika_model")
 
 
 class RasaModel(MLModel):
@@ -171,6 +189,9 @@ class RasaModel(MLModel):
 
     def __init__(self):
         self.model_url = rasa_nlu_url
+        self.base_url = rasa_nlu_url
+        self.client = get_client("rasa_nlu")
+        self.breaker = get_breaker("rasa_nlu")
         self.inference_url = self.model_url + "/model/parse"
         self.dummy_reponse = {"id": "", "name": "", "confidence": 0}
         self.enabled = os.environ.get("RASA_ENABLED", "0")
@@ -183,11 +204,11 @@ class RasaModel(MLModel):
         if user_message.lang == "sv":
             text = user_message.text
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        url=self.inference_url, json={"text": text}, timeout=0.5
-                    ) as resp:
-                        r = await resp.json()
+                # The dummy response is returned at once while the breaker is open
+                with self.breaker.guard():
+                    r, _ = await self.client.post(
+                        url=self.inference_url, json={"text": text}
+                    )
                 return r["intent"]
             except Exception as e:
                 print(e)
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Dict
+
+# Sentinel used for branches that should raise instead of falling back on timeout
+NO_FALLBACK = object()
+
+
+class FanOut:
+    """Request pipeline stage that launches independent lookups at once and joins them.
+    The critical path of the stage becomes the slowest branch instead of the sum of all branches.
+
+    Example usage:
+        stage = FanOut()
+        stage.add("rasa", rasa_model.get_response(user_message), timeout=1, fallback={})
+        stage.add("translate", translator.translate(...), timeout=5)
+        results = await stage.join()
+        results["rasa"], stage.latencies["rasa"]
+    """
+
+    def __init__(self):
+        self.branches = {}
+        self.latencies = {}
+
+    def add(
+        self, name: str, awaitable: Awaitable, timeout: float, fallback=NO_FALLBACK
+    ):
+        """Adds a branch to the stage. If the branch times out the fallback is returned,
+        or asyncio.TimeoutError is raised if no fallback is given"""
+        self.branches[name] = (awaitable, timeout, fallback)
+
+    async def join(self) -> Dict[str, Any]:
+        "Runs all branches concurrently and returns their results by name"
+        tasks = {
+            name: asyncio.ensure_future(self._run_branch(name, *branch))
+            for name, branch in self.branches.items()
+        }
+        try:
+            await asyncio.gather(*tasks.values())
+        except Exception:
+            # One branch failed. There is no point in waiting for the others
+            for task in tasks.values():
+                task.cancel()
+            raise
+        return {name: task.result() for name, task in tasks.items()}
+
+    async def _run_branch(self, name, awaitable, timeout, fallback):
+        "Awaits a single branch with a timeout and records its latency"
+        tic = time.perf_counter()
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            if fallback is NO_FALLBACK:
+                raise
+            logging.warning(f"Branch {name} timed out after {timeout} s. Using fallback")
+            return fallback
+        finally:
+            self.latencies[name] = time.perf_counter() - tic
@@ -0,0 +1,101 @@
+import asyncio
+import contextlib
+import contextvars
+import json
+import time
+from typing import Dict, Optional
+
+""" Speculative model inference.
+
+The model call of a turn can be started as soon as the conversation and the translated user message
+are known, while Rasa is still classifying the message. When the flow handler later calls the model
+with exactly the same inputs it gets the speculative request instead of making a new one.
+Requests that aren't used, e.g. because a Rasa intent or a filter short-circuited the turn, are
+cancelled when the turn ends and counted as wasted.
+"""
+
+_current_speculation = contextvars.ContextVar("speculation", default=None)
+
+
+def current_speculation() -> Optional["Speculation"]:
+    "Returns the speculation of the turn that is being handled, if any"
+    return _current_speculation.get()
+
+
+class Speculation:
+    "Model requests started ahead of time for one turn"
+
+    def __init__(self, speculator: "Speculator"):
+        self.speculator = speculator
+        self.requests = {}
+
+    @staticmethod
+    def _key(model, inputs: Dict):
+        return (id(model), json.dumps(inputs, sort_keys=True))
+
+    def start(self, model, *args):
+        "Starts the request model.get_response(*args) would make"
+        inputs = model._format_input(*args)
+        task = asyncio.ensure_future(model._post(inputs))
+        self.requests[self._key(model, inputs)] = (task, time.perf_counter())
+        self.speculator.nbr_started += 1
+
+    def take(self, model, inputs: Dict) -> Optional[asyncio.Future]:
+        "Returns the speculative request with the same inputs, or None if there is none"
+        request = self.requests.pop(self._key(model, inputs), None)
+        if request is None:
+            self.speculator.nbr_misses += 1
+            return None
+        self.speculator.nbr_hits += 1
+        return request[0]
+
+    def finish(self):
+        "Cancels the requests that weren't used and records what they cost"
+        now = time.perf_counter()
+        for task, started_at in self.requests.values():
+            if task.done() and not task.cancelled():
+                # Failed requests that nobody awaited would otherwise be logged by asyncio
+                task.exception()
+            task.cancel()
+            self.speculator.nbr_wasted += 1
+            self.speculator.wasted_seconds += now - started_at
+        self.requests = {}
+
+
+class Speculator:
+    "Creates a Speculation per turn and keeps track of how well speculation works"
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+
+        # Metrics
+        self.nbr_started = 0
+        self.nbr_hits = 0
+        self.nbr_misses = 0
+        self.nbr_wasted = 0
+        self.wasted_seconds = 0.0
+
+    @contextlib.contextmanager
+    def turn(self):
+        "Context for one turn. Yields the turn's Speculation or None if speculation is disabled"
+        if not self.enabled:
+            yield None
+            return
+
+        speculation = Speculation(self)
+        token = _current_speculation.set(speculation)
+        try:
+            yield speculation
+        finally:
+            _current_speculation.reset(token)
+            speculation.finish()
+
+    def stats(self) -> Dict:
+        return {
+            "started": self.nbr_started,
+            "hits": self.nbr_hits,
+            "misses": self.nbr_misses,
+            "wasted": self.nbr_wasted,
+            "wasted_seconds": self.wasted_seconds,
+            "hit_rate": self.nbr_hits / max(self.nbr_started, 1),
+        }
@@ -0,0 +1,74 @@
+import re
+from typing import Dict, Iterable, List
+
+_token = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    "Lowercases and splits text into words, dropping punctuation so 'kuk!' becomes 'kuk'"
+    return _token.findall(text.lower())
+
+
+class ToxicityMatcher:
+    """Matches messages against per-language badword lists at a constant cost per word.
+
+    Each word is looked up in a frozenset. With prefix_matching, inflected forms are matched too
+    by walking a character trie of the badwords, e.g. 'runkaren' matches 'runka'.
+    Only badwords of at least min_prefix_length characters are matched as prefixes
+    to keep false positives down.
+    """
+
+    def __init__(
+        self,
+        word_lists: Dict[str, Iterable[str]],
+        prefix_matching: bool = False,
+        min_prefix_length: int = 4,
+    ):
+        self.prefix_matching = prefix_matching
+        self.min_prefix_length = min_prefix_length
+        self.words = {
+            lang: frozenset(word.lower() for word in words)
+            for lang, words in word_lists.items()
+        }
+        self.tries = {lang: self._build_trie(words) for lang, words in self.words.items()}
+
+    def _build_trie(self, words) -> Dict:
+        trie = {}
+        for word in words:
+            if len(word) < self.min_prefix_length:
+                continue
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[""] = word
+        return trie
+
+    def _match_prefix(self, token: str, trie: Dict):
+        "Returns the shortest badword that the token starts with or None"
+        node = trie
+        for char in token:
+            node = node.get(char)
+            if node is None:
+                return None
+            if "" in node:
+                return node[""]
+        return None
+
+    def find(self, text: str, lang: str) -> List[str]:
+        "Returns the badwords found in the text. Languages without a word list never match"
+        words = self.words.get(lang)
+        if words is None:
+            return []
+
+        matches = []
+        for token in tokenize(text):
+            if token in words:
+                matches.append(token)
+            elif self.prefix_matching:
+                match = self._match_prefix(token, self.tries[lang])
+                if match is not None:
+                    matches.append(match)
+        return matches
+
+    def contains(self, text: str, lang: str) -> bool:
+        return len(self.find(text, lang)) > 0
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+from chat.metrics import registry
+
+""" Keeps the model services on cloud run warm while people are using Emely.
+
+Cloud run scales a service down to zero instances when it hasn't had requests for a while, and the next
+request has to wait for a new instance to start. While there has been traffic within traffic_window,
+the scheduler pings every service that hasn't answered a request within the last interval. When a
+conversation is initiated, services that aren't known to be warm are pinged right away so they have
+started by the time the user has written an answer.
+
+A ping is counted as a cold start if it took longer than cold_threshold seconds.
+"""
+
+warmup_seconds = registry.histogram(
+    "emely_warmup_seconds",
+    "Latency of keep-warm pings to the model services, by observed warm or cold state",
+    ("upstream", "state"),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0),
+)
+
+
+class ServiceState:
+    "What the keep-warm scheduler knows about one service"
+
+    def __init__(self):
+        self.warm = False
+        self.last_ping_at = None
+        self.last_latency = None
+        self.last_cold_start_latency = None
+        self.nbr_pings = 0
+        self.nbr_cold_starts = 0
+        self.nbr_failed = 0
+
+
+class KeepWarm:
+    """Background scheduler that pings the model services on a cadence driven by recent traffic.
+
+    Example usage:
+        keep_warm = KeepWarm({"interview_model": interview_model, ...})
+        keep_warm.start()               # on startup
+        keep_warm.record_activity()     # on every turn
+        keep_warm.prewarm()             # when a conversation is initiated
+        await keep_warm.stop()          # on shutdown
+    """
+
+    def __init__(
+        self,
+        models: Dict,
+        enabled: bool = True,
+        interval: float = 240,
+        traffic_window: float = 1800,
+        cold_threshold: float = 2,
+        timeout: float = 60,
+    ):
+        # Name of the upstream -> MLModel
+        self.models = models
+        self.enabled = enabled
+        self.interval = interval
+        self.traffic_window = traffic_window
+        self.cold_threshold = cold_threshold
+        self.timeout = timeout
+
+        self.states = {name: ServiceState() for name in models}
+        self._last_activity_at = None
+        self._pings = {}
+        self._task = None
+
+        registry.gauge(
+            "emely_upstream_warm",
+            "Observed state of the model services: warm, last ping latency and cold starts",
+            ("upstream", "stat"),
+            self._state_stats,
+        )
+
+    def record_activity(self):
+        "Marks that Emely is in use"
+        self._last_activity_at = time.monotonic()
+
+    @property
+    def active(self) -> bool:
+        "True if there has been traffic within the traffic window"
+        return (
+            self._last_activity_at is not None
+            and time.monotonic() - self._last_activity_at < self.traffic_window
+        )
+
+    def _recently_used(self, name: str, now: float) -> bool:
+        "True if the service answered a ping or a real request within the interval"
+        state = self.states[name]
+        last_response_at = self.models[name].client.last_response_at
+        if state.warm and now - state.last_ping_at < self.interval:
+            return True
+        return last_response_at is not None and now - last_response_at < self.interval
+
+    def prewarm(self):
+        "Called when a conversation is initiated. Pings the services that may be cold without waiting"
+        self.record_activity()
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        for name in self.models:
+            if not self._recently_used(name, now):
+                self._ping_in_background(name)
+
+    def _ping_in_background(self, name: str) -> asyncio.Future:
+        "Starts a ping unless one is already in flight"
+        if name not in self._pings:
+            task = asyncio.ensure_future(self._ping(name))
+            self._pings[name] = task
+            task.add_done_callback(lambda _: self._pings.pop(name, None))
+        return self._pings[name]
+
+    async def ping_all(self):
+        "Pings all services and waits for them to answer"
+        await asyncio.gather(
+            *[asyncio.shield(self._ping_in_background(name)) for name in self.models]
+        )
+
+    async def _ping(self, name: str) -> Optional[float]:
+        state = self.states[name]
+        try:
+            elapsed = await self.models[name].wake_up(timeout=self.timeout)
+        except Exception as e:
+            state.warm = False
+            state.nbr_failed += 1
+            logging.warning(f"Keep-warm ping to {name} failed: {e!r}")
+            return None
+        finally:
+            state.nbr_pings += 1
+            state.last_ping_at = time.monotonic()
+
+        cold = elapsed >= self.cold_threshold
+        state.warm = not cold
+        state.last_latency = elapsed
+        if cold:
+            state.nbr_cold_starts += 1
+            state.last_cold_start_latency = elapsed
+            logging.info(f"{name} was cold. It took {elapsed:0.1f}s to answer")
+        warmup_seconds.observe(elapsed, upstream=name, state="cold" if cold else "warm")
+        return elapsed
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.active:
+                # Let the services scale down when nobody is using Emely
+                continue
+            now = time.monotonic()
+            for name in self.models:
+                if not self._recently_used(name, now):
+                    self._ping_in_background(name)
+
+    def start(self):
+        "Starts the scheduler. Has to be called from the running event loop"
+        if self.enabled and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        pings = list(self._pings.values())
+        for task in pings:
+            task.cancel()
+        await asyncio.gather(*pings, return_exceptions=True)
+
+    def _state_stats(self) -> Dict:
+        stats = {}
+        now = time.monotonic()
+        for name, state in self.states.items():
+            stats[(name, "warm")] = int(state.warm)
+            stats[(name, "pings")] = state.nbr_pings
+            stats[(name, "cold_starts")] = state.nbr_cold_starts
+            stats[(name, "failed_pings")] = state.nbr_failed
+            if state.last_latency is not None:
+                stats[(name, "last_ping_latency")] = state.last_latency
+            if state.last_cold_start_latency is not None:
+                stats[(name, "last_cold_start_latency")] = state.last_cold_start_latency
+            if state.last_ping_at is not None:
+                stats[(name, "seconds_since_ping")] = now - state.last_ping_at
+        return stats
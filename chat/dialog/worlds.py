@@ -1,10 +1,13 @@
 import os
+import asyncio
 import logging
 from chat.translate.translator import ChatTranslator
+from chat.translate.cache import collect_hardcoded_phrases
 from chat.fika.flow import FikaFlowHandler
 
 from chat.interview.flow import InterviewFlowHandler
 from chat.interview.questions import QuestionGenerator
+from chat.interview.bank import QuestionBank
 
 from chat.data.database import FirestoreHandler
 from chat.data.types import (
@@ -18,7 +21,11 @@ from chat.data.types import (
 import random
 from chat.hardcoded_messages import rasa, callstoaction
 from chat.dialog.models import RasaModel
-from chat.dialog.filters import contains_toxicity
+from chat.dialog.filters import find_toxicity
+from chat.dialog.pipeline import FanOut
+from chat.dialog.speculation import Speculator, Speculation, current_speculation
+from chat.dialog.warmup import KeepWarm
+from chat.metrics import registry, turn_seconds, turn_stage_seconds
 
 
 class DialogWorld:
@@ -27,12 +34,27 @@ class DialogWorld:
         self._set_environment()
 
         self.translator = ChatTranslator()
-        self.question_generator = QuestionGenerator()
-        self.interview_flow_handler = InterviewFlowHandler()
+        self.question_bank = QuestionBank()
+        self.question_generator = QuestionGenerator(self.question_bank)
+        self.interview_flow_handler = InterviewFlowHandler(self.question_bank)
         self.fika_flow_handler = FikaFlowHandler()
+        self.flow_handlers = {
+            "intervju": self.interview_flow_handler,
+            "fika": self.fika_flow_handler,
+        }
         self.database_handler = FirestoreHandler()
         self.rasa_model = RasaModel()
-        self.wake_models()
+        self.speculator = Speculator(os.environ["SPECULATIVE_INFERENCE"] == "1")
+        self.keep_warm = self._create_keep_warm()
+        # Started by start_background_tasks and referenced here so they aren't garbage collected
+        self._background_tasks = set()
+
+        registry.gauge(
+            "emely_component_stats",
+            "Counters and sizes kept by the caches, the write queue, the speculator and the deletion jobs",
+            ("component", "stat"),
+            self.component_stats,
+        )
 
     def _set_environment(self):
         "Sets class attributes based on environment variables"
@@ -57,34 +79,99 @@ class DialogWorld:
 
         if "REPETITION_FILTER" not in env:
             env["REPETITION_FILTER"] = "1"
-            env["SIMILARITY_THRESHOLD"] = "0.9"
+            # Cosine similarity of sentence fingerprints, see tests/calibrate_repetition_filter.py
+            env["SIMILARITY_THRESHOLD"] = "0.85"
             env["N_MESSAGES_FOR_REPETITION_FILTER"] = "8"
 
         if "RASA_ENABLED" not in env:
             env["RASA_ENABLED"] = "1"
             self.rasa_threshold = env.get("RASA_THRESHOLD", 0.95)
 
+        # Translate the hardcoded phrases missing from the phrase table at startup. The table is built
+        # with the image, see the Dockerfile, so this is only needed when running without one
+        if "BUILD_PHRASE_TABLE" not in env:
+            env["BUILD_PHRASE_TABLE"] = "0"
+
+        # Start the model call of a turn while rasa classifies the user message
+        if "SPECULATIVE_INFERENCE" not in env:
+            env["SPECULATIVE_INFERENCE"] = "0"
+
+        ########## Timeouts in seconds for the lookups done at the start of each turn
+        if "RASA_TIMEOUT" not in env:
+            env["RASA_TIMEOUT"] = "1"
+        if "TRANSLATE_TIMEOUT" not in env:
+            env["TRANSLATE_TIMEOUT"] = "5"
+        if "DATABASE_TIMEOUT" not in env:
+            env["DATABASE_TIMEOUT"] = "5"
+
         logging.info("ENVIRONMENT VARIABLES:")
         for k, v in env.items():
             logging.info(f"{k}: {v}")
 
-    def wake_models(self):
-        """Wakes all MLModels.
+    def _create_keep_warm(self) -> KeepWarm:
+        "Keep-warm scheduler for the model services, configured with KEEP_WARM_* environment variables"
+        models = [
+            self.rasa_model,
+            self.interview_flow_handler.interview_model,
+            self.interview_flow_handler.fika_model,
+        ]
+        if os.environ["USE_HUGGINGFACE_FIKA"] == "1":
+            models.append(self.interview_flow_handler.huggingface_fika_model)
+
+        env = os.environ
+        return KeepWarm(
+            {model.client.name: model for model in models},
+            enabled=env.get("KEEP_WARM_ENABLED", "1") == "1",
+            interval=float(env.get("KEEP_WARM_INTERVAL", 240)),
+            traffic_window=float(env.get("KEEP_WARM_TRAFFIC_WINDOW", 1800)),
+            cold_threshold=float(env.get("KEEP_WARM_COLD_THRESHOLD", 2)),
+            timeout=float(env.get("KEEP_WARM_TIMEOUT", 60)),
+        )
+
+    async def wake_models(self):
+        """Wakes all MLModels and starts keeping them warm.
         Can be coupled with an API endpoint in the webserver so front end can wake everything
         """
-        self.rasa_model.wake_up()
-        self.interview_flow_handler.interview_model.wake_up()
-        if os.environ["USE_HUGGINGFACE_FIKA"] == "1":
-            self.interview_flow_handler.huggingface_fika_model.wake_up()
-        self.interview_flow_handler.fika_model.wake_up()
+        self.keep_warm.start()
+        await self.keep_warm.ping_all()
         return
 
+    def start_background_tasks(self):
+        """Wakes the models and resumes the deletions that an earlier instance didn't finish, without waiting.
+        Has to be called from the running event loop"""
+        for coroutine in [
+            # Cold model services can take a minute to start
+            self.wake_models(),
+            self.database_handler.deletion_jobs.resume(),
+        ]:
+            task = asyncio.ensure_future(coroutine)
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+
+    async def stop_background_tasks(self):
+        "Cancels the tasks started by start_background_tasks that haven't finished"
+        tasks = list(self._background_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def build_phrase_table(self):
+        "Makes sure all hardcoded phrases are in the translator's phrase table"
+        try:
+            phrases = collect_hardcoded_phrases(self.question_bank)
+            await self.translator.build_phrase_table(phrases)
+        except Exception as e:
+            logging.warning(f"Failed to build phrase table: {e}")
+
     async def create_new_conversation(self, info: ConversationInit):
         """Creates a new conversation
         - Sets current_dialog_block to either intro or first question depending on parameter in info! Default to False
         - Generates questions
         - Gets first message
         - Pushes data to firestore"""
+        # The user will answer in a moment, so make sure the models are up
+        self.keep_warm.prewarm()
+
         persona = info.persona
         if persona == "intervju":
             job = info.job
@@ -113,32 +200,30 @@ class DialogWorld:
             reply = await self.handle_bot_reply(reply, new_conversation)
 
         progress = new_conversation.add_message(reply)
-        self.database_handler.create(new_conversation)
+        await self.database_handler.create(new_conversation)
         reply.progress = progress
         return reply
 
     async def interview_reply(self, user_message: UserMessage):
         "Responds to user in an interview"
+        self.keep_warm.record_activity()
+        labels = dict(persona="intervju", outcome="error")
+        with self.speculator.turn(), turn_seconds.time(**labels) as labels:
+            reply = await self._interview_reply(user_message, labels)
+        self._log_speculation()
+        return reply
 
-        # Call rasa
-        # TODO: Make the calls to rasa, translate and database concurrent
-        rasa_response = await self.rasa_model.get_response(user_message)
-
-        # Translate
-        text_en = await self.translator.translate(
-            text=user_message.text, src=user_message.lang, target="en"
+    async def _interview_reply(self, user_message: UserMessage, labels: dict):
+        # Call rasa, translate and fetch conversation data from firestore
+        rasa_response, text_en, conversation = await self.fetch_turn_inputs(
+            user_message, "intervju"
         )
+        labels["dialog_block"] = conversation.current_dialog_block
 
-        # Fetch conversation data from firestore
-        conversation = self.database_handler.get_conversation(
-            user_message.conversation_id
-        )
+        toxic_words = find_toxicity(user_message)
 
         # Too short filter
-        if (
-            len(user_message.text) < float(os.environ["MIN_ANSWER_LENGTH"])
-            and not conversation.current_dialog_block == "small_talk"
-        ):
+        if self._is_too_short(user_message, conversation):
 
             # We don't want these messages to show up in the dialog history
             reason = "too_short"
@@ -165,7 +250,8 @@ class DialogWorld:
             )
 
         # Toxicity filter
-        elif contains_toxicity(user_message):
+        elif toxic_words:
+            logging.info(f"Toxic words in user message: {toxic_words}")
             # We don't want these messages to show up in the dialog history
             reason = "toxic"
             conversation.add_user_message(
@@ -204,44 +290,49 @@ class DialogWorld:
                 filtered_reason="",
             )
 
-            # Rasa act
-            if intent in rasa.replies.keys():
-                reply = self.interview_flow_handler.rasa_act(intent, conversation)
+            with turn_stage_seconds.time(persona="intervju", stage="act"):
+                # Rasa act
+                if intent in rasa.replies.keys():
+                    reply = self.interview_flow_handler.rasa_act(intent, conversation)
 
-            # Regular act
-            else:
-                reply = self.interview_flow_handler.act(conversation)
+                # Regular act
+                else:
+                    reply = await self.interview_flow_handler.act(conversation)
 
             # Translate reply depending on if it was hardcoded or not
-            reply = await self.handle_bot_reply(reply, conversation)
+            with turn_stage_seconds.time(persona="intervju", stage="translate_reply"):
+                reply = await self.handle_bot_reply(reply, conversation)
 
         # Add reply to conversation
         progress = conversation.add_message(reply)
         # Update firestore with conversation and send back message to front end
 
-        self.database_handler.update(conversation)  # TODO: Fire and forget
+        await self.database_handler.submit_update(conversation)
         reply.progress = progress
+        self._label_turn(labels, conversation, reply)
         return reply
 
     async def fika_reply(self, user_message: UserMessage):
         "Responds to user during fika"
+        self.keep_warm.record_activity()
+        labels = dict(persona="fika", outcome="error")
+        with self.speculator.turn(), turn_seconds.time(**labels) as labels:
+            reply = await self._fika_reply(user_message, labels)
+        self._log_speculation()
+        return reply
 
-        rasa_response = await self.rasa_model.get_response(user_message)
-
-        # Translate
-        # TODO: Concurrent calls to database and translate
-        text_en = await self.translator.translate(
-            text=user_message.text, src=user_message.lang, target="en"
-        )
-
-        # Fetch conversation data from firestore
-        conversation = self.database_handler.get_conversation(
-            user_message.conversation_id
+    async def _fika_reply(self, user_message: UserMessage, labels: dict):
+        # Call rasa, translate and fetch conversation data from firestore
+        rasa_response, text_en, conversation = await self.fetch_turn_inputs(
+            user_message, "fika"
         )
+        labels["dialog_block"] = conversation.current_dialog_block
 
         # Toxic messages are replied to without doing anything specific.
         # Emely will pretend like she didn't understand and repeat her previous statement
-        if contains_toxicity(user_message):
+        toxic_words = find_toxicity(user_message)
+        if toxic_words:
+            logging.info(f"Toxic words in user message: {toxic_words}")
             conversation.add_user_message(
                 user_message,
                 text_en,
@@ -278,22 +369,188 @@ class DialogWorld:
                 filtered_reason="",
             )
 
-            if intent in rasa.fika_intents:
-                reply = self.interview_flow_handler.rasa_act(intent, conversation)
-            else:
-                reply = self.fika_flow_handler.act(conversation)
+            with turn_stage_seconds.time(persona="fika", stage="act"):
+                if intent in rasa.fika_intents:
+                    reply = self.interview_flow_handler.rasa_act(intent, conversation)
+                else:
+                    reply = await self.fika_flow_handler.act(conversation)
 
             # Translate reply depending on if it was hardcoded or not
-            reply = await self.handle_bot_reply(reply, conversation)
+            with turn_stage_seconds.time(persona="fika", stage="translate_reply"):
+                reply = await self.handle_bot_reply(reply, conversation)
 
         # Add reply to conversation
         progress = conversation.add_message(reply)
         # Update firestore with conversation and send back message to front end
 
-        self.database_handler.update(conversation)  # TODO: Fire and forget
+        await self.database_handler.submit_update(conversation)
         reply.progress = progress
+        self._label_turn(labels, conversation, reply)
         return reply
 
+    async def reply_events(self, user_message: UserMessage, persona: str):
+        """Responds to the user while yielding (event, data) tuples as the reply progresses:
+        - thinking: at once
+        - reply: the reply as soon as it's generated and translated
+        - done: the progress, once the conversation is persisted
+        - error: instead of done if the conversation couldn't be persisted, e.g. while firestore is down"""
+        yield "thinking", {"conversation_id": user_message.conversation_id}
+
+        if persona == "intervju":
+            reply = await self.interview_reply(user_message)
+        elif persona == "fika":
+            reply = await self.fika_reply(user_message)
+        else:
+            raise ValueError(f"Unknown persona {persona}")
+        yield "reply", reply.dict(exclude={"progress"})
+
+        write_queue = self.database_handler.write_queue
+        if await write_queue.wait_for(user_message.conversation_id):
+            yield "done", {"progress": reply.progress, "message_nbr": reply.message_nbr}
+        else:
+            yield "error", {
+                "detail": "The conversation could not be saved",
+                "retrying": write_queue.has_dead_letter(user_message.conversation_id),
+                "message_nbr": reply.message_nbr,
+            }
+
+    async def fetch_turn_inputs(self, user_message: UserMessage, persona: str = None):
+        """Calls rasa, translates the user message and fetches the conversation concurrently.
+        If the turn is speculative, the persona's model call is started as soon as the translation
+        and conversation are available, without waiting for rasa.
+        Returns a tuple of (rasa_response, text_en, conversation)"""
+        env = os.environ
+
+        translation = asyncio.ensure_future(
+            self.translator.translate(
+                text=user_message.text, src=user_message.lang, target="en"
+            )
+        )
+        conversation = asyncio.ensure_future(
+            self.database_handler.get_conversation_async(user_message.conversation_id)
+        )
+
+        stage = FanOut()
+        stage.add(
+            "rasa",
+            self.rasa_model.get_response(user_message),
+            timeout=float(env["RASA_TIMEOUT"]),
+            fallback=self.rasa_model.dummy_reponse,
+        )
+        stage.add("translate", translation, timeout=float(env["TRANSLATE_TIMEOUT"]))
+        stage.add("database", conversation, timeout=float(env["DATABASE_TIMEOUT"]))
+
+        speculation = current_speculation()
+        if speculation is not None and persona in self.flow_handlers:
+            speculating = asyncio.ensure_future(
+                self._start_speculation(
+                    speculation, user_message, persona, translation, conversation
+                )
+            )
+        else:
+            speculating = None
+
+        try:
+            results = await stage.join()
+        except BaseException:
+            # No turn will use the speculation, and the task mustn't outlive the turn
+            if speculating is not None:
+                speculating.cancel()
+                await asyncio.gather(speculating, return_exceptions=True)
+            raise
+        # Starting the speculative request doesn't block, so it's registered before the turn needs it
+        if speculating is not None:
+            await speculating
+
+        logging.info(
+            "Turn input latencies: "
+            + ", ".join(f"{k}={v:0.3f}s" for k, v in stage.latencies.items())
+        )
+        for name, latency in stage.latencies.items():
+            turn_stage_seconds.observe(latency, persona=persona, stage=name)
+        return results["rasa"], results["translate"], results["database"]
+
+    async def _start_speculation(
+        self,
+        speculation: Speculation,
+        user_message: UserMessage,
+        persona: str,
+        translation: asyncio.Future,
+        conversation: asyncio.Future,
+    ):
+        """Starts the model call the turn will make if rasa doesn't return an intent.
+        Nothing is started for messages that the filters will catch"""
+        # Failures and timeouts are handled by fetch_turn_inputs
+        await asyncio.wait([translation, conversation])
+        for future in [translation, conversation]:
+            if future.cancelled() or future.exception() is not None:
+                return
+        text_en = translation.result()
+        conversation = conversation.result()
+
+        try:
+            if find_toxicity(user_message):
+                return
+            if persona == "intervju" and self._is_too_short(user_message, conversation):
+                return
+
+            # The flow handler decides on a copy with the user message added, as it will during the turn
+            conversation = conversation.copy(deep=True)
+            conversation.add_user_message(
+                user_message,
+                text_en,
+                rasa_intent="",
+                show_emely=True,
+                filtered_reason="",
+            )
+            call = self.flow_handlers[persona].plan_model_call(conversation)
+            if call is not None:
+                model, args = call
+                speculation.start(model, *args)
+        except Exception as e:
+            logging.warning(f"Failed to start speculative model call: {e}")
+
+    def _is_too_short(self, user_message: UserMessage, conversation: Conversation):
+        "Too short answers are filtered, except during small talk"
+        return (
+            len(user_message.text) < float(os.environ["MIN_ANSWER_LENGTH"])
+            and not conversation.current_dialog_block == "small_talk"
+        )
+
+    def _label_turn(self, labels: dict, conversation: Conversation, reply: Message):
+        "Sets the outcome labels of the turn's latency"
+        user_message = conversation.messages[-2]
+        labels["outcome"] = user_message.filtered_reason or reply.filtered_reason or "ok"
+        labels["intent"] = user_message.rasa_intent or "none"
+        labels["hardcoded"] = "true" if reply.is_hardcoded else "false"
+
+    def component_stats(self) -> dict:
+        "Stats of the caches, the write queue and the speculator as {(component, stat): value}"
+        components = {
+            "write_queue": self.database_handler.write_queue.stats(),
+            "conversation_cache": self.database_handler.cache.stats(),
+            "translation_cache": self.translator.cache.stats(),
+            "translation_batcher": {
+                "requests": self.translator.batcher.nbr_requests,
+                "batches": self.translator.batcher.nbr_batches,
+            },
+            "speculation": self.speculator.stats(),
+            "deletion_jobs": self.database_handler.deletion_jobs.stats(),
+        }
+        return {
+            (component, stat): value
+            for component, stats in components.items()
+            for stat, value in stats.items()
+        }
+
+    def _log_speculation(self):
+        if self.speculator.enabled:
+            stats = self.speculator.stats()
+            logging.info(
+                f"Speculative inference: hit rate {stats['hit_rate']:0.2f}, "
+                f"{stats['wasted']} wasted requests ({stats['wasted_seconds']:0.1f}s)"
+            )
+
     async def handle_bot_reply(
         self, bot_message: BotMessage, conversation: Conversation
     ) -> Message:
@@ -306,7 +563,7 @@ class DialogWorld:
                 text=text_en, src="en", target=conversation.lang
             )
         else:
-            # TODO: Hardcoded phrases will be translated often. Add dictionary for them?
+            # Hardcoded phrases are found in the translator's phrase table
             text = bot_message.text
             text_en = await self.translator.translate(
                 text=text, src=bot_message.lang, target="en"
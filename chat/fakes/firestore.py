@@ -0,0 +1,336 @@
+import copy
+import functools
+import random
+import string
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Optional
+from google.api_core.exceptions import InvalidArgument, NotFound, ServiceUnavailable
+from chat.fakes.latency import LatencyProfile
+
+""" In-memory stand-in for the firestore client. Enabled in FirestoreHandler with USE_FAKE_FIRESTORE=1.
+
+Supports the part of the api the backend uses: collections, subcollections, documents, queries with
+where/order_by/limit/start_after and write batches. Every rpc waits for the configured latency
+(FAKE_FIRESTORE_LATENCY, FAKE_FIRESTORE_ERROR_RATE), and reads, writes and deletes are counted per document
+the way firestore bills them.
+"""
+
+max_batch_size = 500
+
+_operators = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "in": lambda a, b: a in b,
+    "not-in": lambda a, b: a not in b,
+    "array-contains": lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+def _random_id() -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits, k=20))
+
+
+def _merge(document: Dict, data: Dict):
+    "set(..., merge=True) merges nested maps field by field, like firestore"
+    for field, value in data.items():
+        if isinstance(value, dict) and isinstance(document.get(field), dict):
+            _merge(document[field], value)
+        else:
+            document[field] = copy.deepcopy(value)
+
+
+class FakeFirestoreClient:
+    "Holds the documents. Thread safe, since the backend calls firestore from executor threads"
+
+    def __init__(self, profile: LatencyProfile = None):
+        if profile is None:
+            profile = LatencyProfile.from_env("FAKE_FIRESTORE", "lognormal:0.03:0.3")
+        self.profile = profile
+        # Collection path -> document id -> data
+        self._collections = defaultdict(dict)
+        self._lock = threading.RLock()
+
+        # Metrics
+        self.nbr_rpcs = 0
+        self.nbr_reads = 0
+        self.nbr_writes = 0
+        self.nbr_deletes = 0
+
+    def collection(self, path: str) -> "FakeCollectionReference":
+        return FakeCollectionReference(self, path)
+
+    def document(self, path: str) -> "FakeDocumentReference":
+        collection_path, document_id = path.rsplit("/", 1)
+        return FakeDocumentReference(self, collection_path, document_id)
+
+    def batch(self) -> "FakeWriteBatch":
+        return FakeWriteBatch(self)
+
+    def stats(self) -> Dict:
+        return {
+            "rpcs": self.nbr_rpcs,
+            "reads": self.nbr_reads,
+            "writes": self.nbr_writes,
+            "deletes": self.nbr_deletes,
+        }
+
+    def _rpc(self):
+        "Simulates the round trip of one request"
+        self.nbr_rpcs += 1
+        time.sleep(self.profile.sample())
+        if self.profile.fails():
+            raise ServiceUnavailable("Fake firestore error")
+
+    def _read(self, collection_path: str, document_id: str) -> Optional[Dict]:
+        data = self._collections[collection_path].get(document_id)
+        return copy.deepcopy(data)
+
+    def _write(self, operation: str, collection_path: str, document_id: str, data):
+        "Applies one write. The caller holds the lock"
+        documents = self._collections[collection_path]
+        if operation == "set":
+            documents[document_id] = copy.deepcopy(data)
+        elif operation == "merge":
+            _merge(documents.setdefault(document_id, {}), data)
+        elif operation == "create":
+            if document_id in documents:
+                raise InvalidArgument(f"Document {document_id} already exists")
+            documents[document_id] = copy.deepcopy(data)
+        elif operation == "update":
+            if document_id not in documents:
+                raise NotFound(f"No document to update: {collection_path}/{document_id}")
+            documents[document_id].update(copy.deepcopy(data))
+        elif operation == "delete":
+            documents.pop(document_id, None)
+            self.nbr_deletes += 1
+            return
+        self.nbr_writes += 1
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference: "FakeDocumentReference", data: Optional[Dict]):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[Dict]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field: str) -> Any:
+        return self._data[field]
+
+
+class FakeDocumentReference:
+    def __init__(self, client: FakeFirestoreClient, collection_path: str, id: str):
+        self._client = client
+        self._collection_path = collection_path
+        self.id = id
+
+    @property
+    def path(self) -> str:
+        return f"{self._collection_path}/{self.id}"
+
+    def collection(self, name: str) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths=None) -> FakeDocumentSnapshot:
+        self._client._rpc()
+        with self._client._lock:
+            data = self._client._read(self._collection_path, self.id)
+            self._client.nbr_reads += 1
+        if data is not None and field_paths is not None:
+            data = {field: data[field] for field in field_paths if field in data}
+        return FakeDocumentSnapshot(self, data)
+
+    def _commit(self, operation: str, data=None):
+        self._client._rpc()
+        with self._client._lock:
+            self._client._write(operation, self._collection_path, self.id, data)
+
+    def set(self, document_data: Dict, merge: bool = False):
+        self._commit("merge" if merge else "set", document_data)
+
+    def create(self, document_data: Dict):
+        self._commit("create", document_data)
+
+    def update(self, field_updates: Dict):
+        self._commit("update", field_updates)
+
+    def delete(self):
+        self._commit("delete")
+
+
+class FakeQuery:
+    "Immutable query over one collection, like firestore's Query"
+
+    ASCENDING = "ASCENDING"
+    DESCENDING = "DESCENDING"
+
+    def __init__(
+        self,
+        client: FakeFirestoreClient,
+        path: str,
+        filters=(),
+        orders=(),
+        limit: int = None,
+        cursor=None,
+    ):
+        self._client = client
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._cursor = cursor
+
+    def _copy(self, **kwargs) -> "FakeQuery":
+        params = dict(
+            filters=self._filters,
+            orders=self._orders,
+            limit=self._limit,
+            cursor=self._cursor,
+        )
+        params.update(kwargs)
+        return FakeQuery(self._client, self._path, **params)
+
+    def where(self, field_path: str, op_string: str, value) -> "FakeQuery":
+        if op_string not in _operators:
+            raise ValueError(f"Unsupported operator {op_string}")
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING) -> "FakeQuery":
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> "FakeQuery":
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields) -> "FakeQuery":
+        "Accepts a snapshot or a dict with the values of the order_by fields"
+        if isinstance(document_fields, FakeDocumentSnapshot):
+            values = document_fields.to_dict()
+            document_id = document_fields.id
+        else:
+            values = document_fields
+            document_id = None
+        cursor = tuple(values[field] for field, _ in self._orders)
+        return self._copy(cursor=(cursor, document_id))
+
+    def _matches(self, data: Dict) -> bool:
+        for field, op, value in self._filters:
+            if field not in data or not _operators[op](data[field], value):
+                return False
+        # Documents without the order_by fields are left out, like in firestore
+        return all(field in data for field, _ in self._orders)
+
+    def _compare(self, a, b) -> int:
+        "Compares two (order values, document id) keys in the query's order"
+        (values_a, id_a), (values_b, id_b) = a, b
+        for (_, direction), x, y in zip(self._orders, values_a, values_b):
+            if x != y:
+                result = -1 if x < y else 1
+                return -result if direction == self.DESCENDING else result
+        if id_a is None or id_b is None or id_a == id_b:
+            return 0
+        return -1 if id_a < id_b else 1
+
+    def stream(self) -> Iterator[FakeDocumentSnapshot]:
+        self._client._rpc()
+        with self._client._lock:
+            documents = self._client._collections[self._path]
+            keyed = [
+                ((tuple(data[field] for field, _ in self._orders), document_id), data)
+                for document_id, data in documents.items()
+                if self._matches(data)
+            ]
+            keyed.sort(key=functools.cmp_to_key(lambda a, b: self._compare(a[0], b[0])))
+            if self._cursor is not None:
+                keyed = [(k, d) for k, d in keyed if self._compare(k, self._cursor) > 0]
+            if self._limit is not None:
+                keyed = keyed[: self._limit]
+            snapshots = [
+                FakeDocumentSnapshot(
+                    FakeDocumentReference(self._client, self._path, document_id),
+                    copy.deepcopy(data),
+                )
+                for (_, document_id), data in keyed
+            ]
+            # Queries are billed at least one read
+            self._client.nbr_reads += max(len(snapshots), 1)
+        return iter(snapshots)
+
+    def get(self) -> List[FakeDocumentSnapshot]:
+        return list(self.stream())
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client: FakeFirestoreClient, path: str):
+        super().__init__(client, path)
+
+    @property
+    def id(self) -> str:
+        return self._path.rsplit("/", 1)[-1]
+
+    def document(self, document_id: str = None) -> FakeDocumentReference:
+        if document_id is None:
+            document_id = _random_id()
+        return FakeDocumentReference(self._client, self._path, document_id)
+
+    def add(self, document_data: Dict):
+        reference = self.document()
+        reference.set(document_data)
+        return None, reference
+
+
+class FakeWriteBatch:
+    "Applies all writes atomically in one rpc on commit()"
+
+    def __init__(self, client: FakeFirestoreClient):
+        self._client = client
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def _add(self, operation: str, reference: FakeDocumentReference, data=None):
+        self._writes.append((operation, reference, data))
+
+    def set(self, reference: FakeDocumentReference, document_data: Dict, merge=False):
+        self._add("merge" if merge else "set", reference, document_data)
+
+    def create(self, reference: FakeDocumentReference, document_data: Dict):
+        self._add("create", reference, document_data)
+
+    def update(self, reference: FakeDocumentReference, field_updates: Dict):
+        self._add("update", reference, field_updates)
+
+    def delete(self, reference: FakeDocumentReference):
+        self._add("delete", reference)
+
+    def commit(self):
+        if len(self._writes) > max_batch_size:
+            raise InvalidArgument(f"A batch can contain at most {max_batch_size} writes")
+        self._client._rpc()
+        client = self._client
+        with client._lock:
+            # Check everything before writing so a failing batch changes nothing
+            exists = {}
+            for operation, reference, _ in self._writes:
+                documents = client._collections[reference._collection_path]
+                present = exists.get(reference.path, reference.id in documents)
+                if operation == "update" and not present:
+                    raise NotFound(f"No document to update: {reference.path}")
+                if operation == "create" and present:
+                    raise InvalidArgument(f"Document {reference.path} already exists")
+                exists[reference.path] = operation != "delete"
+            for operation, reference, data in self._writes:
+                client._write(operation, reference._collection_path, reference.id, data)
+        self._writes = []
@@ -0,0 +1,51 @@
+import os
+import random
+
+""" Latency distributions and error rates for the fake upstreams.
+
+A latency is configured as "distribution:arg1:arg2" in seconds, e.g.
+    constant:0.1
+    uniform:0.05:0.2        (low, high)
+    normal:0.3:0.05         (mean, std)
+    lognormal:0.3:0.5       (median, sigma)
+    exponential:0.2         (mean)
+"""
+
+distributions = {
+    "constant": lambda value: value,
+    "uniform": random.uniform,
+    "normal": lambda mean, std: max(random.gauss(mean, std), 0.0),
+    "lognormal": lambda median, sigma: median * random.lognormvariate(0, sigma),
+    "exponential": lambda mean: random.expovariate(1 / mean) if mean > 0 else 0.0,
+}
+
+
+class LatencyProfile:
+    "Samples how long a fake upstream takes to respond and whether it fails"
+
+    def __init__(self, latency: str = "constant:0", error_rate: float = 0.0):
+        name, *args = latency.split(":")
+        if name not in distributions:
+            raise ValueError(f"Unknown latency distribution {name}")
+        self.latency = latency
+        self._sample = distributions[name]
+        self._args = [float(arg) for arg in args]
+        self.error_rate = error_rate
+
+    @classmethod
+    def from_env(cls, prefix: str, latency: str = "constant:0", error_rate: float = 0.0):
+        "Reads {prefix}_LATENCY and {prefix}_ERROR_RATE"
+        return cls(
+            latency=os.environ.get(f"{prefix}_LATENCY", latency),
+            error_rate=float(os.environ.get(f"{prefix}_ERROR_RATE", error_rate)),
+        )
+
+    def sample(self) -> float:
+        "Seconds to wait before responding"
+        return self._sample(*self._args)
+
+    def fails(self) -> bool:
+        return random.random() < self.error_rate
+
+    def __repr__(self):
+        return f"LatencyProfile({self.latency}, error_rate={self.error_rate})"
@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+from aiohttp import web
+from chat.fakes.latency import LatencyProfile
+from chat.hardcoded_messages import rasa
+
+""" Local stand-ins for the model services, for load testing without the real upstreams.
+
+One server answers for all of them:
+    POST /inference             interview and fika model
+    POST /model/parse           rasa nlu
+    POST /models/{model}        huggingface inference api
+    GET  /                      wake up calls
+
+Start it with
+    python -m chat.fakes.servers --port 8001
+and point the backend at it:
+    INTERVIEW_MODEL_URL=http://localhost:8001
+    FIKA_MODEL_URL=http://localhost:8001
+    RASA_NLU_URL=http://localhost:8001
+    HUGGINGFACE_FIKA_MODEL_URL=http://localhost:8001/models/facebook/blenderbot-400M-distill
+
+Latencies and error rates are set per service with FAKE_INFERENCE_*, FAKE_RASA_* and FAKE_HUGGINGFACE_*,
+see chat.fakes.latency. FAKE_RASA_INTENT_RATE is the share of messages rasa classifies with a confident intent.
+"""
+
+model_replies = [
+    "What did you learn from that?",
+    "Why do you want to work here?",
+    "How would your colleagues describe you?",
+    "That sounds interesting. What happened next?",
+    "What do you do on a normal day at work?",
+    "I like that. How did you handle it?",
+]
+
+
+class FakeUpstreams:
+    "Request handlers of the fake model services"
+
+    def __init__(self):
+        self.profiles = {
+            "inference": LatencyProfile.from_env("FAKE_INFERENCE", "lognormal:0.5:0.3"),
+            "rasa": LatencyProfile.from_env("FAKE_RASA", "lognormal:0.1:0.3"),
+            "huggingface": LatencyProfile.from_env(
+                "FAKE_HUGGINGFACE", "lognormal:1.0:0.3"
+            ),
+        }
+        self.intent_rate = float(os.environ.get("FAKE_RASA_INTENT_RATE", 0.1))
+        self.nbr_requests = 0
+
+    async def _respond(self, service: str, data) -> web.Response:
+        profile = self.profiles[service]
+        self.nbr_requests += 1
+        await asyncio.sleep(profile.sample())
+        if profile.fails():
+            return web.json_response({"error": "Fake upstream error"}, status=500)
+        return web.json_response(data)
+
+    async def inference(self, request: web.Request) -> web.Response:
+        await request.json()
+        return await self._respond("inference", {"text": random.choice(model_replies)})
+
+    async def parse(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if random.random() < self.intent_rate:
+            name, confidence = random.choice(list(rasa.replies)), 0.99
+        else:
+            name, confidence = "", 0
+        intent = {"id": "", "name": name, "confidence": confidence}
+        return await self._respond("rasa", {"text": body["text"], "intent": intent})
+
+    async def huggingface(self, request: web.Request) -> web.Response:
+        await request.json()
+        reply = random.choice(model_replies).lower()
+        return await self._respond("huggingface", {"generated_text": reply})
+
+    async def wake_up(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "awake"})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/inference", self.inference)
+        app.router.add_post("/model/parse", self.parse)
+        app.router.add_post("/models/{model:.+}", self.huggingface)
+        app.router.add_get("/", self.wake_up)
+        return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake model services for load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    upstreams = FakeUpstreams()
+    logging.info(f"Fake upstreams: {upstreams.profiles}")
+    web.run_app(upstreams.app(), host=args.host, port=args.port, access_log=None)
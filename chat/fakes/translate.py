@@ -0,0 +1,49 @@
+import time
+from typing import Dict, List, Union
+from chat.fakes.latency import LatencyProfile
+
+""" Stand-in for google.cloud.translate_v2.Client. Enabled in ChatTranslator with USE_FAKE_TRANSLATE=1.
+
+Texts aren't translated, they're returned as they are after the configured latency
+(FAKE_TRANSLATE_LATENCY, FAKE_TRANSLATE_ERROR_RATE).
+"""
+
+
+class FakeTranslateError(Exception):
+    pass
+
+
+class FakeTranslateClient:
+    "Has the same translate() signature as the google translate client"
+
+    def __init__(self, profile: LatencyProfile = None):
+        if profile is None:
+            profile = LatencyProfile.from_env("FAKE_TRANSLATE", "lognormal:0.08:0.3")
+        self.profile = profile
+        self.nbr_requests = 0
+
+    def translate(
+        self,
+        values: Union[str, List[str]],
+        target_language: str = None,
+        format_: str = None,
+        source_language: str = None,
+        **kwargs,
+    ) -> Union[Dict, List[Dict]]:
+        "Blocks like the real client. Returns one dict per text with the 'translatedText'"
+        self.nbr_requests += 1
+        time.sleep(self.profile.sample())
+        if self.profile.fails():
+            raise FakeTranslateError("Fake translation error")
+
+        single = isinstance(values, str)
+        texts = [values] if single else values
+        results = [
+            {
+                "translatedText": text,
+                "input": text,
+                "detectedSourceLanguage": source_language,
+            }
+            for text in texts
+        ]
+        return results[0] if single else results
@@ -1,6 +1,7 @@
 from chat.data.types import Conversation, BotMessage
 from chat.dialog.models import FikaModel, HuggingfaceFika
-from chat.hardcoded_messages import greetings, goodbyes
+from chat.hardcoded_messages import greetings, goodbyes, fallbacks
+from chat.dialog.breaker import log_model_failure
 import logging
 import os
 
@@ -32,27 +33,25 @@ class FikaFlowHandler:
         self.goodbye_words = goodbye_words
         self.persona = random.choice(personas)
 
-    def act(self, conversation: Conversation):
+    async def act(self, conversation: Conversation):
         "Requests response from fika model"
-        last_user_message = conversation.get_last_x_message_strings(1)
-        if (
-            any([word in last_user_message for word in self.goodbye_words])
-            or conversation.nbr_messages > max_dialog_length
-        ):
+        if self._is_goodbye(conversation):
             return self.goodbye(conversation)
 
-        context = self.persona + conversation.get_last_x_message_strings(
-            fika_model_context_length
-        )
-        if conversation.use_huggingface:
+        model, args = self._model_call(conversation)
+        try:
             try:
-                model_reply, response_time = self.huggingface_fika_model.get_response(
-                    context
+                model_reply, response_time = await model.get_response(*args)
+            except Exception:
+                if model is not self.huggingface_fika_model:
+                    raise
+                context = args[0]
+                model_reply, response_time = await self.fika_model.get_response(
+                    context, fika_block_list
                 )
-            except:
-                model_reply, response_time = self.fika_model.get_response(context, fika_block_list)
-        else:
-            model_reply, response_time = self.fika_model.get_response(context, fika_block_list)
+        except Exception as e:
+            log_model_failure(self.fika_model, e)
+            return self.fallback(conversation)
         reply = BotMessage(
             lang="en",
             text=model_reply,
@@ -68,10 +67,43 @@ class FikaFlowHandler:
 
         return reply
 
+    def plan_model_call(self, conversation: Conversation):
+        """Returns the (model, args) that act() will call model.get_response with for the conversation,
+        or None if act() won't call a model. Used to start the model call speculatively"""
+        if self._is_goodbye(conversation):
+            return None
+        return self._model_call(conversation)
+
+    def _is_goodbye(self, conversation: Conversation) -> bool:
+        last_user_message = conversation.get_last_x_message_strings(1)
+        return (
+            any([word in last_user_message for word in self.goodbye_words])
+            or conversation.nbr_messages > max_dialog_length
+        )
+
+    def _model_call(self, conversation: Conversation):
+        context = self.persona + conversation.get_last_x_message_strings(
+            fika_model_context_length
+        )
+        if conversation.use_huggingface:
+            return self.huggingface_fika_model, (context,)
+        return self.fika_model, (context, fika_block_list)
+
     def transition_to_new_subject(self, conversation):
         "Used to get a hardcoded message for 'changing the subject' if Emely gets stuck saying the same stuff"
         pass
 
+    def fallback(self, conversation: Conversation) -> BotMessage:
+        "Hardcoded reply for when the fika model can't be reached"
+        return BotMessage(
+            lang="sv",
+            text=random.choice(fallbacks.fika),
+            response_time=0.0,
+            is_hardcoded=True,
+            filtered_reason="model_unavailable",
+            filtered_message="",
+        )
+
     def goodbye(self, conversation: Conversation):
         conversation.episode_done = True
         goodbye = random.choice(goodbyes.fika)
@@ -71,3 +71,6 @@ badwords = [
     "nazisternas",
     "nazistens",
 ]
+
+# Word lists used by the toxicity filter, by language
+badwords_by_lang = {"sv": badwords}
@@ -0,0 +1,7 @@
+# Used when the fika model can't be reached
+fika = [
+    "Vad spännande! Berätta gärna mer.",
+    "Det låter intressant. Hur kändes det?",
+    "Förlåt, jag tappade tråden lite. Vad tycker du om att göra på fritiden?",
+    "Jaså? Vad hände sen?",
+]
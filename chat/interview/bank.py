@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+from chat.hardcoded_messages import greetings, rasa
+
+"""
+Compiled question bank.
+
+questions.xlsx and question_generator.config are the authoring formats. They are compiled into
+questions.json, a validated artifact that the application loads in milliseconds without pandas or openpyxl.
+
+Compile after editing the spreadsheet or the config:
+    python -m chat.interview.bank
+"""
+
+directory = Path(__file__).resolve().parent
+default_spreadsheet = directory / "questions.xlsx"
+default_config = directory / "question_generator.config"
+default_artifact = directory / "questions.json"
+
+artifact_version = 1
+flag_columns = [
+    "tough",
+    "fit_4_no_exp",
+    "always",
+    "personal",
+    "fit_as_first",
+    "fit_as_last",
+    "fit_4_general",
+]
+
+
+def source_hash(spreadsheet: Path, config: Path) -> str:
+    "Hash of the authoring files. Used to detect a stale artifact"
+    sha = hashlib.sha256()
+    for path in [spreadsheet, config]:
+        sha.update(Path(path).read_bytes())
+    return sha.hexdigest()
+
+
+def validate(rows: List[Dict], config: Dict):
+    "Raises ValueError if the questions are malformed"
+    nbr_alternatives = config["nbr_alternatives"]
+    columns = ["job", "transition"] + flag_columns
+    columns += [f"alt_{j+1}" for j in range(nbr_alternatives)]
+
+    for i, row in enumerate(rows):
+        # Check for missing values
+        for column in columns:
+            if row.get(column) is None or row[column] != row[column]:
+                raise ValueError(f"Missing value in row {i}, column {column}")
+        for flag in flag_columns:
+            if row[flag] not in (0, 1):
+                raise ValueError(f"{flag} has to be 0 or 1 in row {i}")
+
+        alternatives = [row[f"alt_{j+1}"] for j in range(nbr_alternatives)]
+        # Check lowercase for ","-transition
+        if row["transition"][-1] == ",":
+            if not all(alt[0].islower() for alt in alternatives):
+                raise ValueError(f"Row {i}: questions after a ',' must be lowercase")
+        # Check uppercase for "."-transition
+        if row["transition"][-1] == ".":
+            if not all(alt[0].isupper() for alt in alternatives):
+                raise ValueError(f"Row {i}: questions after a '.' must be uppercase")
+
+
+def question_phrasings(transition: str, question: str) -> List[str]:
+    "Returns all the ways InterviewFlowHandler can put a question alternative into a message"
+    return [
+        question,
+        # InterviewFlowHandler.transition_to_next_block
+        transition + " " + question,
+        rasa.dont_understand_transition + " " + question,
+        # InterviewFlowHandler.get_new_question
+        rasa.dont_understand_other_formulation + " " + question,
+        # InterviewFlowHandler.transition_to_first_question
+    ] + [first_transition + question for first_transition in greetings.first_transition]
+
+
+def compile_question_bank(
+    spreadsheet: Path = default_spreadsheet,
+    config: Path = default_config,
+    artifact: Path = default_artifact,
+):
+    "Reads the spreadsheet and config, validates them and writes the artifact"
+    # Only needed at build time
+    import pandas as pd
+
+    with open(config, "r") as file:
+        config_data = json.load(file)
+
+    df = pd.read_excel(spreadsheet, engine="openpyxl")
+    if df.isnull().values.any():
+        raise ValueError("The question spreadsheet has missing values")
+    rows = [
+        {k: (int(v) if k in flag_columns else str(v)) for k, v in row.items()}
+        for row in df.to_dict("records")
+    ]
+    validate(rows, config_data)
+
+    columns = list(df.columns)
+    data = {
+        "version": artifact_version,
+        "source_hash": source_hash(spreadsheet, config),
+        "config": config_data,
+        "columns": columns,
+        "rows": [[row[c] for c in columns] for row in rows],
+    }
+    # Written to a temporary file that replaces the old artifact, so a starting server never reads half of it
+    artifact = Path(artifact)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=artifact.parent, prefix=artifact.name, suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, artifact)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    logging.info(f"Compiled {len(rows)} questions to {artifact}")
+
+
+class QuestionBank:
+    """All interview questions and the question generator config, loaded from the compiled artifact.
+
+    Attributes:
+        config (Dict): contents of question_generator.config
+        rows (List[Dict]): one dict per question with the spreadsheet's columns as keys
+    """
+
+    def __init__(self, artifact: Path = default_artifact):
+        data = self._load(Path(artifact))
+        if data["version"] != artifact_version:
+            raise ValueError(f"Unsupported question bank version {data['version']}")
+
+        self.config = data["config"]
+        self.nbr_alternatives = self.config["nbr_alternatives"]
+        self.rows = [dict(zip(data["columns"], row)) for row in data["rows"]]
+        self.alternatives = [
+            [row[f"alt_{j+1}"] for j in range(self.nbr_alternatives)]
+            for row in self.rows
+        ]
+
+    def _load(self, artifact: Path) -> Dict:
+        """Loads the artifact. It's never compiled here, the serving processes would race to write it and
+        need pandas. If the spreadsheet has been edited since it was compiled, the old artifact is used"""
+        if not artifact.exists():
+            raise FileNotFoundError(
+                f"No question bank at {artifact}. Compile it with: python -m chat.interview.bank"
+            )
+        with open(artifact, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        if artifact == default_artifact and default_spreadsheet.exists():
+            current_hash = source_hash(default_spreadsheet, default_config)
+            if data.get("source_hash") != current_hash:
+                logging.error(
+                    "The question bank is older than the spreadsheet, using it anyway. "
+                    "Recompile it with: python -m chat.interview.bank"
+                )
+
+        return data
+
+    def get_job_list(self) -> List[str]:
+        "Returns the jobs with questions, in the order they appear in the spreadsheet"
+        jobs = []
+        for row in self.rows:
+            if row["job"] not in jobs:
+                jobs.append(row["job"])
+        return jobs
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    compile_question_bank()
@@ -1,11 +1,11 @@
 from chat.data.types import Conversation, BotMessage
 from chat.dialog.models import InterviewModel, FikaModel, HuggingfaceFika
 from chat.dialog.filters import is_too_repetitive, contains_question
+from chat.dialog.breaker import log_model_failure
 from chat.hardcoded_messages import greetings, goodbyes, rasa
 import logging
 import os
-from pathlib import Path
-import pandas as pd
+from chat.interview.bank import QuestionBank, question_phrasings
 
 import random
 
@@ -17,6 +17,13 @@ general_question_max_length = 2
 job_question_max_length = 2
 small_talk_max_length = 2
 
+question_block_max_lengths = {
+    "tough": tough_question_max_length,
+    "personal": personal_question_max_length,
+    "job": job_question_max_length,
+    "general": general_question_max_length,
+}
+
 interview_model_context_length = 8
 fika_model_context_length = 4
 
@@ -53,14 +60,16 @@ small_talk_block_list = [
 class InterviewFlowHandler:
     "Object that encapsulates all methods relating to dialog flow"
 
-    def __init__(self):
+    def __init__(self, question_bank: QuestionBank = None):
         self.interview_model = InterviewModel()
         self.fika_model = FikaModel()
         self.huggingface_fika_model = HuggingfaceFika()
-        p = Path(__file__).resolve().parent / "questions.xlsx"
-        self.question_df = pd.read_excel(p)
+        if question_bank is None:
+            question_bank = QuestionBank()
+        self.question_bank = question_bank
+        self._build_rephrase_index()
 
-    def act(self, conversation: Conversation):
+    async def act(self, conversation: Conversation):
         """All of the methods in this class should filter the the message
         and possible return something appropirate (transition to next question?)
         if it's too short or otherwise doesn't pass the filter"""
@@ -73,32 +82,18 @@ class InterviewFlowHandler:
         if current_dialog_block == "greet":
             if conversation.enable_small_talk:
                 conversation.current_dialog_block = "small_talk"
-                bot_message = self.small_talk_block(conversation)
+                bot_message = await self.small_talk_block(conversation)
             else:
                 bot_message = self.transition_to_next_block(conversation)
 
-        elif current_dialog_block == "tough":
-            bot_message = self.question_block(
-                conversation, max_length=tough_question_max_length
-            )
-
-        elif current_dialog_block == "personal":
-            bot_message = self.question_block(
-                conversation, max_length=personal_question_max_length
-            )
-
-        elif current_dialog_block == "job":
-            bot_message = self.question_block(
-                conversation, max_length=job_question_max_length
-            )
-
-        elif current_dialog_block == "general":
-            bot_message = self.question_block(
-                conversation, max_length=general_question_max_length
+        elif current_dialog_block in question_block_max_lengths:
+            bot_message = await self.question_block(
+                conversation,
+                max_length=question_block_max_lengths[current_dialog_block],
             )
 
         elif current_dialog_block == "small_talk":
-            bot_message = self.small_talk_block(conversation)
+            bot_message = await self.small_talk_block(conversation)
 
         else:
             raise ValueError("Unknown dialog block")
@@ -108,6 +103,42 @@ class InterviewFlowHandler:
 
         return bot_message
 
+    def plan_model_call(self, conversation: Conversation):
+        """Returns the (model, args) that act() will call model.get_response with for the conversation,
+        or None if act() won't call a model. Used to start the model call speculatively"""
+        current_dialog_block = conversation.current_dialog_block
+        if conversation.episode_done:
+            return None
+
+        if current_dialog_block == "greet" and conversation.enable_small_talk:
+            return self._small_talk_call(conversation)
+
+        elif current_dialog_block in question_block_max_lengths:
+            max_length = question_block_max_lengths[current_dialog_block]
+            if conversation.current_dialog_block_length <= max_length:
+                return self._interview_call(conversation)
+
+        elif current_dialog_block == "small_talk":
+            if conversation.current_dialog_block_length < small_talk_max_length:
+                return self._small_talk_call(conversation)
+
+        return None
+
+    def _interview_call(self, conversation: Conversation):
+        context = conversation.get_last_x_message_strings(
+            interview_model_context_length
+        )
+        return self.interview_model, (context, interview_block_list)
+
+    def _small_talk_call(self, conversation: Conversation):
+        # Context is Emelys persona + the conversaiton so far
+        context = small_talk_persona + conversation.get_last_x_message_strings(
+            fika_model_context_length
+        )
+        if conversation.use_huggingface:
+            return self.huggingface_fika_model, (context,)
+        return self.fika_model, (context, small_talk_block_list)
+
     def transition_to_next_block(
         self,
         conversation: Conversation,
@@ -142,7 +173,7 @@ class InterviewFlowHandler:
         else:
             return self.goodbye_block(conversation)
 
-    def question_block(self, conversation: Conversation, max_length) -> BotMessage:
+    async def question_block(self, conversation: Conversation, max_length) -> BotMessage:
         """Handles a question_block by:
         1. Checking if it's time to transition: true -> transition_to_next_block
         2. Requests inference from interview model
@@ -154,12 +185,15 @@ class InterviewFlowHandler:
 
         else:
             # Action
-            context = conversation.get_last_x_message_strings(
-                interview_model_context_length
-            )
-            model_reply, response_time = self.interview_model.get_response(
-                context, interview_block_list
-            )
+            model, args = self._interview_call(conversation)
+            try:
+                model_reply, response_time = await model.get_response(*args)
+            except Exception as e:
+                # Move on with a hardcoded question instead of waiting for an upstream that's down
+                log_model_failure(model, e)
+                return self.transition_to_next_block(
+                    conversation, filtered_reason="model_unavailable"
+                )
             reply = BotMessage(
                 lang="en",
                 text=model_reply,
@@ -182,30 +216,27 @@ class InterviewFlowHandler:
 
             return reply
 
-    def small_talk_block(self, conversation: Conversation) -> BotMessage:
+    async def small_talk_block(self, conversation: Conversation) -> BotMessage:
         "First block of small talk. Uses the fika model instead of the Interview Model"
         if conversation.current_dialog_block_length >= small_talk_max_length:
             return self.transition_to_first_question(conversation)
 
         else:
-            # Context is Emelys persona + the conversaiton so far
-            context = small_talk_persona + conversation.get_last_x_message_strings(
-                fika_model_context_length
-            )
-            if conversation.use_huggingface:
+            model, args = self._small_talk_call(conversation)
+            try:
                 try:
-                    (
-                        model_reply,
-                        response_time,
-                    ) = self.huggingface_fika_model.get_response(context)
-                except:
-                    model_reply, response_time = self.fika_model.get_response(
+                    model_reply, response_time = await model.get_response(*args)
+                except Exception:
+                    if model is not self.huggingface_fika_model:
+                        raise
+                    context = args[0]
+                    model_reply, response_time = await self.fika_model.get_response(
                         context, small_talk_block_list
                     )
-            else:
-                model_reply, response_time = self.fika_model.get_response(
-                    context, small_talk_block_list
-                )
+            except Exception as e:
+                # Skip the rest of the small talk if the fika model is down
+                log_model_failure(self.fika_model, e)
+                return self.transition_to_first_question(conversation)
             reply = BotMessage(
                 lang="en",
                 text=model_reply,
@@ -299,8 +330,7 @@ class InterviewFlowHandler:
                         text = self.get_new_question(last_question)
                     except Exception as e:
                         logging.warning(
-                            "Encountered problem during InterviewFlowHandler.get_new_question():\n",
-                            e,
+                            f"Encountered problem during InterviewFlowHandler.get_new_question(): {e}"
                         )
                         transition_message = rasa.dont_understand_transition
                         return self.transition_to_next_block(
@@ -328,29 +358,45 @@ class InterviewFlowHandler:
             filtered_message="",
         )
 
+    def _build_rephrase_index(self):
+        """Maps every way a question can be asked to an alternative formulation of it,
+        so rephrasing a question is a dict lookup. The rephrasings are in the translator's phrase table"""
+        self.rephrase_index = {}
+        bank = self.question_bank
+        for row, alternatives in zip(bank.rows, bank.alternatives):
+            for alt in alternatives:
+                for question in question_phrasings(row["transition"], alt):
+                    if question not in self.rephrase_index:
+                        self.rephrase_index[question] = self._rephrase(
+                            question, alternatives
+                        )
+
+    def _rephrase(self, question: str, question_alternatives) -> str:
+        "Picks another version of the question and concatenates it with rasa.dont_understand_other_formulation"
+        new_transition = rasa.dont_understand_other_formulation
+        new_question = None
+        for alt_q in question_alternatives:
+            if alt_q not in question:
+                new_question = alt_q
+
+        if new_question is None:
+            new_question = question
+
+        return new_transition + " " + new_question
+
     def get_new_question(self, question: str) -> str:
         """This funtion should
-        1. Find the question in the question dataframe
+        1. Find the question in the question bank
         2. Pick another version of the question
         3. Concatenate with the rasa.dont_understand_other_formulation"""
-        all_questions = self.question_df[["alt_1", "alt_2", "alt_3"]].copy()
-        idx = None
-        for i, alts in all_questions.iterrows():
-            if any([alt in question for alt in alts]):
-                idx = i
-                break
-        if idx is None:
-            logging.warning("Couldn't find the question in the dataframe...")
-            return question
-        else:
-            new_transition = rasa.dont_understand_other_formulation
-            question_alternatives = all_questions.loc[idx]
-            new_question = None
-            for alt_q in question_alternatives:
-                if alt_q not in question:
-                    new_question = alt_q
+        rephrasing = self.rephrase_index.get(question)
+        if rephrasing is not None:
+            return rephrasing
 
-            if new_question is None:
-                new_question = question
+        # Questions that aren't phrased the way the flow handler phrases them are searched for
+        for question_alternatives in self.question_bank.alternatives:
+            if any([alt in question for alt in question_alternatives]):
+                return self._rephrase(question, question_alternatives)
 
-            return new_transition + " " + new_question
+        logging.warning("Couldn't find the question in the question bank...")
+        return question
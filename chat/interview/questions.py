@@ -1,11 +1,10 @@
-import pandas as pd
-from pathlib import Path
+import numpy as np
 from typing import List, Dict
 import random
-import json
 import copy
 import os
 import logging
+from chat.interview.bank import QuestionBank
 
 """
 Class for generating interview questions.
@@ -26,16 +25,11 @@ Print example usage:
 
 
 class QuestionGenerator:
-    def __init__(
-        self, some_file="questions.xlsx", some_config="question_generator.config"
-    ):
-        self.question_df = pd.read_excel(
-            Path(__file__).resolve().parent / some_file, engine="openpyxl"
-        )
-        self.question_df["question_id"] = self.question_df.index
-
-        with open(Path(__file__).resolve().parent / some_config, "r") as file:
-            config = json.load(file)
+    def __init__(self, bank: QuestionBank = None):
+        if bank is None:
+            bank = QuestionBank()
+        self.bank = bank
+        config = bank.config
 
         # Set the number of different questions
         self.config = {
@@ -49,37 +43,47 @@ class QuestionGenerator:
         nbr_interview_questions = sum(self.config.values())
         os.environ["NBR_INTERVIEW_QUESTIONS"] = str(nbr_interview_questions)
 
-        self.nbr_alternatives = config["nbr_alternatives"]
-
-        # Temporary variables used in question generation
-        self.candidate_questions = None
-        self.temp_config = None
-
-        # Check for missing values
-        assert self.question_df.isnull().values.any() == False
-        for i in range(self.question_df.shape[0]):
-            # Check lowercase for ","-transition
-            if self.question_df.loc[i, "transition"][-1] == ",":
-                for j in range(self.nbr_alternatives):
-                    assert self.question_df.loc[i, f"alt_{str(j+1)}"][0].islower()
-            # Check uppercase for "."-transition
-            if self.question_df.loc[i, "transition"][-1] == ".":
-                for j in range(self.nbr_alternatives):
-                    assert self.question_df.loc[i, f"alt_{str(j+1)}"][0].isupper()
+        self.nbr_alternatives = bank.nbr_alternatives
+
+        self._build_index()
+
+    def _build_index(self):
+        """Precomputes one boolean array per question property, so generating questions
+        only combines arrays. The questions are validated when the bank is compiled"""
+        self.rows = self.bank.rows
+        self.jobs = np.array([row["job"] for row in self.rows])
+        self.index = {
+            flag: np.array([row[flag] == 1 for row in self.rows], dtype=bool)
+            for flag in [
+                "tough",
+                "always",
+                "personal",
+                "fit_as_first",
+                "fit_as_last",
+                "fit_4_no_exp",
+                "fit_4_general",
+            ]
+        }
+        self.index["general_job"] = self.jobs == "Allmän"
+        self.job_index = {job: self.jobs == job for job in set(self.jobs)}
 
     """
     Main function of generating interview questions.
     The questions are generated semi-stochastically, using the nbr_x_questions-parameters, in the following way:
         - Filter away all questions for other jobs, and those for people with experience, if the interviewee has no experience.
-        - Pick the first and last question from the dataframe among questions fulfilling fit_as_first or fit_as_last.
-        - Remove these questions from the dataframe, and decrease the corresponding types self.nbr_x_questions with one.
+        - Pick the first and last question among questions fulfilling fit_as_first or fit_as_last.
+        - Remove these questions from the candidates, and decrease the corresponding types nbr_x_questions with one.
         - Create a random order for the intermediate questions with the remaining types.
-        - For each type in the generated order, retreive a corresponding question from all questions that fulfill the criterion, and remove it from the dataframe.
+        - For each type in the generated order, retreive a corresponding question from all questions that fulfill the criterion, and remove it from the candidates.
     When generating each question, one of self.nbr_alternatives alternatives is chosen randomly.
 
+    All state of a generation lives in local variables and a per-call random generator,
+    so it's safe to generate questions for concurrent requests.
+
     Parameters:
         job     (str): Job type of the interview
         no_exp  (bool): Indicates if the interviewee has any previous job experience
+        seed    (int): Optional seed for reproducible question lists
 
     Example question:
         question = {
@@ -89,35 +93,28 @@ class QuestionGenerator:
             }
     """
 
-    def get_interview_questions(self, job, no_exp=False) -> List[Dict[str, str]]:
+    def get_interview_questions(
+        self, job, no_exp=False, seed=None
+    ) -> List[Dict[str, str]]:
         """Returns list of dicts with keys question, label, transition"""
+        rng = random.Random(seed)
 
         # Copy config
-        self.temp_config = copy.copy(self.config)
+        config = copy.copy(self.config)
 
         # Remove irrelevant questions
-        self.candidate_questions = self.question_df[
-            (self.question_df.loc[:, "job"] == job)
-            | (self.question_df.loc[:, "job"] == "Allmän")
-        ].copy()
+        candidates = self.index["general_job"].copy()
+        if job in self.job_index:
+            candidates |= self.job_index[job]
         if no_exp:
-            self.candidate_questions = self.candidate_questions[
-                self.candidate_questions.loc[:, "fit_4_no_exp"] == True
-            ]
+            candidates &= self.index["fit_4_no_exp"]
 
         # If job does not exist assume "Allmän intervjuträning"
-        if (
-            job not in set(self.question_df.loc[:, "job"])
-            or job == "Allmän intervjuträning"
-        ):
-            self.candidate_questions = self.candidate_questions[
-                self.candidate_questions.loc[:, "fit_4_general"] == 1
-            ]
-            self.temp_config["nbr_random_questions"] += (
-                self.temp_config["nbr_job_questions"] + 1
-            )
-            self.temp_config["nbr_job_questions"] = 0
-            self.temp_config[
+        if job not in self.job_index or job == "Allmän intervjuträning":
+            candidates &= self.index["fit_4_general"]
+            config["nbr_random_questions"] += config["nbr_job_questions"] + 1
+            config["nbr_job_questions"] = 0
+            config[
                 "nbr_always_questions"
             ] -= 1  # In this case we currently only have one "always"-question
 
@@ -125,31 +122,35 @@ class QuestionGenerator:
         question_list = []
 
         # Append the first question
-        first_question = self.get_first_question(
-            random.randint(1, self.nbr_alternatives)
+        first_question = self._pick_question(
+            candidates & self.index["fit_as_first"], candidates, config, rng
         )
         question_list.append(first_question)
 
         # Generate the last question
-        last_question = self.get_last_question(random.randint(1, self.nbr_alternatives))
+        last_mask = candidates & self.index["fit_as_last"]
+        # Make sure two random questions are not taken if only one is allowed
+        if config["nbr_random_questions"] == 0 and config["nbr_personal_questions"] > 0:
+            last_mask &= self.index["personal"]
+        last_question = self._pick_question(last_mask, candidates, config, rng)
 
         # Create a random order of remaining question types
         question_order = []
-        for _ in range(self.temp_config["nbr_always_questions"]):
+        for _ in range(config["nbr_always_questions"]):
             question_order.append("always")
-        for _ in range(self.temp_config["nbr_personal_questions"]):
+        for _ in range(config["nbr_personal_questions"]):
             question_order.append("personal")
-        for _ in range(self.temp_config["nbr_job_questions"]):
+        for _ in range(config["nbr_job_questions"]):
             question_order.append("job")
-        for _ in range(self.temp_config["nbr_random_questions"]):
+        for _ in range(config["nbr_random_questions"]):
             question_order.append("random")
-        random.shuffle(question_order)
+        rng.shuffle(question_order)
 
         # Append intermediate questions
         for question_type in question_order:
             try:
-                next_question = self.get_intermediate_question(
-                    random.randint(1, self.nbr_alternatives), question_type
+                next_question = self._pick_question(
+                    candidates & self._type_mask(question_type), candidates, config, rng
                 )
                 question_list.append(next_question)
             except Exception as e:
@@ -164,102 +165,63 @@ class QuestionGenerator:
         return question_list
 
     """
-    Retrieve the first question in the conversation
-    """
-
-    def get_first_question(self, alt_id) -> Dict[str, str]:
-        temp_df = self.candidate_questions[
-            self.candidate_questions.loc[:, "fit_as_first"] == 1
-        ]
-        return self.get_random_question_from_df(temp_df, alt_id)
-
-    """
-    Retreive an intermediate question of a specific type
+    Mask of the questions that fit an intermediate question type
     """
 
-    def get_intermediate_question(self, alt_id, question_type) -> Dict[str, str]:
+    def _type_mask(self, question_type) -> np.ndarray:
         if question_type == "always":
-            temp_df = self.candidate_questions[
-                self.candidate_questions.loc[:, "always"] == 1
-            ]
+            return self.index["always"]
         elif question_type == "personal":
-            temp_df = self.candidate_questions[
-                self.candidate_questions.loc[:, "personal"] == 1
-            ]
+            return self.index["personal"]
         elif question_type == "job":
-            temp_df = self.candidate_questions[
-                self.candidate_questions.loc[:, "job"] != "Allmän"
-            ]
+            return ~self.index["general_job"]
         else:  # type==random
-            temp_df = self.candidate_questions[
-                self.candidate_questions.loc[:, "always"] == 0
-            ]
-        return self.get_random_question_from_df(temp_df, alt_id)
+            return ~self.index["always"]
 
     """
-    Retrieve the last question in the conversation
+    Picks a random question among the masked ones and removes it from the candidates
     """
 
-    def get_last_question(self, alt_id) -> Dict[str, str]:
-        temp_df = self.candidate_questions[
-            self.candidate_questions.loc[:, "fit_as_last"] == 1
-        ]
-        # Make sure two random questions are not taken if only one is allowed
-        if (
-            self.temp_config["nbr_random_questions"] == 0
-            and self.temp_config["nbr_personal_questions"] > 0
-        ):
-            temp_df = temp_df[temp_df.personal == 1]
-        return self.get_random_question_from_df(temp_df, alt_id)
+    def _pick_question(self, mask, candidates, config, rng) -> Dict[str, str]:
+        question_ids = np.flatnonzero(mask)
+        if len(question_ids) == 0:
+            raise ValueError("No candidate questions left")
+        question_id = question_ids[rng.randrange(len(question_ids))]
+        alt_id = rng.randint(1, self.nbr_alternatives)
 
-    """
-    Retreive a random question from a dataframe formatted
-    """
+        # Discard the question
+        candidates[question_id] = False
 
-    def get_random_question_from_df(self, temp_df, alt_id) -> Dict[str, str]:
-        rand_idx = random.randint(0, temp_df.shape[0] - 1)
-        question_row = temp_df.iloc[rand_idx, :]
-        label = self.get_label(question_row)
-        self.discard_question(question_row.question_id)
+        row = self.rows[question_id]
         return {
-            "question": question_row.loc[f"alt_{str(alt_id)}"],
-            "label": label,
-            "transition": question_row.loc["transition"],
+            "question": row[f"alt_{str(alt_id)}"],
+            "label": self._get_label(question_id, config),
+            "transition": row["transition"],
         }
 
     """
-    Retreive the appropriate label for a specific question
+    Retreive the appropriate label for a specific question and decrease the count of its type
     """
 
-    def get_label(self, question_row) -> str:
-        if question_row.loc["always"] == 1:
-            self.temp_config["nbr_always_questions"] -= 1
+    def _get_label(self, question_id, config) -> str:
+        if self.index["always"][question_id]:
+            config["nbr_always_questions"] -= 1
             return "general"
-        elif question_row.loc["personal"] == 1:
-            self.temp_config["nbr_personal_questions"] -= 1
+        elif self.index["personal"][question_id]:
+            config["nbr_personal_questions"] -= 1
             return "personal"
-        elif question_row.loc["job"] != "Allmän":
-            self.temp_config["nbr_job_questions"] -= 1
+        elif not self.index["general_job"][question_id]:
+            config["nbr_job_questions"] -= 1
             return "job"
-        elif question_row.loc["tough"] == 1:
-            self.temp_config["nbr_random_questions"] -= 1
+        elif self.index["tough"][question_id]:
+            config["nbr_random_questions"] -= 1
             return "tough"
         else:
-            self.temp_config["nbr_random_questions"] -= 1
+            config["nbr_random_questions"] -= 1
             return "general"
 
-    """
-    Removes the question from the dataframe
-    """
-
-    def discard_question(self, question_id):
-        self.candidate_questions = self.candidate_questions[
-            self.candidate_questions.question_id != question_id
-        ]
-
     def get_job_list(self):
         "Returns jobs with questions"
-        job_list = list(self.question_df["job"].unique())
+        job_list = self.bank.get_job_list()
         job_list.remove("Allmän")
         return ["Allmän intervjuträning"] + job_list
-
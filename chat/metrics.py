@@ -0,0 +1,277 @@
+import asyncio
+import bisect
+import contextlib
+import functools
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+""" In-process metrics, exposed in the Prometheus text format on /metrics.
+
+Histograms keep one row of bucket counts per label combination, so observing a value is a bisect and
+an increment under a lock. Components that already keep their own counters (caches, write queue,
+speculation) are read through callbacks when /metrics is scraped.
+
+With several workers each process has its own registry and Prometheus scrapes whichever worker answers,
+so aggregate with sum()/rate() across scrapes rather than reading single values.
+"""
+
+default_buckets = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    "Distribution of a value, e.g. a latency in seconds, per label combination"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = default_buckets,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> [bucket counts..., sum, count]
+        self._rows: Dict[Tuple, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                row = self._rows[key] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the duration of the block. The labels dict can be updated inside the block,
+        e.g. with the outcome"""
+        tic = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - tic, **labels)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            rows = {key: list(row) for key, row in self._rows.items()}
+        for key, row in sorted(rows.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                labels = _format_labels(self.label_names + ("le",), key + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names + ("le",), key + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {row[-1]}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {row[-2]}")
+            lines.append(f"{self.name}_count{labels} {row[-1]}")
+        return lines
+
+
+class Counter:
+    "Monotonically increasing count per label combination"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class CallbackGauge:
+    "Values read from a callback at scrape time. The callback returns {label values: value}"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Tuple[str, ...],
+        callback: Callable[[], Dict[Tuple, float]],
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+        ]
+        try:
+            values = self.callback()
+        except Exception as e:
+            logging.warning(f"Failed to read metric {self.name}: {e}")
+            return lines
+        for key, value in sorted(values.items()):
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                labels = _format_labels(self.label_names, key)
+                lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Registry:
+    "All metrics of the process"
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, documentation, label_names=(), buckets=default_buckets):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names, callback):
+        "Registers a gauge read from callback. Replaces an existing gauge with the same name"
+        self._metrics.pop(name, None)
+        return self._register(CallbackGauge(name, documentation, label_names, callback))
+
+    def render(self) -> str:
+        "Returns all metrics in the Prometheus text exposition format"
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def timed(histogram: Histogram, **labels):
+    """Decorator that observes the duration of each call. Works on functions and coroutines.
+    An 'outcome' label is set to 'ok' or 'error' if the histogram has one"""
+    track_outcome = "outcome" in histogram.label_names
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with histogram.time(**labels) as call_labels:
+                    if track_outcome:
+                        call_labels["outcome"] = "error"
+                    value = await func(*args, **kwargs)
+                    if track_outcome:
+                        call_labels["outcome"] = "ok"
+                    return value
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with histogram.time(**labels) as call_labels:
+                    if track_outcome:
+                        call_labels["outcome"] = "error"
+                    value = func(*args, **kwargs)
+                    if track_outcome:
+                        call_labels["outcome"] = "ok"
+                    return value
+
+        return wrapper
+
+    return decorator
+
+
+########## Metrics of the request path
+turn_seconds = registry.histogram(
+    "emely_turn_seconds",
+    "Time to reply to a user message",
+    ("persona", "dialog_block", "outcome", "intent", "hardcoded"),
+)
+turn_stage_seconds = registry.histogram(
+    "emely_turn_stage_seconds",
+    "Time spent in each stage of a turn: rasa, translate, database, act and translate_reply",
+    ("persona", "stage"),
+)
+upstream_seconds = registry.histogram(
+    "emely_upstream_seconds",
+    "Latency of requests to the model services",
+    ("upstream", "outcome"),
+)
+model_call_seconds = registry.histogram(
+    "emely_model_call_seconds",
+    "Time a turn waits for a model reply. Shorter than the request if it was started speculatively",
+    ("model", "speculative"),
+)
+translation_seconds = registry.histogram(
+    "emely_translation_seconds",
+    "Time to translate a text, from the cache or the translation api",
+    ("src", "target", "cached"),
+)
+translation_api_seconds = registry.histogram(
+    "emely_translation_api_seconds",
+    "Latency of batched calls to the translation api",
+    ("outcome",),
+)
+firestore_seconds = registry.histogram(
+    "emely_firestore_seconds",
+    "Latency of firestore reads and writes",
+    ("operation", "outcome"),
+)
+filter_seconds = registry.histogram(
+    "emely_filter_seconds",
+    "Time spent in the message filters",
+    ("filter",),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
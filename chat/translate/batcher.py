@@ -0,0 +1,83 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+
+class TranslationBatcher:
+    """Coalesces translation requests from concurrent conversations into one upstream call.
+
+    Requests with the same source and target language that arrive within `window` seconds
+    are sent together. A batch is sent at once when it reaches `max_batch_size` texts.
+    """
+
+    def __init__(
+        self,
+        translate_batch: Callable[[List[str], str, str], Awaitable[List[str]]],
+        window: float = 0.005,
+        max_batch_size: int = 100,
+    ):
+        # translate_batch is a coroutine that translates a list of texts in one call
+        self.translate_batch = translate_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: Dict[Tuple[str, str], Dict[str, List[asyncio.Future]]] = {}
+        self._timers = {}
+        # Batches in flight. Referenced here so they can't be garbage collected before they finish
+        self._sending = set()
+
+        # Metrics
+        self.nbr_requests = 0
+        self.nbr_batches = 0
+
+    async def translate(self, text: str, src: str, target: str) -> str:
+        "Queues a text for the next batch and waits for its translation"
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.nbr_requests += 1
+
+        languages = (src, target)
+        pending = self._pending.setdefault(languages, {})
+        # Identical texts are only translated once
+        pending.setdefault(text, []).append(future)
+
+        if len(pending) >= self.max_batch_size:
+            self._flush(languages)
+        elif languages not in self._timers:
+            self._timers[languages] = loop.call_later(
+                self.window, self._flush, languages
+            )
+
+        return await future
+
+    def _flush(self, languages: Tuple[str, str]):
+        "Sends the pending texts for a language pair as one batch"
+        timer = self._timers.pop(languages, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self._pending.pop(languages, None)
+        if pending:
+            self.nbr_batches += 1
+            task = asyncio.ensure_future(self._send(pending, *languages))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, pending: Dict[str, List[asyncio.Future]], src, target):
+        texts = list(pending.keys())
+        try:
+            translations = await self.translate_batch(texts, src, target)
+        except asyncio.CancelledError:
+            # E.g. at shutdown. The callers would otherwise wait forever
+            for futures in pending.values():
+                for future in futures:
+                    future.cancel()
+            raise
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for text, translation in zip(texts, translations):
+            for future in pending[text]:
+                if not future.done():
+                    future.set_result(translation)
@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+from chat.hardcoded_messages import greetings, goodbyes, callstoaction, rasa, fallbacks
+from chat.interview.bank import QuestionBank, question_phrasings
+
+default_table_path = Path(__file__).resolve().parent / "phrase_table.json"
+
+_whitespace = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    "Translations are made on lowercased text, so the cache is keyed the same way"
+    return _whitespace.sub(" ", text.strip().lower())
+
+
+class TranslationCache:
+    """Two level translation cache.
+    1. An in-memory LRU of recent translations
+    2. A persistent table with translations of all hardcoded phrases, built when the image is built
+
+    Keys are (normalized text, src, target) and values are the final, post-processed translations.
+    """
+
+    def __init__(self, max_size: int = 10000, table_path: Path = default_table_path):
+        self.max_size = max_size
+        self.table_path = Path(table_path)
+        self.table = {}
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.hits = 0
+        self.table_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text: str, src: str, target: str) -> str:
+        return f"{src}|{target}|{normalize(text)}"
+
+    def get(self, text: str, src: str, target: str) -> Optional[str]:
+        "Returns the cached translation or None"
+        key = self.key(text, src, target)
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return self._lru[key]
+            if key in self.table:
+                self.table_hits += 1
+                return self.table[key]
+            self.misses += 1
+            return None
+
+    def put(self, text: str, src: str, target: str, translation: str):
+        key = self.key(text, src, target)
+        with self._lock:
+            self._lru[key] = translation
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_size:
+                self._lru.popitem(last=False)
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._lru),
+            "table_size": len(self.table),
+            "hits": self.hits,
+            "table_hits": self.table_hits,
+            "misses": self.misses,
+        }
+
+    def load_table(self):
+        "Loads the phrase table from disk if it exists. A table that can't be read is left empty"
+        if not self.table_path.exists():
+            return
+        try:
+            with open(self.table_path, "r", encoding="utf-8") as f:
+                self.table = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"Could not load the phrase table {self.table_path}: {e}")
+
+    def save_table(self):
+        "Writes the table to a temporary file that replaces the old table, so readers never see half a table"
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.table_path.parent, prefix=self.table_path.name, suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self.table, f, ensure_ascii=False, indent=0, sort_keys=True)
+            os.replace(tmp_path, self.table_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def missing_from_table(
+        self, phrases: Iterable[str], src: str, target: str
+    ) -> List[str]:
+        "Returns the unique phrases that aren't in the phrase table"
+        missing = {}
+        for phrase in phrases:
+            key = self.key(phrase, src, target)
+            if key not in self.table and key not in missing:
+                missing[key] = phrase
+        return list(missing.values())
+
+    def add_to_table(self, text: str, src: str, target: str, translation: str):
+        self.table[self.key(text, src, target)] = translation
+
+
+def collect_hardcoded_phrases(question_bank: QuestionBank) -> List[str]:
+    """Returns every hardcoded swedish phrase Emely can say, including the ways questions are combined with transitions.
+    Phrases formatted with the user's name are left out"""
+    phrases = []
+    phrases.extend(greetings.interview_no_small_talk)
+    phrases.extend(greetings.fika)
+    phrases.extend(goodbyes.interview)
+    phrases.extend(goodbyes.fika)
+    phrases.extend(callstoaction.tooshort)
+    phrases.extend(fallbacks.fika)
+    phrases.extend(rasa.replies.values())
+
+    for row, alternatives in zip(question_bank.rows, question_bank.alternatives):
+        for alt in alternatives:
+            phrases.extend(question_phrasings(row["transition"], alt))
+
+    logging.info(f"Collected {len(phrases)} hardcoded phrases")
+    return phrases
@@ -0,0 +1,120 @@
+import os
+import re
+import time
+from pathlib import Path
+from typing import Dict
+
+""" Post processing of translations. All patterns are compiled once at import or load time.
+"""
+
+# Matching spaces between word and delimiters ,.?!
+_space_before_delimiter = re.compile(r"\s(?=[^,\s\w+]*[,.?!])")
+# Lower case letters at the beginning of each sentence
+_sentence_start = re.compile(r"(^[a-zåäöA-Zåäö]|(?<=[?.!]\s)\w)")
+
+default_swenglish_path = Path(__file__).resolve().parent / "swenglish.txt"
+
+
+def format_text(text: str) -> str:
+    "Fixes some common formatting errors produced by the blenderbot and translate"
+    # Removes the spaces between words and delimiters
+    text = _space_before_delimiter.sub("", text)
+
+    # Fixes upper and lowercase letters at the beginning of each sentence
+    text = _sentence_start.sub(lambda match: match.group(1).upper(), text)
+    return text
+
+
+def _trie_pattern(phrases) -> str:
+    """Builds a regex that matches any of the phrases by walking a character trie of them,
+    e.g. ["i am", "i'm"] -> "i(?: am|'m)". Longer continuations are tried first"""
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def to_pattern(node) -> str:
+        ends_here = "" in node
+        branches = [
+            re.escape(char) + to_pattern(child)
+            for char, child in sorted(node.items())
+            if char != ""
+        ]
+        if len(branches) == 0:
+            return ""
+        if len(branches) == 1 and not ends_here:
+            return branches[0]
+        pattern = "(?:" + "|".join(branches) + ")"
+        return pattern + "?" if ends_here else pattern
+
+    return to_pattern(trie)
+
+
+class SwenglishCorrector:
+    """Replaces common swenglish phrases with proper swedish in a single pass.
+
+    All phrases are compiled into one regex shaped like a trie of the phrases, so the cost per text
+    barely grows with the number of phrases the way a loop of str.replace does.
+    Where phrases overlap the longest one wins.
+    The phrase file is reloaded if it has changed, checked at most every `reload_interval` seconds.
+    """
+
+    def __init__(self, path: Path = default_swenglish_path, reload_interval: float = 10):
+        self.path = Path(path)
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._next_check = 0.0
+        self.load()
+
+    def load(self):
+        "Reads the phrase file and compiles the pattern"
+        mtime = os.stat(self.path).st_mtime
+        phrases = self._read_phrases()
+        pattern = re.compile(_trie_pattern(phrases))
+
+        # Swapped in one assignment so concurrent calls never see a pattern with the wrong phrases
+        self._compiled = (pattern if len(phrases) > 0 else None, phrases)
+        self._mtime = mtime
+
+    @property
+    def phrases(self) -> Dict[str, str]:
+        return self._compiled[1]
+
+    def _read_phrases(self) -> Dict[str, str]:
+        "Reads common swenglish translations from file to dictionary"
+        with open(self.path, "r") as f:
+            swenglish_phrases = f.readlines()
+
+        dictionary = {}
+        for phrase in swenglish_phrases:
+            if ":" not in phrase:
+                continue
+            phrase = phrase.lower()
+            eng, swe = phrase.split(":")
+            dictionary[eng.strip()] = swe.strip()
+
+        return dictionary
+
+    def _reload_if_changed(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.reload_interval
+        try:
+            if os.stat(self.path).st_mtime != self._mtime:
+                self.load()
+        except OSError:
+            # Keep the phrases we have if the file is being replaced
+            pass
+
+    def correct(self, text: str) -> str:
+        "Corrects text if it contains swenglish"
+        self._reload_if_changed()
+        text = text.lower()
+
+        pattern, phrases = self._compiled
+        if pattern is None:
+            return text
+        return pattern.sub(lambda match: phrases[match.group(0)], text)
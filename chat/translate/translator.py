@@ -2,9 +2,14 @@ import six
 from google.cloud import translate_v2 as translate
 import os
 from pathlib import Path
-import re
 from chat.utils import is_gcp_instance, timer
-from aioify import aioify
+from chat.metrics import translation_seconds, translation_api_seconds, timed
+from chat.translate.cache import TranslationCache, collect_hardcoded_phrases
+from chat.translate.batcher import TranslationBatcher
+from chat.translate.postprocess import SwenglishCorrector, format_text
+from typing import List
+import asyncio
+import logging
 
 """ Translates text using Google's official API
 """
@@ -13,6 +18,38 @@ from aioify import aioify
 class ChatTranslator:
     def __init__(self):
 
+        # Translator object
+        self.use_fake = os.environ.get("USE_FAKE_TRANSLATE") == "1"
+        if self.use_fake:
+            # Returns the texts untranslated, for load testing. See chat.fakes
+            from chat.fakes.translate import FakeTranslateClient
+
+            self.gcloud_translator = FakeTranslateClient()
+        else:
+            self.gcloud_translator = self._authenticate_translate()
+        self.swenglish_corrector = SwenglishCorrector()
+
+        self.cache = TranslationCache(
+            max_size=int(os.environ.get("TRANSLATION_CACHE_SIZE", 10000)),
+            table_path=os.environ.get(
+                "TRANSLATION_TABLE_PATH",
+                Path(__file__).resolve().parent / "phrase_table.json",
+            ),
+        )
+        self.cache.load_table()
+
+        # Coalesces translations from concurrent conversations into one api call
+        self.batcher = TranslationBatcher(
+            self._translate_batch_async,
+            window=float(os.environ.get("TRANSLATION_BATCH_WINDOW", 0.005)),
+            max_batch_size=self.max_batch_size,
+        )
+
+    # The translation api accepts at most 128 texts per request
+    max_batch_size = 100
+
+    def _authenticate_translate(self) -> translate.Client:
+        "Returns an authenticated google translate client"
         # Set this to your google api key location
         if not is_gcp_instance():
             # Add an authentication to the Google translate if we are not on GCP.
@@ -24,15 +61,13 @@ class ChatTranslator:
             )
             os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = json_path.as_posix()
 
-        # Translator object
-        self.gcloud_translator = translate.Client()
-        self.swenglish_dict = self._load_swenglish()
+        return translate.Client()
 
-    @aioify
-    def translate(self, text: str, src: str, target: str) -> str:
+    async def translate(self, text: str, src: str, target: str) -> str:
         """
         @ Isabella - Method that translates between two languages
-        and makes sure each start of sentence is uppercase
+        and makes sure each start of sentence is uppercase.
+        Cached translations are returned without calling the translation api
 
         Args:
             text (str): text that is to be translated
@@ -42,16 +77,61 @@ class ChatTranslator:
         Returns:
             str: the translated string
         """
-        # To minimize errors in google translate - lowercase everything
-        text = text.lower()
+        with translation_seconds.time(src=src, target=target, cached="true") as labels:
+            translated_text = self.cache.get(text, src, target)
+            if translated_text is None:
+                labels["cached"] = "false"
+                translated_text = await self.batcher.translate(text, src, target)
+                self.cache.put(text, src, target, translated_text)
+        return translated_text
 
-        if isinstance(text, six.binary_type):
-            text = text.decode("utf-8")
-        result = self.gcloud_translator.translate(
-            text, source_language=src, target_language=target, format_="text"
+    async def translate_many(self, texts: List[str], src: str, target: str) -> List[str]:
+        "Translates a list of texts. The ones that aren't cached are translated in one api call"
+        translations = [self.cache.get(text, src, target) for text in texts]
+        missing = list({t for t, tr in zip(texts, translations) if tr is None})
+
+        if len(missing) > 0:
+            translated = {}
+            for i in range(0, len(missing), self.max_batch_size):
+                batch = missing[i : i + self.max_batch_size]
+                results = await self._translate_batch_async(batch, src, target)
+                translated.update(zip(batch, results))
+            for text, translation in translated.items():
+                self.cache.put(text, src, target, translation)
+            translations = [
+                tr if tr is not None else translated[t]
+                for t, tr in zip(texts, translations)
+            ]
+
+        return translations
+
+    async def _translate_batch_async(
+        self, texts: List[str], src: str, target: str
+    ) -> List[str]:
+        "Runs the blocking translation client in a thread"
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, self._translate_batch, texts, src, target
         )
-        translated_text = result["translatedText"]
 
+    @timed(translation_api_seconds)
+    def _translate_batch(self, texts: List[str], src: str, target: str) -> List[str]:
+        "Translates a list of texts with one call to google translate"
+        # To minimize errors in google translate - lowercase everything
+        texts = [
+            text.decode("utf-8") if isinstance(text, six.binary_type) else text
+            for text in texts
+        ]
+        results = self.gcloud_translator.translate(
+            [text.lower() for text in texts],
+            source_language=src,
+            target_language=target,
+            format_="text",
+        )
+        return [self._postprocess(r["translatedText"], src, target) for r in results]
+
+    def _postprocess(self, translated_text: str, src: str, target: str) -> str:
+        "Corrects swenglish and formatting of a translation"
         if src == "en" and target == "sv":
             translated_text = self.correct_swenglish(translated_text)
 
@@ -59,39 +139,44 @@ class ChatTranslator:
 
         return translated_text
 
+    async def build_phrase_table(
+        self, phrases: List[str], src: str = "sv", target: str = "en"
+    ):
+        """Translates the hardcoded phrases that aren't already in the phrase table and saves it to disk.
+        Run when the image is built so hardcoded replies don't need a call to the translation api"""
+        missing = self.cache.missing_from_table(phrases, src, target)
+        if len(missing) == 0:
+            return
+
+        logging.info(f"Translating {len(missing)} phrases for the phrase table")
+        translations = await self.translate_many(missing, src, target)
+        for text, translation in zip(missing, translations):
+            self.cache.add_to_table(text, src, target, translation)
+
+        # Fake translations must not end up in the phrase table on disk
+        if self.use_fake:
+            return
+        try:
+            self.cache.save_table()
+        except OSError as e:
+            logging.warning(f"Could not save the phrase table: {e}")
+
     def format_text(self, text: str) -> str:
         "Fixes some common formatting errors produced by the blenderbot and translate"
-        # Matching spaces between word and delimiters ,.?!
-        # and then removing the spaces
-        text = re.sub(r"\s(?=[^,\s\w+]*[,.?!])", "", text)
-
-        # Fixes upper and lowercase letters at the beginning of each sentence
-        text = re.sub(
-            r"(^[a-zåäöA-Zåäö]|(?<=[?.!]\s)\w)",
-            lambda match: r"{}".format(match.group(1).upper()),
-            text,
-        )
-        return text
-
-    def _load_swenglish(self) -> dict:
-        "Reads common swenglish translations from file to dictionary"
-        p = Path(__file__).parent / "swenglish.txt"
-        with open(p, "r") as f:
-            swenglish_phrases = f.readlines()
-
-        dictionary = {}
-        for phrase in swenglish_phrases:
-            phrase = phrase.lower()
-            eng, swe = phrase.split(":")
-            dictionary[eng.strip()] = swe.strip()
-
-        return dictionary
+        return format_text(text)
 
     def correct_swenglish(self, text: str) -> str:
         "Corrects text if it contains swenglish"
-        text = text.lower()
+        return self.swenglish_corrector.correct(text)
+
+
+if __name__ == "__main__":
+    from chat.interview.bank import QuestionBank
 
-        for eng_phrase, swe_phrase in self.swenglish_dict.items():
-            if eng_phrase in text:
-                text = text.replace(eng_phrase, swe_phrase)
-        return text
+    logging.basicConfig(level=logging.INFO)
+    try:
+        phrases = collect_hardcoded_phrases(QuestionBank())
+        asyncio.run(ChatTranslator().build_phrase_table(phrases))
+    except Exception as e:
+        # The image still works, hardcoded phrases are then translated and cached when first used
+        logging.warning(f"Failed to build phrase table: {e}")
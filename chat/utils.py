@@ -1,17 +1,33 @@
+import asyncio
 import functools
+import logging
 import time
 import socket
 
 
 def timer(func):
+    "Logs the elapsed time of each call. Works on functions and coroutines. See chat.metrics for histograms"
+    if asyncio.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper_timer(*args, **kwargs):
+            tic = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                elapsed_time = time.perf_counter() - tic
+                logging.info(f"Elapsed time for {func}: {elapsed_time:0.4f} seconds")
+
+        return async_wrapper_timer
+
     @functools.wraps(func)
     def wrapper_timer(*args, **kwargs):
         tic = time.perf_counter()
-        value = func(*args, **kwargs)
-        toc = time.perf_counter()
-        elapsed_time = toc - tic
-        print(f"Elapsed time for {func}: {elapsed_time:0.4f} seconds")
-        return value
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed_time = time.perf_counter() - tic
+            logging.info(f"Elapsed time for {func}: {elapsed_time:0.4f} seconds")
 
     return wrapper_timer
 
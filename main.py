@@ -1,9 +1,24 @@
-from fastapi import FastAPI, Response, status, Request, HTTPException
+from fastapi import (
+    FastAPI,
+    Response,
+    status,
+    Request,
+    HTTPException,
+    WebSocket,
+    WebSocketDisconnect,
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+import json
 import logging
+import os
 import uvicorn
 from chat.data.types import ConversationInit, UserMessage, Message
+from chat.data.export import export_formats, gzip_chunks, started, text_chunks
 from chat.dialog.worlds import DialogWorld
+from chat.dialog.clients import close_clients
+from chat.metrics import registry
 
 
 logging.basicConfig(level=logging.NOTSET)
@@ -30,12 +45,26 @@ world = DialogWorld()
 
 
 async def startup():
-    "Run on startup. Currently used to wake models"
-    world.wake_models()
+    "Run on startup. Wakes the models and starts keeping them warm"
+    if os.environ["BUILD_PHRASE_TABLE"] == "1":
+        await world.build_phrase_table()
+    world.start_background_tasks()
+    return
+
+
+async def shutdown():
+    "Run on shutdown. Writes queued conversation updates and closes the connection pools"
+    await world.stop_background_tasks()
+    await world.keep_warm.stop()
+    await world.database_handler.deletion_jobs.stop()
+    await world.database_handler.write_queue.drain()
+    await world.database_handler.cache.close()
+    await close_clients()
     return
 
 
 app.add_event_handler("startup", startup)
+app.add_event_handler("shutdown", shutdown)
 
 
 @app.post("/init", status_code=201)
@@ -59,35 +88,132 @@ async def fika(user_message: UserMessage, response: Response):
     return reply
 
 
+async def server_sent_events(events):
+    "Formats (event, data) tuples as server-sent events"
+    try:
+        async for event, data in events:
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    except Exception as e:
+        logging.exception("Failed to stream reply")
+        yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+
+
+@app.post("/intervju/stream", status_code=200)
+async def interview_stream(user_message: UserMessage):
+    "Same as /intervju but streams the reply as server-sent events"
+    events = world.reply_events(user_message, persona="intervju")
+    return StreamingResponse(
+        server_sent_events(events), media_type="text/event-stream"
+    )
+
+
+@app.post("/fika/stream", status_code=200)
+async def fika_stream(user_message: UserMessage):
+    "Same as /fika but streams the reply as server-sent events"
+    events = world.reply_events(user_message, persona="fika")
+    return StreamingResponse(
+        server_sent_events(events), media_type="text/event-stream"
+    )
+
+
+@app.websocket("/ws/{persona}")
+async def chat_websocket(websocket: WebSocket, persona: str):
+    """Keeps a connection open across turns. Each UserMessage sent by the client
+    is answered with the same events as the stream endpoints, as {"event": ..., "data": ...}"""
+    if persona not in ["intervju", "fika"]:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+    try:
+        while True:
+            try:
+                user_message = UserMessage(**await websocket.receive_json())
+            except (ValidationError, ValueError) as e:
+                await websocket.send_json({"event": "error", "data": {"detail": str(e)}})
+                continue
+
+            try:
+                async for event, data in world.reply_events(user_message, persona):
+                    await websocket.send_json({"event": event, "data": data})
+            except WebSocketDisconnect:
+                raise
+            except Exception as e:
+                logging.exception("Failed to reply over websocket")
+                await websocket.send_json({"event": "error", "data": {"detail": str(e)}})
+    except WebSocketDisconnect:
+        return
+
+
+@app.get("/metrics")
+def metrics():
+    "Latency histograms and component stats in the Prometheus text format"
+    return Response(
+        content=registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
 @app.get("/joblist")
 def get_joblist():
     return {"occupations": world.question_generator.get_job_list()}
 
 
 @app.get("/user_conversations")
-def get_user_conversations(user_id: str):
-    response = world.database_handler.get_user_conversations_formatted(
-            user_id
+async def get_user_conversations(user_id: str, request: Request, format: str = "json"):
+    """Exports a user's conversations. The default format=json returns {"user_conversations": text}.
+    format=text and format=ndjson stream the export, gzip compressed if the client accepts it"""
+    if format != "json" and format not in export_formats:
+        raise HTTPException(status_code=400, detail=f"Unknown format {format}")
+    try:
+        conversations = await started(
+            world.database_handler.stream_user_conversations(user_id)
         )
-    if response:
-        return {"user_conversations": response}
-    else:
+        if format == "json":
+            chunks = [chunk async for chunk in text_chunks(conversations)]
+            return {"user_conversations": "".join(chunks)}
+    except Exception:
+        logging.exception("Failed to export user conversations")
         raise HTTPException(
             status_code=500,
             detail="Something went wrong when fetching the user data, please contact us at emely@nordaxon.com",
         )
 
-
-@app.post("/user_delete")
-def delete_user_data(user_id: str):
-    response = world.database_handler.delete_user_data(user_id)
-    if response:
-        return {"response": "Successfully deleted all user data"}
-    else:
+    formatter, media_type = export_formats[format]
+    chunks = formatter(conversations)
+    headers = {"Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+
+@app.post("/user_delete", status_code=202)
+async def delete_user_data(user_id: str):
+    """Starts deleting all data of the user in the background.
+    Poll /user_delete/{job_id} for the status. Starting it again returns the unfinished job"""
+    try:
+        job = await world.database_handler.deletion_jobs.start(user_id)
+    except Exception:
+        logging.exception("Failed to start deletion of user data")
         raise HTTPException(
             status_code=500,
             detail="Something went wrong when deleting the user data, please contact us at emely@nordaxon.com",
         )
+    return {
+        "response": "Deletion of all user data has started",
+        "job_id": job["job_id"],
+        "status": job["status"],
+    }
+
+
+@app.get("/user_delete/{job_id}")
+async def delete_user_data_status(job_id: str):
+    "Status of a deletion job: pending, running, done or failed, and how much has been deleted"
+    job = await world.database_handler.deletion_jobs.status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No such deletion job")
+    job.pop("user_id", None)
+    return job
 
 
 if __name__ == "__main__":
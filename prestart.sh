@@ -0,0 +1,12 @@
+#! /usr/bin/env bash
+# Run by the uvicorn-gunicorn image before it starts the workers.
+# Starts the redis that the workers share the conversation cache in, see CONVERSATION_CACHE_BACKEND
+if [ "$CONVERSATION_CACHE_BACKEND" = "redis" ] && [ "$REDIS_URL" = "unix:///tmp/redis.sock" ]; then
+    redis-server --daemonize yes --port 0 --unixsocket /tmp/redis.sock --save "" \
+        --maxmemory 256mb --maxmemory-policy allkeys-lru
+    # Give it a moment to create the socket, the workers fall back to firestore until it's there
+    for _ in $(seq 50); do
+        [ -S /tmp/redis.sock ] && break
+        sleep 0.1
+    done
+fi
@@ -0,0 +1,145 @@
+import asyncio
+import os
+from chat.data.database import FirestoreHandler
+from chat.data.types import Conversation, Message
+
+"""
+Firestore document operations per turn for the two message storage layouts.
+
+Runs conversations against the in-memory fake firestore and counts rpcs, document reads and writes,
+the way firestore bills them, for:
+    - create: the first message when a conversation is initiated
+    - turn: persisting one turn, a user message and a reply
+    - load: reading a conversation that isn't in the cache (CONVERSATION_WINDOW messages)
+    - export: get_user_conversations for a user with nbr_conversations conversations
+    - delete: a deletion job for the same user
+
+Run with:
+    python tests/benchmark_message_layout.py
+"""
+
+
+# --------------- parameters ------------------
+conversation_lengths = [10, 40, 100]
+nbr_conversations = 10
+bucket_size = 32
+window = 16
+
+# ---------------------------------------------
+
+
+def make_message(conversation_id, message_nbr):
+    return Message(
+        conversation_id=conversation_id,
+        lang="sv",
+        message_nbr=message_nbr,
+        text=f"Meddelande nummer {message_nbr}",
+        text_en=f"Message number {message_nbr}",
+        response_time=0.5,
+        show_emely=True,
+        who="bot" if message_nbr % 2 == 0 else "user",
+        filtered_message="",
+        filtered_reason="",
+        rasa_intent="",
+        is_hardcoded=False,
+    )
+
+
+def make_conversation(conversation_id, user_id):
+    return Conversation(
+        created_at="2022-01-01 12:00:00",
+        current_dialog_block="greet",
+        current_dialog_block_length=0,
+        development_testing=True,
+        enable_small_talk=True,
+        episode_done=False,
+        job="",
+        lang="sv",
+        messages=[],
+        name="benchmark",
+        nbr_messages=0,
+        persona="intervju",
+        question_list=[],
+        user_id=user_id,
+        user_ip_number="127.0.0.1",
+        use_huggingface=False,
+        conversation_id=conversation_id,
+    )
+
+
+class OperationCounter:
+    "Difference in the fake client's counters over a block"
+
+    def __init__(self, client):
+        self.client = client
+        self.totals = {}
+
+    def __enter__(self):
+        self.before = self.client.stats()
+        return self
+
+    def __exit__(self, *args):
+        for key, value in self.client.stats().items():
+            self.totals[key] = self.totals.get(key, 0) + value - self.before[key]
+
+
+async def delete_user_data(handler, user_id):
+    job = await handler.deletion_jobs.start(user_id)
+    await handler.deletion_jobs.wait(job["job_id"])
+
+
+def run(layout, nbr_messages):
+    os.environ["USE_FAKE_FIRESTORE"] = "1"
+    os.environ["FAKE_FIRESTORE_LATENCY"] = "constant:0"
+    os.environ["MESSAGE_STORAGE_LAYOUT"] = layout
+    os.environ["MESSAGE_BUCKET_SIZE"] = str(bucket_size)
+    handler = FirestoreHandler()
+    client = handler.firestore_client
+    create, turn, load = (OperationCounter(client) for _ in range(3))
+    nbr_turns = 0
+
+    for i in range(nbr_conversations):
+        conversation_id = f"{layout}-{i}"
+        conversation = make_conversation(conversation_id, user_id="benchmark-user")
+        conversation.add_message(make_message(conversation_id, 0))
+        with create:
+            asyncio.run(handler.create(conversation))
+
+        while conversation.nbr_messages < nbr_messages:
+            for _ in range(2):
+                message_nbr = conversation.nbr_messages
+                conversation.add_message(make_message(conversation_id, message_nbr))
+            with turn:
+                handler.update(conversation)
+            nbr_turns += 1
+
+        handler.cache.invalidate(conversation_id)
+        with load:
+            loaded = handler.get_conversation(conversation_id, window=window)
+        assert [m.text for m in loaded.messages] == [
+            m.text for m in conversation.messages[-window:]
+        ]
+
+    with OperationCounter(client) as export:
+        conversations = handler.get_user_conversations("benchmark-user")
+    assert all(len(messages) >= nbr_messages for _, messages in conversations)
+    with OperationCounter(client) as delete:
+        asyncio.run(delete_user_data(handler, "benchmark-user"))
+
+    print(f"\n{layout}, {nbr_messages} messages per conversation")
+    rows = [
+        ("create", create, nbr_conversations),
+        ("turn", turn, nbr_turns),
+        ("load", load, nbr_conversations),
+        ("export", export, 1),
+        ("delete", delete, 1),
+    ]
+    for name, counter, n in rows:
+        stats = "  ".join(f"{k} {v / n:8.1f}" for k, v in counter.totals.items())
+        print(f"  {name:<8}{stats}")
+
+
+if __name__ == "__main__":
+    for nbr_messages in conversation_lengths:
+        for layout in ["documents", "buckets"]:
+            run(layout, nbr_messages)
@@ -0,0 +1,109 @@
+import re
+import random
+import timeit
+import tempfile
+from pathlib import Path
+from chat.translate.postprocess import (
+    SwenglishCorrector,
+    format_text,
+    default_swenglish_path,
+)
+
+"""
+Microbenchmark of the translation post processing (swenglish correction + formatting) per reply.
+
+Compares the previous implementation, a loop of `in` and str.replace over the swenglish dictionary
+and re.sub with uncompiled patterns, against the compiled single pass SwenglishCorrector and format_text.
+The phrase list is padded with synthetic phrases to show how the cost grows with the list.
+
+Run with:
+    python tests/benchmark_postprocess.py
+"""
+
+
+# --------------- parameters ------------------
+nbr_replies = 200
+extra_phrases = [0, 100, 1000]
+repeats = 5
+
+# ---------------------------------------------
+
+
+replies = [
+    "i am good , thank you . i don ' t know about you but i like horses !",
+    "that sounds like a lot of fun . what do you do for work ?",
+    "that ' s good to hear . i've never been there , what is it like ?",
+    "i'm good . do you have any plans for the weekend ?",
+    "that's too bad . i hope you feel better soon",
+]
+
+
+def old_correct_swenglish(text, swenglish_dict):
+    text = text.lower()
+    for eng_phrase, swe_phrase in swenglish_dict.items():
+        if eng_phrase in text:
+            text = text.replace(eng_phrase, swe_phrase)
+    return text
+
+
+def old_format_text(text):
+    text = re.sub(r"\s(?=[^,\s\w+]*[,.?!])", "", text)
+    text = re.sub(
+        r"(^[a-zåäöA-Zåäö]|(?<=[?.!]\s)\w)",
+        lambda match: r"{}".format(match.group(1).upper()),
+        text,
+    )
+    return text
+
+
+def make_phrase_file(nbr_extra: int) -> Path:
+    "Writes the real swenglish phrases plus synthetic ones to a temporary file"
+    lines = default_swenglish_path.read_text().splitlines()
+    rng = random.Random(0)
+    for i in range(nbr_extra):
+        words = " ".join(rng.choice(["blue", "car", "went", "home", "yes"]) for _ in range(3))
+        lines.append(f"{words} {i}:svensk fras {i}")
+    f = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False)
+    f.write("\n".join(lines))
+    f.close()
+    return Path(f.name)
+
+
+if __name__ == "__main__":
+    texts = [random.choice(replies) for _ in range(nbr_replies)]
+
+    for nbr_extra in extra_phrases:
+        path = make_phrase_file(nbr_extra)
+        corrector = SwenglishCorrector(path)
+        swenglish_dict = corrector.phrases
+
+        # Both implementations have to agree
+        for text in replies:
+            assert old_format_text(
+                old_correct_swenglish(text, swenglish_dict)
+            ) == format_text(corrector.correct(text))
+
+        old = min(
+            timeit.repeat(
+                lambda: [
+                    old_format_text(old_correct_swenglish(t, swenglish_dict))
+                    for t in texts
+                ],
+                number=1,
+                repeat=repeats,
+            )
+        )
+        new = min(
+            timeit.repeat(
+                lambda: [format_text(corrector.correct(t)) for t in texts],
+                number=1,
+                repeat=repeats,
+            )
+        )
+        print(
+            f"{len(swenglish_dict)} phrases: "
+            f"old {old / nbr_replies * 1e6:0.1f} us/reply, "
+            f"new {new / nbr_replies * 1e6:0.1f} us/reply, "
+            f"speedup {old / new:0.1f}x"
+        )
+        path.unlink()
@@ -0,0 +1,109 @@
+from difflib import SequenceMatcher
+import numpy as np
+from chat.dialog.fingerprints import fingerprint_sentences, split_text_into_sentences
+
+"""
+Calibration of the repetition filter's SIMILARITY_THRESHOLD for sentence fingerprints.
+
+The filter used to compare sentences with difflib's SequenceMatcher.ratio() and drop those with a ratio of at
+least 0.9 to one of Emely's previous sentences. It now uses the cosine similarity of hashed character 3-gram
+fingerprints, which is a different scale. This script replays sample replies against sample histories,
+decides keep/drop for every sentence with the old measure at the old threshold, and counts how often the
+fingerprint measure disagrees at a range of thresholds.
+
+Run with:
+    python tests/calibrate_repetition_filter.py
+"""
+
+
+# --------------- parameters ------------------
+old_threshold = 0.9
+thresholds = [0.8, 0.85, 0.88, 0.9, 0.92, 0.94, 0.96]
+
+# Emely's earlier replies in a conversation
+history = [
+    "That sounds like a lot of fun. What do you do for work?",
+    "I'm good, thank you. How are you doing today?",
+    "I love to go hiking in the mountains with my dog. Do you have any pets?",
+    "That's too bad. I hope you feel better soon.",
+    "I have never been to Sweden, but I would love to visit someday. What is it like?",
+    "What made you interested in working as a chef?",
+    "I work at a grocery store, it's not a great job but it pays the bills.",
+    "Do you have any plans for the weekend?",
+]
+
+# New replies from the model. Some repeat the history word for word, some with small changes
+replies = [
+    "That sounds like a lot of fun! What do you do for work?",
+    "That sounds like a lot of fun. What do you do for a living?",
+    "That sounds like fun. Where do you work?",
+    "I'm good, thank you. How are you doing?",
+    "I'm fine, thanks. How are you?",
+    "I'm good thank you. How are you doing today?",
+    "I love to go hiking in the mountains with my cat. Do you have any pets?",
+    "I like hiking with my dog. Do you have any kids?",
+    "That's too bad. I hope you feel better.",
+    "That is too bad. I hope you get better soon.",
+    "I have never been to Norway, but I would love to visit someday. What is it like?",
+    "I've been to Sweden once. It was beautiful.",
+    "What made you interested in working as a cook?",
+    "What made you want to become a chef?",
+    "Why do you want to work as a chef?",
+    "I work at a grocery store. It's not a great job, but it pays the bills.",
+    "I used to work at a grocery store too.",
+    "Do you have any plans for the weekend? I'm going to the beach.",
+    "Do you have any plans for tonight?",
+    "Any plans for the weekend?",
+    "What is your favorite food? Mine is pizza.",
+    "How long have you been working as a chef?",
+    "That's great to hear. What do you like most about your job?",
+    "Do you have any pets? I have a dog named Max.",
+    "I hope you have a great day.",
+]
+
+# ---------------------------------------------
+
+
+def sentences_of(texts):
+    sentences = []
+    for text in texts:
+        parts, _ = split_text_into_sentences(text)
+        sentences.extend(part for part in parts if part.strip() != "")
+    return sentences
+
+
+def main():
+    previous = sentences_of(history)
+    new = sentences_of(replies)
+
+    # Old measure, as the filter used to compute it
+    old_scores = np.array(
+        [max(SequenceMatcher(a=s, b=p).ratio() for p in previous) for s in new]
+    )
+    # New measure
+    new_scores = (fingerprint_sentences(new) @ fingerprint_sentences(previous).T).max(
+        axis=1
+    )
+    old_drops = old_scores >= old_threshold
+
+    print(f"{len(new)} sentences, {old_drops.sum()} dropped by SequenceMatcher >= {old_threshold}\n")
+    print(f"  {'threshold':<10}{'dropped':>8}{'only new':>10}{'only old':>10}")
+    best = None
+    for threshold in thresholds:
+        new_drops = new_scores >= threshold
+        only_new = int((new_drops & ~old_drops).sum())
+        only_old = int((old_drops & ~new_drops).sum())
+        print(f"  {threshold:<10}{new_drops.sum():>8}{only_new:>10}{only_old:>10}")
+        # Ties go to the threshold that drops as many sentences as the old filter did
+        score = (only_new + only_old, abs(int(new_drops.sum()) - int(old_drops.sum())))
+        if best is None or score < best[1]:
+            best = (threshold, score)
+    print(f"\nFewest disagreements at SIMILARITY_THRESHOLD={best[0]}\n")
+
+    print(f"  {'ratio':>6}{'cosine':>8}  sentence")
+    for i in np.argsort(-old_scores):
+        print(f"  {old_scores[i]:6.2f}{new_scores[i]:8.2f}  {new[i].strip()}")
+
+
+if __name__ == "__main__":
+    main()
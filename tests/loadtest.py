@@ -0,0 +1,114 @@
+import aiohttp
+import asyncio
+import argparse
+import statistics
+import time
+
+"""
+Load test of the backend's own throughput, without the real upstreams.
+
+1. Start the fake model services
+    $ python -m chat.fakes.servers --port 8001
+2. Start the backend against the fakes
+    $ INTERVIEW_MODEL_URL=http://localhost:8001 FIKA_MODEL_URL=http://localhost:8001 \\
+      RASA_NLU_URL=http://localhost:8001 USE_FAKE_TRANSLATE=1 USE_FAKE_FIRESTORE=1 \\
+      uvicorn main:app --port 8000
+3. Run the test
+    $ python tests/loadtest.py --url http://localhost:8000 --chatters 50 --messages 10
+
+Every simulated chatter starts an interview and then sends its messages one at a time.
+Prints throughput and latency percentiles for /init and for the replies.
+Set the fake latencies to 0 (e.g. FAKE_INFERENCE_LATENCY=constant:0) to find the backend's throughput ceiling.
+"""
+
+init_data = {
+    "created_at": "1999-04-07 18:59:24.584658",
+    "development_testing": True,
+    "lang": "sv",
+    "name": "load test",
+    "persona": "intervju",
+    "user_ip_number": "127.0.0.1",
+    "job": "Snickare",
+    "has_experience": True,
+    "enable_small_talk": False,
+    "user_id": None,
+    "use_huggingface": False,
+}
+
+user_messages = [
+    "Jag har jobbat som snickare i fem år",
+    "Jag tycker om att arbeta med händerna och bygga saker",
+    "Mina kollegor skulle säga att jag är noggrann och glad",
+    "Jag vill lära mig mer och utvecklas i mitt yrke",
+]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def chatter(session, url, persona, nbr_messages, latencies, errors):
+    tic = time.perf_counter()
+    async with session.post(url + "/init", json=dict(init_data, persona=persona)) as r:
+        if r.status >= 300:
+            errors.append(r.status)
+            return
+        conversation_id = (await r.json())["conversation_id"]
+    latencies["init"].append(time.perf_counter() - tic)
+
+    for i in range(nbr_messages):
+        data = {
+            "created_at": "1999-01-01 00:00:00.000000",
+            "conversation_id": conversation_id,
+            "lang": "sv",
+            "text": user_messages[i % len(user_messages)],
+            "recording_used": False,
+            "response_time": 0,
+        }
+        tic = time.perf_counter()
+        async with session.post(f"{url}/{persona}", json=data) as r:
+            await r.read()
+            if r.status >= 300:
+                errors.append(r.status)
+                continue
+        latencies["reply"].append(time.perf_counter() - tic)
+
+
+async def main(url, persona, nbr_chatters, nbr_messages):
+    latencies = {"init": [], "reply": []}
+    errors = []
+    connector = aiohttp.TCPConnector(limit=nbr_chatters)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tic = time.perf_counter()
+        await asyncio.gather(
+            *[
+                chatter(session, url, persona, nbr_messages, latencies, errors)
+                for _ in range(nbr_chatters)
+            ]
+        )
+        elapsed = time.perf_counter() - tic
+
+    nbr_requests = sum(len(v) for v in latencies.values()) + len(errors)
+    throughput = nbr_requests / elapsed
+    print(f"{nbr_requests} requests in {elapsed:0.2f}s: {throughput:0.1f} req/s")
+    print(f"Errors: {len(errors)}")
+    for name, values in latencies.items():
+        if values:
+            print(
+                f"{name}: mean {statistics.mean(values):0.3f}s, "
+                f"p50 {percentile(values, 0.5):0.3f}s, "
+                f"p95 {percentile(values, 0.95):0.3f}s, "
+                f"p99 {percentile(values, 0.99):0.3f}s"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--persona", default="intervju", choices=["intervju", "fika"])
+    parser.add_argument("--chatters", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=10)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.url, args.persona, args.chatters, args.messages))